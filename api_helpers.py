@@ -1,6 +1,6 @@
 import os
 from dotenv import load_dotenv
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 import uuid
 from PIL import Image
@@ -8,120 +8,179 @@ import io
 from pathlib import Path
 import traceback
 
+from image_renditions import render_renditions
+from storage import MB, make_storage_backend
 
-load_dotenv()
 
-aws_access_key_id = os.environ['aws_access_key_id']
-aws_secret_access_key = os.environ['aws_secret_access_key']
+load_dotenv()
 
-s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id,
-                  aws_secret_access_key=aws_secret_access_key)
+# Uploads share one thread pool per process, so the original and the
+# thumbnail go up at the same time without starting threads per request.
+UPLOAD_THREADS = int(os.environ.get('S3_UPLOAD_THREADS', 8))
+S3_MULTIPART_CONCURRENCY = int(os.environ.get('S3_MULTIPART_CONCURRENCY', 4))
+
+# Browsers upload straight to S3 under this prefix of the large image
+# bucket (see presigned_upload), and files uploaded through the app are
+# staged there too (see stage_upload); the image job then stores the image
+# like any other upload and deletes the staged object.
+UPLOAD_PREFIX = "uploads/"
+PRESIGNED_UPLOAD_EXPIRES = int(os.environ.get('PRESIGNED_UPLOAD_EXPIRES', 15 * 60))
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 20 * MB))
+UPLOAD_CONTENT_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif")
+
+# "s3", or "file:///some/dir" to keep images on local disk (see storage.py)
+storage = make_storage_backend(
+    os.environ.get('STORAGE_BACKEND', 's3'),
+    base_url=os.environ.get('STORAGE_BASE_URL'),
+    region='us-west-1',
+    # every upload thread may have a multipart upload's parts in flight
+    max_pool_connections=UPLOAD_THREADS * S3_MULTIPART_CONCURRENCY,
+    multipart_threshold=int(os.environ.get('S3_MULTIPART_THRESHOLD', 8 * MB)),
+    multipart_chunksize=int(os.environ.get('S3_MULTIPART_CHUNKSIZE', 8 * MB)),
+    multipart_concurrency=S3_MULTIPART_CONCURRENCY,
+)
 BUCKET_NAME_LARGE_IMAGES = 'sharebnb-gmm'
 BUCKET_NAME_SMALL_IMAGES = 'sharebnb-gmm-small-images'
 
+upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_THREADS, thread_name_prefix="s3-upload")
 
-bucket_base_url_large_images = "https://sharebnb-gmm.s3.us-west-1.amazonaws.com/"
-bucket_base_url_small_images = "https://sharebnb-gmm-small-images.s3.us-west-1.amazonaws.com/"
 
+def image_url(bucket, key):
+    """ Public url of an object in storage """
 
-def upload_to_aws(file):
-    """ Uploads a file to the aws """
+    return f"{storage.base_url(bucket)}{key}"
 
-    filename = f"{uuid.uuid4()}"
-    try:
-        s3.put_object(
-            Body=file,
-            Bucket=BUCKET_NAME_LARGE_IMAGES,
-            Key=filename
-        )
-    except Exception as e:
-        print("failed to upload orig image: ", e)
 
-    orig_image_url = f"{bucket_base_url_large_images}{filename}"
+def put_file(file, bucket, key, content_type=None):
+    """ Uploads a file object to storage, in parts if it is large """
 
-    small_image_file = resize_image(file)
+    storage.put(file, bucket, key, content_type)
 
-    try:
-        s3.put_object(
-            Body=small_image_file,
-            Bucket=BUCKET_NAME_SMALL_IMAGES,
-            Key=f"{filename}-small"
-        )
-        small_image_url = f"{bucket_base_url_small_images}{filename}-small"
-    except Exception as e:
-        print("failed to upload thumbnail image: ", e)
-        traceback.print_exc()
 
-    return [orig_image_url, small_image_url]
+def presigned_upload(key, content_type):
+    """ Returns a presigned POST for uploading one file to key.
 
+    S3 rejects the upload unless it has this content type and is at most
+    MAX_UPLOAD_SIZE bytes. Raises NotImplementedError with local storage.
 
-# def resize_image(file):
-#     """ Resizes image to height of 140 and sizes width proportionally"""
+    Returns {url, fields}: POST multipart/form-data to url with fields,
+    then the file as "file".
+    """
 
-#     img = Image.open(file)
+    return storage.presigned_post(BUCKET_NAME_LARGE_IMAGES, key, content_type,
+                                  MAX_UPLOAD_SIZE, PRESIGNED_UPLOAD_EXPIRES)
 
-#     try:
-#         orig_height = int(img.height)
-#         orig_width = int(img.width)
-#         orig_height_to_140_ratio = orig_height / 140
-#         new_height = 140
 
-#         new_width = int(orig_width / orig_height_to_140_ratio)
+def stage_upload(file):
+    """ Streams a file uploaded through the app to the staging prefix and
+    returns its key, for an image job to pick up """
 
-#         new_image_size = (new_width, new_height)
-#         resized_img = img.resize(
-#             new_image_size, resample=Image.Resampling.BICUBIC)
-#         in_mem_file = io.BytesIO()
-#         resized_img.save(in_mem_file, format=img.format)
+    key = f"{UPLOAD_PREFIX}app/{uuid.uuid4()}"
+    put_file(file, BUCKET_NAME_LARGE_IMAGES, key)
+    return key
 
-#         in_mem_file.seek(0)
-#         img.close()
 
-#         return in_mem_file
-#     except Exception as e:
-#         print("failing at resize_image with error: ", e)
-#         traceback.print_exc()
+def staged_upload_size(key):
+    """ Returns the size of a staged upload, or None if it isn't there """
 
-def resize_image(file):
-    """ Resizes image to height of 280 and sizes width proportionally"""
+    return storage.size(BUCKET_NAME_LARGE_IMAGES, key)
 
-    img = Image.open(file)
 
-    try:
-        orig_height = int(img.height)
-        orig_width = int(img.width)
-        orig_height_to_280_ratio = orig_height / 280
-        new_height = 280
+def delete_staged_upload(key):
+    storage.delete(BUCKET_NAME_LARGE_IMAGES, key)
 
-        new_width = int(orig_width / orig_height_to_280_ratio)
 
-        new_image_size = (new_width, new_height)
-        resized_img = img.resize(new_image_size, resample=Image.Resampling.LANCZOS)
-        in_mem_file = io.BytesIO()
-        resized_img.save(in_mem_file, format=img.format, quality=85)
+def upload_to_aws(file, filename=None):
+    """ Uploads an image, its thumbnail and its responsive renditions to
+    storage (S3 unless STORAGE_BACKEND says otherwise).
 
-        in_mem_file.seek(0)
-        img.close()
+    Objects are stored under filename (a random uuid if not given), with
+    "-small" and "-<width>w.<ext>" suffixes for the resized copies.
 
-        return in_mem_file
-    except Exception as e:
-        print("failing at resize_image with error: ", e)
-        traceback.print_exc()
+    The original starts uploading while the image is decoded and resized
+    (once, see image_renditions), and every upload runs on upload_executor.
+    Raises if any upload fails.
 
+    Returns [orig_image_url, small_image_url, renditions, info], where
+    renditions is a list like [{width, height, format, url}, ...], smallest
+    first, and info is {width, height, placeholder, color} (see
+    image_renditions.describe_image).
+    """
 
+    filename = filename or f"{uuid.uuid4()}"
+    data = file.read()
 
-def make_thumbnail(file):
-    """ Given an image file, create a thumbnail for it and return as an
-    in-memory file """
+    orig_upload = upload_executor.submit(
+        put_file, io.BytesIO(data), BUCKET_NAME_LARGE_IMAGES, filename)
 
-    img = Image.open(file)
-    img.thumbnail((200, 200))
+    thumbnail, renditions, info = render_renditions(data)
+    uploads, small_image_url, rendition_urls = submit_renditions(
+        filename, thumbnail, renditions)
+    wait_for_uploads([orig_upload] + uploads)
+
+    orig_image_url = image_url(BUCKET_NAME_LARGE_IMAGES, filename)
+
+    return [orig_image_url, small_image_url, rendition_urls, info]
+
+
+def submit_renditions(filename, thumbnail, renditions):
+    """ Starts uploading the resized copies of the original under filename.
+
+    Returns (uploads, small_image_url, rendition_urls); pass uploads to
+    wait_for_uploads.
+    """
+
+    uploads = [upload_executor.submit(
+        put_file, io.BytesIO(thumbnail.data), BUCKET_NAME_SMALL_IMAGES,
+        f"{filename}-small", thumbnail.content_type)]
+
+    rendition_urls = []
+    for rendition in renditions:
+        key = f"{filename}-{rendition.width}w.{rendition.extension}"
+        uploads.append(upload_executor.submit(
+            put_file, io.BytesIO(rendition.data), BUCKET_NAME_SMALL_IMAGES,
+            key, rendition.content_type))
+        rendition_urls.append({
+            "width": rendition.width,
+            "height": rendition.height,
+            "format": rendition.format.lower(),
+            "url": image_url(BUCKET_NAME_SMALL_IMAGES, key),
+        })
+
+    small_image_url = image_url(BUCKET_NAME_SMALL_IMAGES, f"{filename}-small")
+    return uploads, small_image_url, rendition_urls
+
+
+def wait_for_uploads(uploads):
+    """ Waits for upload futures; raises the first failure """
+
+    for upload in uploads:
+        try:
+            upload.result()
+        except Exception as e:
+            print("failed to upload image: ", e)
+            traceback.print_exc()
+            raise
+
+
+def read_original(key):
+    """ Returns the bytes of an object in the large image bucket: an
+    original, or a staged upload """
+
+    return storage.get(BUCKET_NAME_LARGE_IMAGES, key)
+
+
+def list_originals(start_after=None, page_size=1000):
+    """ Yields the keys in the large image bucket in key order, page by page.
 
-    in_mem_file = io.BytesIO()
-    img.save(in_mem_file, format=img.format)
-    in_mem_file.seek(0)
+    Staged browser uploads (UPLOAD_PREFIX) are skipped. Pass the last key
+    seen as start_after to pick up where a previous listing stopped.
+    """
 
-    return in_mem_file
+    for key in storage.list_keys(BUCKET_NAME_LARGE_IMAGES, start_after, page_size):
+        if not key.startswith(UPLOAD_PREFIX):
+            yield key
 
 
 def aux_make_thumbnail_manual(file):
@@ -133,4 +192,3 @@ def aux_make_thumbnail_manual(file):
     img.save(f"{file_name}-small.jpg",'JPEG', dpi=(300,300) )
     img.show()
 
-# TODO: write function to re-thumbnail entire AWS bucket
@@ -1,15 +1,45 @@
+import json
+import math
 import os
+import tempfile
+import uuid
+import click
+from functools import wraps
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-from models import db, connect_db, User, Message, Pool, Reservation, PoolImage
+from flask import (Flask, Request, current_app, request, jsonify, stream_with_context,
+                   send_from_directory, abort)
+from models import db, connect_db, User, Message, Pool, Reservation, PoolImage, PoolFacet
+from models import RATE_BUCKET_WIDTH, DEFAULT_POOL_IMAGE_URL, IMAGE_PENDING, IMAGE_READY
+from sqlalchemy import case, exists, func, insert, or_, select, tuple_
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy.orm import aliased, load_only, make_transient_to_detached
 from flask_jwt_extended import create_access_token
+from flask_jwt_extended import get_current_user
+from flask_jwt_extended import get_jwt
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 
-from api_helpers import upload_to_aws
+from image_jobs import (ImageWorker, enqueue_image_job, store_images,
+                        image_executor)
+from rethumbnail import (Checkpoint, rethumbnail_bucket, DEFAULT_BATCH_SIZE,
+                         DEFAULT_CHECKPOINT_PATH)
+from image_renditions import InvalidImageError, check_image_header
+from passwords import PasswordHasherBusy
+from api_helpers import (UPLOAD_PREFIX, UPLOAD_CONTENT_TYPES, MAX_UPLOAD_SIZE,
+                         PRESIGNED_UPLOAD_EXPIRES, BUCKET_NAME_LARGE_IMAGES,
+                         BUCKET_NAME_SMALL_IMAGES, presigned_upload, staged_upload_size)
+import api_helpers
+from storage import LocalStorageBackend
+from cache import make_cache_backend
+from rate_limits import make_rate_limit_backend
+from revocations import RevokedTokens, issued_at_claims, token_issued_at
+from json_provider import make_json_provider
+from geo_helpers import EARTH_RADIUS_KM, bounding_box, covering_prefixes, parse_coordinates
 
 
 load_dotenv()
@@ -17,6 +47,10 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
+# orjson-backed responses (same wire format as Flask's default encoder).
+# Set FAST_JSON=0 to fall back to the stdlib encoder.
+app.json = make_json_provider(app, use_orjson=os.environ.get('FAST_JSON', '1') != '0')
+
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -33,12 +67,513 @@ jwt = JWTManager(app)
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = False
 app.config["JWT_IDENTITY_CLAIM"] = "username"
 
+# Each app process runs a background thread for image jobs (see
+# image_jobs.py). Set IMAGE_WORKER=0 when a separate `flask image-worker`
+# process handles them instead.
+app.config['IMAGE_WORKER_ENABLED'] = os.environ.get('IMAGE_WORKER', '1') != '0'
+
+# Response cache for pool reads (see cache.py): by default a SQLite file in
+# the temp dir, shared by all workers on the host, so a write in one worker
+# (or an image job finishing in any of them) invalidates every worker's
+# reads; "memory" per worker, which serves other workers' stale entries
+# until RESPONSE_CACHE_TTL, or "none". With IMAGE_WORKER=0, pools' images
+# are filled in by another process, whose invalidations only reach a shared
+# cache, so "memory" is refused.
+app.config['RESPONSE_CACHE_BACKEND'] = os.environ.get(
+    'RESPONSE_CACHE_BACKEND',
+    f"sqlite:///{os.path.join(tempfile.gettempdir(), 'pool_party_cache.db')}")
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+
+# Cache of the users behind JWTs (see load_current_user). Per worker by
+# default; entries are dropped on update/delete and otherwise live for
+# USER_CACHE_TTL seconds, which bounds how stale another worker's copy is.
+app.config['USER_CACHE_BACKEND'] = os.environ.get('USER_CACHE_BACKEND', 'memory')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+
+# Admission control for login and signup, the bcrypt-heavy routes (see
+# rate_limits.py): by default a SQLite file in the temp dir, so all workers
+# on the host share the limits (a sync gunicorn worker only ever has one
+# request in flight, so per-worker concurrency limits would never trip), or
+# "memory" per worker. RATE_LIMITS=0 turns them off.
+app.config['RATE_LIMITS_ENABLED'] = os.environ.get('RATE_LIMITS', '1') != '0'
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get(
+    'RATE_LIMIT_BACKEND',
+    f"sqlite:///{os.path.join(tempfile.gettempdir(), 'pool_party_limits.db')}")
+# requests in flight at once, per route
+app.config['AUTH_CONCURRENCY'] = int(
+    os.environ.get('AUTH_CONCURRENCY', 2 * (os.cpu_count() or 1)))
+# token buckets: burst requests at once, refilled at rate per second
+app.config['AUTH_IP_RATE'] = float(os.environ.get('AUTH_IP_RATE', 1))
+app.config['AUTH_IP_BURST'] = int(os.environ.get('AUTH_IP_BURST', 20))
+app.config['AUTH_USERNAME_RATE'] = float(os.environ.get('AUTH_USERNAME_RATE', 0.2))
+app.config['AUTH_USERNAME_BURST'] = int(os.environ.get('AUTH_USERNAME_BURST', 5))
+# proxies in front of the app that append to X-Forwarded-For (1 on Heroku)
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Most images one gallery upload (POST /api/pools/<id>/images) may carry
+MAX_GALLERY_FILES = 20
+
+# Requests larger than this are refused with 413 before the body is read;
+# each file is also held to MAX_UPLOAD_SIZE. Werkzeug spools uploaded files
+# over 500KB to a temp file while parsing. Room is left for the other form
+# fields. Only the gallery upload gets the larger limit (see
+# LimitedRequest).
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 64 * 1024
+app.config['MAX_GALLERY_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE * MAX_GALLERY_FILES + 64 * 1024
+
 
 connect_db(app)
 db.create_all()
 
+if (not app.config['IMAGE_WORKER_ENABLED']
+        and app.config['RESPONSE_CACHE_BACKEND'] == 'memory'):
+    raise ValueError("IMAGE_WORKER=0 needs a shared RESPONSE_CACHE_BACKEND (sqlite:///...), "
+                     "or pools would show stale image_status until their cache entries expire")
+
+response_cache = make_cache_backend(
+    app.config['RESPONSE_CACHE_BACKEND'],
+    max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+    default_ttl=app.config['RESPONSE_CACHE_TTL'])
+
+rate_limiter = make_rate_limit_backend(app.config['RATE_LIMIT_BACKEND'])
+
+user_cache = make_cache_backend(
+    app.config['USER_CACHE_BACKEND'],
+    max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+    default_ttl=app.config['USER_CACHE_TTL'])
+
+
+def user_cache_key(username):
+    return f"user:{username}"
+
+
+@jwt.user_lookup_loader
+def load_current_user(_jwt_header, jwt_data):
+    """ Returns the User a JWT belongs to, for get_current_user().
+
+    Runs at most once per request (Flask-JWT-Extended keeps the result for
+    the request). On a user_cache hit the user is attached to the session
+    without a query; its password hash, never cached, loads if accessed.
+    Returning None (user deleted) makes the request a 401.
+    """
+
+    username = jwt_data[app.config["JWT_IDENTITY_CLAIM"]]
+    key = user_cache_key(username)
+
+    cached = user_cache.get(key)
+    if cached is None:
+        user = db.session.get(User, username)
+        if user is not None:
+            columns = {column: getattr(user, column) for column in User.cached_columns}
+            user_cache.set(key, json.dumps(columns).encode(), tags=[key])
+        return user
+
+    user = User(**json.loads(cached))
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def forget_cached_user(username):
+    user_cache.invalidate_tags([user_cache_key(username)])
+
+
+# Tokens never expire (JWT_ACCESS_TOKEN_EXPIRES is False), so logging out
+# revokes them; see revocations.py.
+revoked_tokens = RevokedTokens()
+
+
+@jwt.additional_claims_loader
+def add_issued_at_claim(_identity):
+    """ Stamps each new token with its issue time to the microsecond """
+
+    return issued_at_claims()
+
+
+@jwt.token_in_blocklist_loader
+def check_token_revoked(_jwt_header, jwt_data):
+    """ Checked from memory before every @jwt_required view """
+
+    return revoked_tokens.is_revoked(
+        jwt_data[app.config["JWT_IDENTITY_CLAIM"]], jwt_data["jti"],
+        token_issued_at(jwt_data))
+
+
+image_worker = ImageWorker(
+    app, on_pool_updated=lambda pool_id: response_cache.invalidate_tags([pool_tag(pool_id)]),
+    on_user_updated=forget_cached_user)
+
+
+@app.before_request
+def start_image_worker():
+    """ Starts this process's image worker on its first request """
+
+    if app.config['IMAGE_WORKER_ENABLED'] and not app.testing:
+        image_worker.start()
+
+
+@app.cli.command("image-worker")
+def image_worker_command():
+    """ Process image jobs in the foreground until interrupted. """
+
+    image_worker.run_forever()
+
+
+@app.cli.command("rethumbnail")
+@click.option("--workers", type=int, default=None,
+              help="Resizing processes (default: one per CPU).")
+@click.option("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+@click.option("--checkpoint", "checkpoint_path", default=DEFAULT_CHECKPOINT_PATH,
+              help="Progress file; an existing one is resumed.")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint and start over.")
+def rethumbnail_command(workers, batch_size, checkpoint_path, restart):
+    """ Regenerate thumbnails and renditions for every image in S3. """
+
+    checkpoint = Checkpoint(checkpoint_path)
+    if restart:
+        checkpoint.clear()
+    elif checkpoint.after is not None:
+        print(f"resuming after {checkpoint.after}")
+
+    rethumbnail_bucket(checkpoint, workers=workers, batch_size=batch_size)
+    print(f"done: {checkpoint.done} images, {len(checkpoint.failed)} failed")
+    for key in checkpoint.failed:
+        print("failed:", key)
+
+
+# ALTER TABLE / CREATE INDEX scripts for existing databases, run in name order
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+
+def apply_migrations(connection):
+    """ Runs every migration script on connection; each is safe to rerun.
+
+    db.create_all() only creates missing tables, so the columns and indexes
+    added to existing ones since come from these. Tables that are new
+    altogether are left to db.create_all().
+    """
+
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        if name.endswith(".sql"):
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                connection.exec_driver_sql(f.read())
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """ Bring an existing database's tables up to date with models.py. """
+
+    with db.engine.begin() as connection:
+        apply_migrations(connection)
+    db.create_all()
+
+    # pool_facets made just now by create_all starts out empty, and the
+    # counts kept up by each write would never include the existing pools
+    if not db.session.query(PoolFacet.query.exists()).scalar():
+        PoolFacet.rebuild()
+        db.session.commit()
+    print("database upgraded")
+
+# Page sizes for list endpoints. Clients may ask for less than MAX_PAGE_SIZE
+# with ?limit=, never more.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+#######################  PAGINATION HELPERS START  ############################
+
+def get_page_limit():
+    """ Reads ?limit= from the query string and clamps it to MAX_PAGE_SIZE """
+
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_paginate(query, pk_column, after, limit):
+    """ Returns one page of query ordered on pk_column as (rows, next_cursor).
+
+    Rows strictly after the `after` cursor are returned, so the database only
+    walks the primary key index from the cursor on instead of counting past an
+    offset. One extra row is fetched to know whether another page exists;
+    next_cursor is None on the last page.
+    """
+
+    if after is not None:
+        query = query.filter(pk_column > after)
+
+    rows = query.order_by(pk_column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], pk_column.key)
+
+    return rows, next_cursor
+
+#######################  SPARSE FIELDSET HELPERS START  #######################
+
+class InvalidFieldsError(ValueError):
+    """ ?fields= named something the model doesn't serialize """
+
+
+@app.errorhandler(InvalidFieldsError)
+def handle_invalid_fields(error):
+    return (jsonify({"error": str(error)}), 400)
+
+
+def get_requested_fields(model):
+    """ Reads ?fields=a,b,c as a list of model serialize() keys.
+
+    Returns None when ?fields= is absent, meaning every field.
+    """
+
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in model.serialize_fields]
+    if unknown or not fields:
+        raise InvalidFieldsError(
+            f"fields must be a comma separated subset of {list(model.serialize_fields)}")
+
+    return fields
+
+
+def only_fields(query, model, fields, *extra_columns):
+    """ Limits query to the columns behind `fields` (plus extra_columns).
+
+    Unrequested columns are then never fetched from Postgres. Primary keys
+    are always loaded.
+    """
+
+    if fields is None:
+        return query
+
+    return query.options(load_only(*model.load_only_columns(fields), *extra_columns))
+
+#######################  CACHE HELPERS START  #################################
+
+# Cached pool responses are tagged so writes can drop exactly what they
+# affect:
+#   pool:<id>             every cached response that includes that pool
+#   pools:city:<city>     the city listing
+#   pools:owner:<user>    the owner's listing
+#   pools:list:tail       the last page of /api/pools, where new pools land
+POOLS_LIST_TAIL_TAG = "pools:list:tail"
+
+
+def pool_tag(pool_id):
+    return f"pool:{pool_id}"
+
+
+def new_pool_tags(pool):
+    """ Tags of the listings a newly created pool shows up in """
+
+    return [POOLS_LIST_TAIL_TAG,
+            f"pools:city:{pool.city}",
+            f"pools:owner:{pool.owner_username}"]
+
+
+def response_cache_key():
+    """ Cache key for the current request: endpoint, URL and query args """
+
+    view_args = ",".join(f"{k}={v}" for k, v in sorted(request.view_args.items()))
+    query_args = "&".join(
+        f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    return f"{request.endpoint}:{view_args}?{query_args}"
+
+
+def cached_json(build):
+    """ Serves the current request from response_cache when possible.
+
+    On a miss build() is called and must return (response, tags); a 200
+    response body is cached under response_cache_key() with those tags.
+    """
+
+    key = response_cache_key()
+    body = response_cache.get(key)
+    if body is not None:
+        return app.response_class(body, mimetype='application/json')
+
+    response, tags = build()
+    if response.status_code == 200:
+        response_cache.set(key, response.get_data(), tags=tags)
+    return response
+
+#######################  ADMISSION CONTROL HELPERS START  #####################
+
+# A crashed request gives its concurrency slot back after this long
+ADMISSION_SLOT_LEASE = 30
+
+
+def client_ip():
+    """ The client's address, from X-Forwarded-For behind TRUSTED_PROXIES """
+
+    proxies = app.config['TRUSTED_PROXIES']
+    route = request.access_route
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+    return request.remote_addr
+
+
+def too_many_requests(status, retry_after):
+    return (jsonify({"error": "too many requests, try again later"}),
+            status, {"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def admission_controlled(view):
+    """ Sheds load on an expensive route before it does any work.
+
+    Answers 429 when the client's IP or the username in the request body is
+    over its token bucket, and 503 when AUTH_CONCURRENCY requests to the
+    route are already in flight, both with Retry-After. Limits are shared
+    through rate_limiter.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config['RATE_LIMITS_ENABLED']:
+            return view(*args, **kwargs)
+
+        retry_after = rate_limiter.take(
+            f"ip:{client_ip()}", app.config['AUTH_IP_RATE'], app.config['AUTH_IP_BURST'])
+        if retry_after:
+            return too_many_requests(429, retry_after)
+
+        username = (request.get_json(silent=True) or request.form).get('username')
+        if isinstance(username, str) and username:
+            retry_after = rate_limiter.take(
+                f"username:{username}",
+                app.config['AUTH_USERNAME_RATE'], app.config['AUTH_USERNAME_BURST'])
+            if retry_after:
+                return too_many_requests(429, retry_after)
+
+        slots = f"route:{request.endpoint}"
+        slot_id = rate_limiter.acquire(
+            slots, app.config['AUTH_CONCURRENCY'], ADMISSION_SLOT_LEASE)
+        if slot_id is None:
+            return too_many_requests(503, 1)
+
+        try:
+            return view(*args, **kwargs)
+        finally:
+            rate_limiter.release(slots, slot_id)
+
+    return wrapper
+
+#######################  UPLOAD HELPERS START  ################################
+
+# endpoint -> config key of its body size limit, if not MAX_CONTENT_LENGTH
+CONTENT_LENGTH_LIMITS = {
+    "add_pool_image": "MAX_GALLERY_CONTENT_LENGTH",
+}
+
+
+class LimitedRequest(Request):
+    """ Request whose body size limit depends on the endpoint """
+
+    @property
+    def max_content_length(self):
+        config_key = CONTENT_LENGTH_LIMITS.get(self.endpoint, "MAX_CONTENT_LENGTH")
+        return current_app.config[config_key]
+
+
+app.request_class = LimitedRequest
+
+
+@app.before_request
+def limit_content_length():
+    """ Refuses bodies over the limit before they're read.
+
+    Werkzeug only applies max_content_length when parsing form data, so
+    without this JSON bodies of any size would be read and parsed.
+    """
+
+    max_length = request.max_content_length
+    if max_length is not None and (request.content_length or 0) > max_length:
+        raise RequestEntityTooLarge()
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """ One uploaded file is over MAX_UPLOAD_SIZE """
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(error):
+    if isinstance(error, UploadTooLarge):
+        return (jsonify({"error": f"upload is larger than {MAX_UPLOAD_SIZE} bytes"}), 413)
+
+    # the whole body is over this endpoint's limit
+    return (jsonify({"error": f"request is larger than {request.max_content_length} bytes"}),
+            413)
+
+
+@app.errorhandler(InvalidImageError)
+def handle_invalid_image(error):
+    return (jsonify({"error": str(error)}), 400)
+
+
+def check_uploaded_image(file):
+    """ Checks one uploaded file's size and image header.
+
+    Only the header is read, to reject files that aren't images or whose
+    dimensions are over the limits in image_renditions before any work is
+    queued. Raises UploadTooLarge or InvalidImageError.
+    """
+
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    if size > MAX_UPLOAD_SIZE:
+        raise UploadTooLarge()
+
+    check_image_header(file.stream)
+
+
+def get_uploaded_image():
+    """ Returns the checked uploaded image in request.files['file'], or None """
+
+    file = request.files.get('file')
+    if not file:
+        return None
+
+    check_uploaded_image(file)
+    return file
+
+
+def get_uploaded_images():
+    """ Returns every checked uploaded image sent as 'file' (possibly none) """
+
+    files = [file for file in request.files.getlist('file') if file]
+    for file in files:
+        check_uploaded_image(file)
+    return files
+
+
+@app.get("/media/<bucket>/<path:key>")
+def get_local_image(bucket, key):
+    """Serve an image kept by the local storage backend
+    (STORAGE_BACKEND=file:///some/dir); 404 with S3 storage."""
+
+    storage = api_helpers.storage
+    if (not isinstance(storage, LocalStorageBackend)
+            or bucket not in (BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES)):
+        abort(404)
+
+    return send_from_directory(storage.bucket_path(bucket), key)
+
 #######################  AUTH ENDPOINTS START  ################################
+
+@app.errorhandler(PasswordHasherBusy)
+def handle_password_hasher_busy(error):
+    # too many logins/signups already waiting on bcrypt; clients back off
+    return (jsonify({"error": "too many login attempts in progress, try again"}),
+            503, {"Retry-After": "1"})
+
+
 @app.route("/api/auth/login", methods=["POST"])
+@admission_controlled
 def login():
     """ Login user, returns JWT if authenticated """
 
@@ -49,13 +584,37 @@ def login():
     user = User.authenticate(username, password)
 
     if user:
+        # saves the password hash if authenticate upgraded its cost
+        db.session.commit()
         token = create_access_token(identity=user.username)
         return jsonify(token=token)
     else:
         return jsonify({"error": "Invalid credentials"}), 401
 
 
+@app.post("/api/auth/logout")
+@jwt_required()
+def logout():
+    """ Revoke the token this request was made with """
+
+    token = get_jwt()
+    revoked_tokens.revoke_token(token[app.config["JWT_IDENTITY_CLAIM"]], token["jti"])
+
+    return jsonify(message="logged out")
+
+
+@app.post("/api/auth/logout-all")
+@jwt_required()
+def logout_everywhere():
+    """ Revoke every token issued to the current user so far """
+
+    revoked_tokens.revoke_user(get_jwt_identity())
+
+    return jsonify(message="logged out everywhere")
+
+
 @app.post("/api/auth/signup")
+@admission_controlled
 def create_user():
     """Add user, and return data about new user.
 
@@ -63,29 +622,25 @@ def create_user():
         {user: {id, email, username, image_url, location, reserved_pools, owned_pools}}
     """
     print("form", request.form)
+    file = get_uploaded_image()
     try:
         form = request.form
         print("form", form)
 
-        file = request.files.get('file')
-        url = None
-        if (file):
-            [url] = upload_to_aws(file) # TODO: refactor to account for [orig_size_img, small_size_img]
-            # print("url", url)
-            # print("request.form.get('text')", request.form.get('text'))
-            # print("request.form['text']", request.form['text'])
-            # print("request.form['text'].keys()", request.form['text'].keys())
-            # print("request.forms.keys", request.form.keys())
-            # print("request.forms.items", request.form.items())
-
         user = User.signup(
             username=form['username'],
             password=form['password'],
             email=form['email'],
             location=form['location'],
-            image_url=url
         )
+        # The profile image is uploaded by the image worker; until then the
+        # user has the default image.
+        if (file):
+            db.session.flush()
+            enqueue_image_job(file, username=user.username)
         db.session.commit()
+        if (file):
+            image_worker.wake()
 
 
         # user = User.authenticate(username, password)
@@ -97,6 +652,8 @@ def create_user():
 
         # return (jsonify(user=user.serialize()), 201)
 
+    except PasswordHasherBusy:
+        raise
     except Exception as error:
         print("Error", error)
         db.session.rollback()
@@ -108,17 +665,24 @@ def create_user():
 
 @app.get("/api/users")
 def list_users():
-    """Return all users in system.
+    """Return a page of users ordered by username.
+
+    Accepts ?limit= (capped at MAX_PAGE_SIZE), ?after=<username>, the
+    next_cursor of the previous page, and ?fields= to return only some keys.
 
     Returns JSON like:
         {users: [{id, email, username, image_url,
-        location, reserved_pools, owned_pools}, ...]}
+        location, reserved_pools, owned_pools}, ...], next_cursor}
     """
-    users = User.query.all()
+    after = request.args.get('after')
+    fields = get_requested_fields(User)
 
-    serialized = [user.serialize() for user in users]
+    query = only_fields(User.query, User, fields)
+    users, next_cursor = keyset_paginate(query, User.username, after, get_page_limit())
 
-    return jsonify(users=serialized)
+    serialized = [user.serialize(fields) for user in users]
+
+    return jsonify(users=serialized, next_cursor=next_cursor)
 
 @app.get('/api/users/<username>')
 def show_user(username):
@@ -142,9 +706,8 @@ def update_user(username):
         {user: id, email, username, image_url, location, reserved_pools, owned_pools}
     """
 
-    current_user = get_jwt_identity()
-    if current_user == username:
-        user = User.query.get_or_404(username)
+    user = get_current_user()
+    if user.username == username:
         data = request.json
         # TODO: ADD "CHANGE PASSWORD FEATURE LATER"
         user.email = data['email'],
@@ -152,6 +715,7 @@ def update_user(username):
 
         db.session.add(user)
         db.session.commit()
+        forget_cached_user(username)
 
         return (jsonify(user=user.serialize()), 200)
 
@@ -163,12 +727,13 @@ def update_user(username):
 def delete_user(username):
     """Delete user. """
 
-    current_user = get_jwt_identity()
-    if current_user == username:
-        user = User.query.get_or_404(username)
-
+    user = get_current_user()
+    if user.username == username:
         db.session.delete(user)
         db.session.commit()
+        forget_cached_user(username)
+        # a new account with the same username mustn't inherit the tokens
+        revoked_tokens.revoke_user(username)
 
         return jsonify("User successfully deleted", 200)
     return (jsonify({"error": "not authorized"}), 401)
@@ -178,13 +743,22 @@ def delete_user(username):
 def list_pools_of_user(username):
     """Show pools of logged in user.
 
+    Accepts ?fields= to return only some keys.
+
     Returns JSON like:
         {pools: {id, owner_id, rate, size, description, address, image_url}, ...}
     """
-    pools = Pool.query.filter(Pool.owner_username == username)
-    serialized = [pool.serialize() for pool in pools]
+    fields = get_requested_fields(Pool)
 
-    return jsonify(pools=serialized)
+    def build():
+        query = only_fields(Pool.query, Pool, fields)
+        pools = query.filter(Pool.owner_username == username).all()
+        serialized = [pool.serialize(fields) for pool in pools]
+
+        tags = [f"pools:owner:{username}"] + [pool_tag(pool.id) for pool in pools]
+        return jsonify(pools=serialized), tags
+
+    return cached_json(build)
 
 
 ################################################################################
@@ -192,15 +766,34 @@ def list_pools_of_user(username):
 
 @app.get("/api/pools")
 def list_pools():
-    """Return all pools in system.
+    """Return a page of pools ordered by id.
+
+    Accepts ?limit= (capped at MAX_PAGE_SIZE), ?after=<pool id>, the
+    next_cursor of the previous page, and ?fields= to return only some keys,
+    e.g. ?fields=id,rate,city,small_image_url for pool cards.
 
     Returns JSON like:
-        {pools: {id, owner_id, rate, size, description, address, small_image_url}, ...}
+        {pools: {id, owner_id, rate, size, description, address, small_image_url}, ...,
+         next_cursor}
     """
-    pools = Pool.query.all()
+    after = request.args.get('after')
+    if after is not None:
+        if not (after.isascii() and after.isdigit()):
+            return (jsonify({"error": "after must be a pool id"}), 400)
+        after = int(after)
+    fields = get_requested_fields(Pool)
 
-    serialized = [pool.serialize() for pool in pools]
-    return jsonify(pools=serialized)
+    def build():
+        query = only_fields(Pool.query, Pool, fields)
+        pools, next_cursor = keyset_paginate(query, Pool.id, after, get_page_limit())
+        serialized = [pool.serialize(fields) for pool in pools]
+
+        tags = [pool_tag(pool.id) for pool in pools]
+        if next_cursor is None:
+            tags.append(POOLS_LIST_TAIL_TAG)
+        return jsonify(pools=serialized, next_cursor=next_cursor), tags
+
+    return cached_json(build)
 
 
 @app.get('/api/pools/<int:pool_id>')
@@ -210,23 +803,306 @@ def show_pool_by_id(pool_id):
     Returns JSON like:
         {pool: owner_username, rate, size, description, address}
     """
-    pool = Pool.query.get_or_404(pool_id)
-    pool = pool.serialize()
+    def build():
+        pool = Pool.query.get_or_404(pool_id)
+        pool = pool.serialize()
+
+        return jsonify(pool=pool), [pool_tag(pool_id)]
+
+    return cached_json(build)
+
+
+# sort name -> (sort column, descending?) for /api/pools/search. Ids are
+# serial, so "newest" is simply the highest id first.
+POOL_SEARCH_SORTS = {
+    "newest": (None, True),
+    "rate_asc": (Pool.rate, False),
+    "rate_desc": (Pool.rate, True),
+}
+
+@app.get('/api/pools/search')
+def search_pools():
+    """Search pools by city, rate range, owner and availability in a single query.
+
+    Accepts ?city=, ?min_rate=, ?max_rate=, ?owner=, ?sort= (newest,
+    rate_asc or rate_desc; default newest), ?limit= and ?after=, the
+    next_cursor of the previous page. With ?available_from= and
+    ?available_to= (ISO 8601 datetimes) only pools with no reservation
+    overlapping [available_from, available_to) are returned. ?fields=
+    limits the keys returned.
+
+    Returns JSON like:
+        {pools: [{id, owner_username, rate, size, description, city, ...}, ...],
+         next_cursor}
+    """
+    args = request.args
+
+    sort = args.get('sort', 'newest')
+    if sort not in POOL_SEARCH_SORTS:
+        return (jsonify({"error": f"sort must be one of {list(POOL_SEARCH_SORTS)}"}), 400)
+    sort_column, descending = POOL_SEARCH_SORTS[sort]
+
+    try:
+        min_rate = parse_rate(args['min_rate']) if 'min_rate' in args else None
+        max_rate = parse_rate(args['max_rate']) if 'max_rate' in args else None
+        after = parse_search_cursor(args.get('after'), sort_column)
+        available_from, available_to = parse_availability_window(args)
+    except (InvalidOperation, TypeError, ValueError):
+        return (jsonify({"error": "Invalid rate, cursor or availability window"}), 400)
+
+    # rate is needed for the cursor even if it wasn't asked for
+    fields = get_requested_fields(Pool)
+    query = only_fields(Pool.query, Pool, fields, Pool.rate)
+    if 'city' in args:
+        query = query.filter(Pool.city == args['city'])
+    if 'owner' in args:
+        query = query.filter(Pool.owner_username == args['owner'])
+    if min_rate is not None:
+        query = query.filter(Pool.rate >= min_rate)
+    if max_rate is not None:
+        query = query.filter(Pool.rate <= max_rate)
+    if available_from is not None:
+        window = func.tsrange(available_from, available_to, '[)')
+        query = query.filter(~exists().where(
+            Reservation.pool_id == Pool.id,
+            Reservation.period.op('&&')(window)))
+
+    # Keyset on (sort column, id) so that every page is an index range scan.
+    key_columns = [sort_column, Pool.id] if sort_column is not None else [Pool.id]
+    key = tuple_(*key_columns) if len(key_columns) > 1 else key_columns[0]
+    if after is not None:
+        query = query.filter(key < after if descending else key > after)
+
+    order = [col.desc() if descending else col.asc() for col in key_columns]
+    limit = get_page_limit()
+    pools = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(pools) > limit:
+        pools = pools[:limit]
+        last = pools[-1]
+        next_cursor = (f"{last.rate}_{last.id}" if sort_column is not None
+                       else str(last.id))
+
+    serialized = [pool.serialize(fields) for pool in pools]
+    return jsonify(pools=serialized, next_cursor=next_cursor)
+
+
+def parse_search_cursor(after, sort_column):
+    """ Turns a search next_cursor back into the value(s) to compare with.
+
+    Cursors are "<id>" when sorting on id alone and "<rate>_<id>" when
+    sorting on rate. Raises ValueError/InvalidOperation if malformed.
+    """
+
+    if after is None:
+        return None
+
+    if sort_column is None:
+        return int(after)
+
+    rate, pool_id = after.split('_')
+    return tuple_(parse_rate(rate), int(pool_id))
+
+
+# Pool.rate is numeric(10,2)
+MAX_RATE = Decimal('1e8')
+
+def parse_rate(value):
+    """ Returns a rate from search args as a Decimal.
+
+    Raises ValueError/InvalidOperation unless it's a number Pool.rate can
+    hold (finite, under MAX_RATE, at most 2 decimal places), so that
+    Postgres never sees one it would fail on.
+    """
+
+    rate = Decimal(value)
+    if not rate.is_finite() or abs(rate) >= MAX_RATE:
+        raise ValueError("rate out of range")
+    if rate.normalize().as_tuple().exponent < -2:
+        raise ValueError("rate has more than 2 decimal places")
+
+    return rate
+
+
+def parse_availability_window(args):
+    """ Returns (available_from, available_to) datetimes from search args.
+
+    Both are None when neither is given. Datetimes with an offset (e.g.
+    "2023-02-04T16:00:00Z") are converted to naive UTC, like the
+    reservation dates they're compared with. Raises ValueError if only one
+    is given, either is not ISO 8601, or the window is empty.
+    """
+
+    if 'available_from' not in args and 'available_to' not in args:
+        return None, None
+
+    available_from = parse_naive_utc(args.get('available_from', ''))
+    available_to = parse_naive_utc(args.get('available_to', ''))
+    if available_to <= available_from:
+        raise ValueError("available_to must be after available_from")
+
+    return available_from, available_to
+
+
+def parse_naive_utc(value):
+    """ Parses an ISO 8601 datetime, converting one with an offset to naive
+    UTC """
+
+    # fromisoformat only accepts a "Z" suffix from Python 3.11
+    if value.endswith(('Z', 'z')):
+        value = f"{value[:-1]}+00:00"
+
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+@app.get('/api/pools/search/text')
+def text_search_pools():
+    """Keyword search over pool descriptions and cities, best matches first.
+
+    Accepts ?q= (web search syntax: words, "quoted phrases", -excluded),
+    ?limit=, ?page= (1-based) and ?fields=. Matching goes through the GIN
+    index on Pool.search_vector, so only matching rows are ranked.
+
+    Returns JSON like:
+        {pools: [{id, owner_username, rate, size, description, city, ...}, ...],
+         next_page}
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        return (jsonify({"error": "q is required"}), 400)
+
+    page = max(1, request.args.get('page', 1, type=int))
+    limit = get_page_limit()
+    fields = get_requested_fields(Pool)
+
+    tsquery = func.websearch_to_tsquery('english', q)
+    rank = func.ts_rank(Pool.search_vector, tsquery)
+
+    pools = (only_fields(Pool.query, Pool, fields)
+             .filter(Pool.search_vector.op('@@')(tsquery))
+             .order_by(rank.desc(), Pool.id)
+             .offset((page - 1) * limit)
+             .limit(limit + 1)
+             .all())
+
+    next_page = None
+    if len(pools) > limit:
+        pools = pools[:limit]
+        next_page = page + 1
+
+    serialized = [pool.serialize(fields) for pool in pools]
+    return jsonify(pools=serialized, next_page=next_page)
+
+
+DEFAULT_SEARCH_RADIUS_KM = 10
+MAX_SEARCH_RADIUS_KM = 200
+
+@app.get('/api/pools/nearby')
+def search_pools_nearby():
+    """Return pools within a radius of a point, closest first.
+
+    Accepts ?lat=, ?lng=, ?radius_km= (default DEFAULT_SEARCH_RADIUS_KM,
+    capped at MAX_SEARCH_RADIUS_KM), ?limit= and ?fields=. Candidates are pruned with
+    geohash prefixes and latitude bounds before exact distances are computed.
+
+    Returns JSON like:
+        {pools: [{id, owner_username, rate, ..., latitude, longitude, distance_km}, ...]}
+    """
+    try:
+        lat, lng = parse_coordinates(request.args.get('lat'), request.args.get('lng'))
+    except ValueError:
+        return (jsonify({"error": "lat and lng are required"}), 400)
+
+    radius_km = request.args.get('radius_km', DEFAULT_SEARCH_RADIUS_KM, type=float)
+    radius_km = max(0, min(radius_km, MAX_SEARCH_RADIUS_KM))
+
+    fields = get_requested_fields(Pool)
+
+    min_lat, max_lat, _, _ = bounding_box(lat, lng, radius_km)
+    query = only_fields(Pool.query, Pool, fields).filter(Pool.latitude.between(min_lat, max_lat))
+
+    prefixes = covering_prefixes(lat, lng, radius_km)
+    if prefixes is not None:
+        query = query.filter(
+            or_(*[Pool.geohash.startswith(prefix, autoescape=True)
+                  for prefix in sorted(prefixes)]))
+
+    # Haversine; least() guards asin against rounding just past 1.
+    distance = (2 * EARTH_RADIUS_KM * func.asin(func.sqrt(func.least(1,
+        func.power(func.sin(func.radians(Pool.latitude - lat) / 2), 2)
+        + func.cos(func.radians(lat)) * func.cos(func.radians(Pool.latitude))
+        * func.power(func.sin(func.radians(Pool.longitude - lng) / 2), 2)))))
+    distance = distance.label('distance_km')
+
+    results = (query
+               .add_columns(distance)
+               .filter(distance <= radius_km)
+               .order_by(distance, Pool.id)
+               .limit(get_page_limit())
+               .all())
+
+    serialized = [{**pool.serialize(fields), "distance_km": round(distance_km, 3)}
+                  for pool, distance_km in results]
+    return jsonify(pools=serialized)
+
+
+@app.get('/api/pools/facets')
+def show_pool_facets():
+    """Return pool counts per city and a rate histogram for the browse page.
+
+    Read from the precomputed pool_facets table rather than counted from
+    pools, so the cost doesn't grow with the number of pools.
+
+    Returns JSON like:
+        {facets: {cities: [{city, count}, ...],
+                  rates: [{min_rate, max_rate, count}, ...]}}
+    """
+    facets = PoolFacet.query.filter(PoolFacet.pool_count > 0).all()
+
+    cities = sorted((f for f in facets if f.facet == "city"), key=lambda f: f.value)
+    rates = sorted((f for f in facets if f.facet == "rate"), key=lambda f: Decimal(f.value))
+
+    return jsonify(facets={
+        "cities": [{"city": f.value, "count": f.pool_count} for f in cities],
+        "rates": [{"min_rate": Decimal(f.value),
+                   "max_rate": Decimal(f.value) + RATE_BUCKET_WIDTH,
+                   "count": f.pool_count} for f in rates],
+    })
+
+
+@app.cli.command("refresh-facets")
+def refresh_facets():
+    """ Recompute pool_facets from scratch; schedule this periodically. """
+
+    PoolFacet.rebuild()
+    db.session.commit()
+    print("pool facets refreshed")
 
-    return jsonify(pool=pool)
 
 @app.get('/api/pools/<city>')
 def show_pool_by_city(city):
     """Show information on a specific pool.
 
+    Accepts ?fields= to return only some keys.
+
     Returns JSON like:
         {pool: owner_username, rate, size, description, address}
     """
+    fields = get_requested_fields(Pool)
 
-    pools = Pool.query.filter(Pool.city == city)
-    serialized = [pool.serialize() for pool in pools]
+    def build():
+        query = only_fields(Pool.query, Pool, fields)
+        pools = query.filter(Pool.city == city).all()
+        serialized = [pool.serialize(fields) for pool in pools]
 
-    return jsonify(pools=serialized)
+        tags = [f"pools:city:{city}"] + [pool_tag(pool.id) for pool in pools]
+        return jsonify(pools=serialized), tags
+
+    return cached_json(build)
 
 # @app.post("/api/pools")
 # @jwt_required()
@@ -269,15 +1145,19 @@ def create_pool():
     print("I'm in api/pools")
     current_user = get_jwt_identity()
     if current_user:
+        file = get_uploaded_image()
+        location = None
+        if request.form.get('latitude') and request.form.get('longitude'):
+            try:
+                location = parse_coordinates(request.form['latitude'],
+                                             request.form['longitude'])
+            except ValueError as error:
+                return (jsonify({"error": str(error)}), 400)
         try:
             form=request.form
             print("current_user", current_user)
             print("form", form)
-            file = request.files.get('file')
             print("file", file)
-            orig_url=None
-            if(file):
-                [orig_url, small_url] = upload_to_aws(file)
 
             pool = Pool(
                 owner_username=current_user,
@@ -285,13 +1165,27 @@ def create_pool():
                 size=form['size'],
                 description=form['description'],
                 city=form['city'],
-                orig_image_url=orig_url,
-                small_image_url=small_url
+                orig_image_url=DEFAULT_POOL_IMAGE_URL,
+                small_image_url=DEFAULT_POOL_IMAGE_URL
             )
+            if location is not None:
+                pool.set_location(*location)
             print("I made it out of pool")
 
             db.session.add(pool)
+            PoolFacet.pool_added(pool)
+
+            # Resize + upload happen in the image worker; the response says
+            # image_status "pending" and the urls are filled in later.
+            if(file):
+                db.session.flush()
+                pool.image_status = IMAGE_PENDING
+                enqueue_image_job(file, pool_id=pool.id)
+
             db.session.commit()
+            response_cache.invalidate_tags(new_pool_tags(pool))
+            if(file):
+                image_worker.wake()
 
             return (jsonify(pool=pool.serialize()), 201)
         except Exception as error:
@@ -317,13 +1211,33 @@ def update_pool(pool_id):
     if current_user == pool.owner_username:
         data = request.json
 
-        pool.rate = data['rate'],
-        pool.size = data['size'],
-        pool.description = data['description'],
+        location = None
+        if 'latitude' in data and 'longitude' in data:
+            # both null clears the location
+            location = (None, None)
+            if data['latitude'] is not None or data['longitude'] is not None:
+                try:
+                    location = parse_coordinates(data['latitude'], data['longitude'])
+                except ValueError as error:
+                    return (jsonify({"error": str(error)}), 400)
+
+        old_facet_keys = PoolFacet.keys_for(pool)
+
+        pool.rate = data['rate']
+        pool.size = data['size']
+        pool.description = data['description']
         pool.address = data['address']
+        if location is not None:
+            pool.set_location(*location)
+
+        new_facet_keys = PoolFacet.keys_for(pool)
+        if new_facet_keys != old_facet_keys:
+            PoolFacet.adjust(old_facet_keys, -1)
+            PoolFacet.adjust(new_facet_keys, 1)
 
         db.session.add(pool)
         db.session.commit()
+        response_cache.invalidate_tags([pool_tag(pool_id)])
 
         return (jsonify(pool=pool.serialize()), 200)
 
@@ -345,7 +1259,9 @@ def delete_pool(pool_id):
     if current_user == pool.owner_username:
 
         db.session.delete(pool)
+        PoolFacet.pool_removed(pool)
         db.session.commit()
+        response_cache.invalidate_tags([pool_tag(pool_id)])
 
         return (jsonify("Pool successfully deleted"), 200)
 
@@ -354,31 +1270,162 @@ def delete_pool(pool_id):
 @app.post("/api/pools/<int:pool_id>/images")
 @jwt_required()
 def add_pool_image(pool_id):
-    """Add pool image, and return data about pool image.
+    """Add one or more pool images, and return data about them.
+
+    Takes up to MAX_GALLERY_FILES files, all in the "file" form field. They
+    are resized and uploaded concurrently (see image_jobs.store_images) and
+    saved together, so either all are added or none.
 
     Returns JSON like:
-        {pool_image: {id, pool_owner, image_url }}
+        {pool_images: [{id, pool_owner, pool_id, image_url, image_status,
+                        image_width, image_height, image_placeholder,
+                        image_color}, ...]}
+    plus pool_image (the same as pool_images[0]) when one file was sent.
     """
-    # TODO: if we get an array of files, then we could do a list comprehension where
-    # we use the helper function and add that to the table for each one in the comprehension
 
     current_user = get_jwt_identity()
     pool = Pool.query.get_or_404(pool_id)
-    if current_user == pool.owner_username:
-        file = request.files['file']
-        url = upload_to_aws(file) # TODO: refactor to account for [orig_size_img, small_size_img]
+    if current_user != pool.owner_username:
+        return (jsonify({"error": "not authorized"}), 401)
 
-        pool_image = PoolImage(
-            pool_owner=current_user,
-            image_url=url
-        )
+    files = get_uploaded_images()
+    if not files:
+        return (jsonify({"error": "file is required"}), 400)
+    if len(files) > MAX_GALLERY_FILES:
+        return (jsonify({"error": f"at most {MAX_GALLERY_FILES} files at once"}), 400)
+
+    try:
+        stored = store_images([file.stream for file in files], executor=image_executor)
+        pool_images = db.session.scalars(
+            insert(PoolImage).returning(PoolImage),
+            [{"pool_owner": current_user,
+              "pool_id": pool_id,
+              "image_url": orig_url,
+              "image_status": IMAGE_READY,
+              **PoolImage.image_info_columns(info)}
+             for orig_url, _, _, info in stored]).all()
+        db.session.commit()
+    except Exception as error:
+        print("Error", error)
+        db.session.rollback()
+        return (jsonify({"error": "Failed to add pool images"}), 424)
+
+    response_cache.invalidate_tags([pool_tag(pool_id)])
+
+    serialized = [pool_image.serialize() for pool_image in pool_images]
+    if len(serialized) == 1:
+        return (jsonify(pool_image=serialized[0], pool_images=serialized), 201)
+    return (jsonify(pool_images=serialized), 201)
+
+
+@app.post("/api/pools/<int:pool_id>/uploads")
+@jwt_required()
+def create_pool_upload(pool_id):
+    """Start a direct-to-S3 upload of a pool image.
+
+    Takes optional JSON like {content_type} (default image/jpeg). The client
+    POSTs the file to url as multipart/form-data with fields, then calls
+    /api/pools/<pool_id>/uploads/complete with the key.
+
+    Returns JSON like:
+        {upload: {key, url, fields, expires_in, max_size}}
+    """
+
+    current_user = get_jwt_identity()
+    pool = Pool.query.get_or_404(pool_id)
+    if current_user != pool.owner_username:
+        return (jsonify({"error": "not authorized"}), 401)
+
+    data = request.get_json(silent=True) or {}
+    content_type = data.get("content_type", "image/jpeg")
+    if content_type not in UPLOAD_CONTENT_TYPES:
+        return (jsonify({"error": f"content_type must be one of: {', '.join(UPLOAD_CONTENT_TYPES)}"}), 400)
+
+    key = f"{UPLOAD_PREFIX}{pool_id}/{uuid.uuid4()}"
+    try:
+        post = presigned_upload(key, content_type)
+    except NotImplementedError as error:
+        return (jsonify({"error": str(error)}), 501)
+
+    return (jsonify(upload={
+        "key": key,
+        "url": post["url"],
+        "fields": post["fields"],
+        "expires_in": PRESIGNED_UPLOAD_EXPIRES,
+        "max_size": MAX_UPLOAD_SIZE,
+    }), 201)
+
+
+def is_pool_upload_key(key, pool_id):
+    """ True if key has the form create_pool_upload gives this pool's uploads.
+
+    Checking the prefix alone isn't enough: on local storage a key like
+    "uploads/1/../<other key>" would point at someone else's upload.
+    """
+
+    prefix = f"{UPLOAD_PREFIX}{pool_id}/"
+    if not isinstance(key, str) or not key.startswith(prefix):
+        return False
+
+    name = key[len(prefix):]
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+@app.post("/api/pools/<int:pool_id>/uploads/complete")
+@jwt_required()
+def complete_pool_upload(pool_id):
+    """Register a finished direct upload on the pool and queue its resizing.
+
+    Takes JSON like {key, gallery}. The image becomes the pool's main image,
+    or with gallery true is added to its images.
+
+    Returns JSON like:
+        {pool: {..., image_status: "pending"}}
+        or {pool_image: {id, pool_owner, pool_id, image_url, image_status}}
+    """
+
+    current_user = get_jwt_identity()
+    pool = Pool.query.get_or_404(pool_id)
+    if current_user != pool.owner_username:
+        return (jsonify({"error": "not authorized"}), 401)
+
+    data = request.get_json(silent=True) or {}
+    key = data.get("key")
+    if not is_pool_upload_key(key, pool_id):
+        return (jsonify({"error": "key is not an upload for this pool"}), 400)
+
+    if staged_upload_size(key) is None:
+        return (jsonify({"error": "upload not found"}), 400)
+
+    try:
+        if data.get("gallery"):
+            pool_image = PoolImage(
+                pool_owner=current_user,
+                pool_id=pool_id,
+                image_url=DEFAULT_POOL_IMAGE_URL,
+                image_status=IMAGE_PENDING
+            )
+            db.session.add(pool_image)
+            db.session.flush()
+            enqueue_image_job(source_key=key, pool_image_id=pool_image.id)
+            result = {"pool_image": pool_image.serialize()}
+        else:
+            pool.image_status = IMAGE_PENDING
+            enqueue_image_job(source_key=key, pool_id=pool_id)
+            result = {"pool": pool.serialize()}
 
-        db.session.add(pool_image)
         db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return (jsonify({"error": "upload already registered"}), 409)
 
-        return (jsonify(pool_image=pool_image.serialize()), 201)
+    response_cache.invalidate_tags([pool_tag(pool_id)])
+    image_worker.wake()
 
-    return (jsonify({"error": "not authorized"}), 401)
+    return (jsonify(**result), 201)
 
 ################################################################################
 #######################  MESSAGES ENDPOINTS START  #############################
@@ -387,25 +1434,81 @@ def add_pool_image(pool_id):
 @app.get("/api/messages")
 @jwt_required()
 def list_messages():
-    """ Gets all messages outgoing and incoming to view """
+    """ Gets all messages outgoing and incoming to view
+
+    Accepts ?fields= to return only some keys of each message.
+    """
 
     current_user = get_jwt_identity()
+    fields = get_requested_fields(Message)
+    query = only_fields(Message.query, Message, fields)
+
     # inbox
-    messages_inbox = (Message.query
+    messages_inbox = (query
                       .filter(Message.recipient_username == current_user)
                       .order_by(Message.timestamp.desc()))
-    serialized_inbox = [message.serialize() for message in messages_inbox]
+    serialized_inbox = [message.serialize(fields) for message in messages_inbox]
 
     # outbox
-    messages_outbox = (Message.query
+    messages_outbox = (query
                        .filter(Message.sender_username == current_user)
                        .order_by(Message.timestamp.desc()))
-    serialized_outbox = [message.serialize() for message in messages_outbox]
+    serialized_outbox = [message.serialize(fields) for message in messages_outbox]
 
     response = {"messages" : {"inbox": serialized_inbox, "outbox": serialized_outbox}}
     return response
 
 
+@app.get("/api/messages/conversations")
+@jwt_required()
+def list_conversations():
+    """ Gets the current user's message threads, newest activity first.
+
+    A thread is every message to or from one other user about one listing.
+    Accepts ?fields= to return only some keys of each latest_message.
+
+    Returns JSON like:
+        {conversations: [{counterpart, listing, message_count,
+                          latest_message: {id, sender_username, ...}}, ...]}
+    """
+
+    current_user = get_jwt_identity()
+    fields = get_requested_fields(Message)
+
+    counterpart = case(
+        (Message.sender_username == current_user, Message.recipient_username),
+        else_=Message.sender_username)
+    thread = (counterpart, Message.listing)
+
+    # One pass over the user's messages (both composite indexes, OR-ed),
+    # numbering each thread's messages newest first and counting them.
+    ranked = (select(Message,
+                     counterpart.label("counterpart"),
+                     func.row_number().over(
+                         partition_by=thread,
+                         order_by=(Message.timestamp.desc(), Message.id.desc()),
+                     ).label("position"),
+                     func.count().over(partition_by=thread).label("message_count"))
+              .where(or_(Message.recipient_username == current_user,
+                         Message.sender_username == current_user))
+              .subquery())
+    latest = aliased(Message, ranked)
+
+    rows = db.session.execute(
+        select(latest, ranked.c.counterpart, ranked.c.message_count)
+        .where(ranked.c.position == 1)
+        .order_by(ranked.c.timestamp.desc(), ranked.c.id.desc()))
+
+    conversations = [{
+        "counterpart": counterpart,
+        "listing": message.listing,
+        "message_count": message_count,
+        "latest_message": message.serialize(fields),
+    } for message, counterpart, message_count in rows]
+
+    return jsonify(conversations=conversations)
+
+
 @app.post("/api/messages")
 @jwt_required()
 def create_message():
@@ -500,17 +1603,21 @@ def create_reservation(pool_id):
 @app.get("/api/reservations/<int:pool_id>")
 @jwt_required()
 def get_reservations_for_pool(pool_id):
-    """ Gets all reservations assocaited with pool_id """
+    """ Gets all reservations assocaited with pool_id
+
+    Accepts ?fields= to return only some keys of each reservation.
+    """
 
     current_user = get_jwt_identity()
+    fields = get_requested_fields(Reservation)
 
     pool = Pool.query.get_or_404(pool_id)
     if(pool.owner_username==current_user):
-        reservations = (Reservation.query
-        .filter(pool_id=pool_id)
+        reservations = (only_fields(Reservation.query, Reservation, fields)
+        .filter(Reservation.pool_id == pool_id)
         .order_by(Reservation.start_date.desc()))
 
-        serialized_reservations = ([reservation.serialize()
+        serialized_reservations = ([reservation.serialize(fields)
             for reservation in reservations])
 
         return (jsonify(reservations=serialized_reservations))
@@ -522,17 +1629,20 @@ def get_reservations_for_pool(pool_id):
 @app.get("/api/reservations/<username>")
 @jwt_required()
 def get_booked_reservations_for_username(username):
-    """ Gets all reservations created by a username """
+    """ Gets all reservations created by a username
 
-    current_user = get_jwt_identity()
+    Accepts ?fields= to return only some keys of each reservation.
+    """
 
-    user = User.query.get_or_404(username)
-    if(user.username == current_user):
-        reservations = (Reservation.query
+    fields = get_requested_fields(Reservation)
+
+    user = get_current_user()
+    if(user.username == username):
+        reservations = (only_fields(Reservation.query, Reservation, fields)
         .filter(Reservation.booked_username == username)
         .order_by(Reservation.start_date.desc()))
 
-        serialized_reservations = ([reservation.serialize()
+        serialized_reservations = ([reservation.serialize(fields)
             for reservation in reservations])
 
         return (jsonify(reservations=serialized_reservations))
@@ -589,7 +1699,76 @@ def delete_booked_reservation(reservation_id):
     return (jsonify({"error": "not authorized"}), 401)
 
 
+################################################################################
+#######################  EXPORT ENDPOINTS START  ###############################
+
+# Rows fetched per round trip from the server-side cursor, and lines sent per
+# chunk of the streamed response.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_LINES_PER_CHUNK = 100
+
+
+def ndjson_export(query, fields):
+    """ Streams query as newline delimited JSON, one serialize() per line.
+
+    Rows come from a server-side cursor EXPORT_BATCH_SIZE at a time and are
+    written out as they arrive, so memory stays flat however big the table
+    is and the client gets the first rows without waiting for the last.
+    """
+
+    rows = query.yield_per(EXPORT_BATCH_SIZE)
+
+    def generate():
+        lines = []
+        for row in rows:
+            lines.append(app.json.dumps(row.serialize(fields)))
+            if len(lines) == EXPORT_LINES_PER_CHUNK:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return app.response_class(
+        stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.get("/api/export/pools")
+def export_pools():
+    """ Streams every pool as NDJSON, ordered by id. Accepts ?fields=. """
+
+    fields = get_requested_fields(Pool)
+    query = only_fields(Pool.query, Pool, fields).order_by(Pool.id)
+
+    return ndjson_export(query, fields)
+
+
+@app.get("/api/export/users")
+def export_users():
+    """ Streams every user as NDJSON, ordered by username. Accepts ?fields=. """
+
+    fields = get_requested_fields(User)
+    query = only_fields(User.query, User, fields).order_by(User.username)
+
+    return ndjson_export(query, fields)
+
+
+@app.get("/api/export/reservations")
+@jwt_required()
+def export_reservations():
+    """ Streams reservations as NDJSON, ordered by id. Accepts ?fields=.
+
+    Only includes reservations the current user booked or that are for a
+    pool they own, same as the other reservation endpoints.
+    """
+
+    current_user = get_jwt_identity()
+    fields = get_requested_fields(Reservation)
 
+    owned_pool_ids = select(Pool.id).where(Pool.owner_username == current_user)
+    query = (only_fields(Reservation.query, Reservation, fields)
+             .filter(or_(Reservation.booked_username == current_user,
+                         Reservation.pool_id.in_(owned_pool_ids)))
+             .order_by(Reservation.id))
 
+    return ndjson_export(query, fields)
 
-########################  MESSAGES ENDPOINTS END  ##############################
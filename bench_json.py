@@ -0,0 +1,72 @@
+""" Benchmark: stdlib vs orjson JSON provider on large pool/message lists.
+
+Builds payloads shaped like Pool.serialize() and Message.serialize() output
+(Decimal rates, datetime timestamps) and times rendering them as a response
+with each provider. No database needed:
+
+    python bench_json.py [rows] [repeats]
+"""
+
+import sys
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from json_provider import OrjsonProvider
+
+
+def make_pools(n):
+    return [{
+        "id": i,
+        "owner_username": f"user{i % 500}",
+        "rate": Decimal(f"{10 + i % 90}.50"),
+        "size": "20x40",
+        "description": "Heated saltwater pool with a view of the hills. " * 3,
+        "city": "Los Angeles",
+        "orig_image_url": f"https://sharebnb-gmm.s3.us-west-1.amazonaws.com/{i}",
+        "small_image_url": f"https://sharebnb-gmm-small-images.s3.us-west-1.amazonaws.com/{i}-small",
+        "latitude": 34.05 + i / 1e5,
+        "longitude": -118.24 - i / 1e5,
+    } for i in range(n)]
+
+
+def make_messages(n):
+    start = datetime(2023, 2, 1, 12, 0)
+    return [{
+        "id": i,
+        "sender_username": f"user{i % 500}",
+        "recipient_username": f"user{(i + 1) % 500}",
+        "title": "is your pool available?",
+        "body": "Hi there, i'd like to see if your pool is available for this weekend?",
+        "listing": i % 1000,
+        "timestamp": start + timedelta(minutes=i),
+    } for i in range(n)]
+
+
+def bench(rows, repeats):
+    app = Flask(__name__)
+    payloads = {"pools": make_pools(rows), "messages": make_messages(rows)}
+
+    with app.app_context():
+        for name, payload in payloads.items():
+            results = {}
+            for provider_class in (DefaultJSONProvider, OrjsonProvider):
+                provider = provider_class(app)
+                seconds = min(timeit.repeat(
+                    lambda: provider.response({name: payload}),
+                    number=1, repeat=repeats))
+                results[provider_class.__name__] = seconds
+
+            stdlib = results["DefaultJSONProvider"]
+            fast = results["OrjsonProvider"]
+            print(f"{name:>8} x {rows}: stdlib {stdlib * 1000:8.2f} ms   "
+                  f"orjson {fast * 1000:8.2f} ms   speedup {stdlib / fast:5.1f}x")
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    bench(rows, repeats)
@@ -0,0 +1,56 @@
+""" Benchmark: login throughput per core for each bcrypt cost.
+
+Times password checks (the CPU cost of a login) through PasswordHasher,
+first one at a time and then from as many client threads as there are
+hash threads. bcrypt releases the GIL, so checks/sec should scale with
+PASSWORD_HASH_THREADS up to the number of cores. No database needed:
+
+    python bench_passwords.py [seconds] [rounds ...]
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PASSWORD_HASH_THREADS, PasswordHasher, bcrypt
+
+
+def checks_per_second(hasher, pw_hash, clients, seconds):
+    """ Returns password checks/sec from clients threads checking for seconds """
+
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        count = 0
+        while time.perf_counter() < deadline:
+            hasher.check(pw_hash, "password")
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        total = sum(pool.map(lambda _: client(), range(clients)))
+    return total / (time.perf_counter() - start)
+
+
+def bench(seconds, rounds_list):
+    cores = os.cpu_count() or 1
+    threads = PASSWORD_HASH_THREADS
+    print(f"{cores} cores, {threads} hash threads")
+
+    for rounds in rounds_list:
+        hasher = PasswordHasher(rounds=rounds, threads=threads, queue_depth=threads)
+        pw_hash = bcrypt.generate_password_hash("password", rounds).decode()
+
+        serial = checks_per_second(hasher, pw_hash, 1, seconds)
+        parallel = checks_per_second(hasher, pw_hash, threads, seconds)
+        print(f"rounds={rounds:2d}  {1000 / serial:7.1f} ms/login  "
+              f"1 client {serial:7.1f}/s  {threads} clients {parallel:7.1f}/s  "
+              f"per core {parallel / min(threads, cores):7.1f}/s")
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    rounds_list = [int(rounds) for rounds in sys.argv[2:]] or [10, 11, 12]
+    bench(seconds, rounds_list)
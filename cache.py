@@ -0,0 +1,235 @@
+""" Response cache for read-heavy endpoints.
+
+Entries are opaque bytes (rendered JSON bodies) stored under a key and any
+number of tags. Writes invalidate by tag, so an update to one pool drops just
+the cached responses that included that pool.
+
+Two backends share the same interface:
+
+- MemoryCacheBackend: TTL + LRU dict inside one process. Fastest, but each
+  gunicorn worker has its own copy.
+- SqliteCacheBackend: a SQLite file on local disk, shared by every worker on
+  the host, so an invalidation in one worker is seen by all of them.
+
+make_cache_backend picks one from a config string.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class NullCacheBackend:
+    """ Cache that never stores anything; used to switch caching off. """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None, tags=()):
+        pass
+
+    def invalidate_tags(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryCacheBackend:
+    """ In-process cache with a per-entry TTL and LRU eviction. """
+
+    def __init__(self, max_entries=1024, default_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()    # key -> (expires_at, value, tags)
+        self._tags = {}                  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value stored under key, or None if missing/expired """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value, _ = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        """ Stores value under key for ttl seconds, tagged with tags """
+
+        ttl = self.default_ttl if ttl is None else ttl
+        tags = frozenset(tags)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def invalidate_tags(self, tags):
+        """ Drops every entry carrying any of tags """
+
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        """ Removes key and its tag links. Caller holds the lock. """
+
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SqliteCacheBackend:
+    """ Cache in a local SQLite file, shared across worker processes.
+
+    Reads never write: expired entries are simply ignored until they are
+    overwritten or evicted. When the cache is full the entries closest to
+    expiry are evicted first, which avoids a write on every read to track
+    recency.
+    """
+
+    def __init__(self, path, max_entries=10000, default_ttl=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._local = threading.local()
+
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL,"
+                " expires_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_tags ("
+                " tag TEXT NOT NULL, key TEXT NOT NULL,"
+                " PRIMARY KEY (tag, key))")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cache_entries_expires_at"
+                " ON cache_entries (expires_at)")
+
+    def _connection(self):
+        return sqlite_connection(self._local, self.path)
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?",
+            (key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = self.default_ttl if ttl is None else ttl
+
+        with SqliteTransaction(self._connection()) as conn:
+            self._delete_keys(conn, [key])
+            conn.execute(
+                "INSERT INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl))
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                [(tag, key) for tag in set(tags)])
+
+            (count,) = conn.execute("SELECT count(*) FROM cache_entries").fetchone()
+            if count > self.max_entries:
+                keys = [k for (k,) in conn.execute(
+                    "SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?",
+                    (count - self.max_entries,))]
+                self._delete_keys(conn, keys)
+
+    def invalidate_tags(self, tags):
+        tags = list(set(tags))
+        if not tags:
+            return
+
+        with SqliteTransaction(self._connection()) as conn:
+            placeholders = ", ".join("?" * len(tags))
+            keys = [k for (k,) in conn.execute(
+                f"SELECT DISTINCT key FROM cache_tags WHERE tag IN ({placeholders})",
+                tags)]
+            self._delete_keys(conn, keys)
+
+    def clear(self):
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute("DELETE FROM cache_entries")
+            conn.execute("DELETE FROM cache_tags")
+
+    @staticmethod
+    def _delete_keys(conn, keys):
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM cache_tags WHERE key = ?", [(k,) for k in keys])
+
+
+def sqlite_connection(local, path):
+    """ Returns this thread's connection to path, opening it on first use.
+
+    local is a threading.local owned by the caller. Connections are never
+    reused across a fork (e.g. gunicorn --preload).
+    """
+
+    conn, pid = getattr(local, 'conn', (None, None))
+    if conn is None or pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = (conn, os.getpid())
+    return conn
+
+
+class SqliteTransaction:
+    """ Runs a block as one SQLite write transaction (BEGIN IMMEDIATE) """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def make_cache_backend(spec, max_entries=1024, default_ttl=60):
+    """ Builds a cache backend from a config string.
+
+    "memory" (per process), "sqlite:///path/to/cache.db" (shared by all
+    workers on the host) or "none" (caching off).
+    """
+
+    if spec == "none":
+        return NullCacheBackend()
+    if spec == "memory":
+        return MemoryCacheBackend(max_entries=max_entries, default_ttl=default_ttl)
+    if spec.startswith("sqlite:///"):
+        return SqliteCacheBackend(
+            spec[len("sqlite:///"):], max_entries=max_entries, default_ttl=default_ttl)
+
+    raise ValueError(f"Unknown cache backend: {spec}")
@@ -0,0 +1,148 @@
+""" Geohash helpers for "pools near me" search on plain Postgres.
+
+Pools store a geohash of their location. A radius search is turned into a
+handful of geohash prefixes that cover the search circle's bounding box, so
+the database can prune with an index range scan (LIKE 'prefix%') and only
+compute exact distances for pools in those cells.
+"""
+
+import math
+
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_KM = 6371.0
+
+# Stored precision; 9 characters is a cell of roughly 5m x 5m.
+GEOHASH_PRECISION = 9
+
+# Most prefixes we'll OR together for one search before giving up on
+# pruning by geohash and relying on the latitude bounds alone.
+MAX_COVER_CELLS = 16
+
+
+def parse_coordinates(latitude, longitude):
+    """ Returns (latitude, longitude) as floats from request values.
+
+    Accepts numbers or numeric strings. Raises ValueError unless both are
+    finite and within -90..90 and -180..180.
+    """
+
+    if isinstance(latitude, bool) or isinstance(longitude, bool):
+        raise ValueError("coordinates must be numbers")
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("coordinates must be numbers")
+
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        raise ValueError("coordinates must be finite")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("coordinates out of range")
+
+    return latitude, longitude
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """ Returns the geohash of a point as a string of `precision` chars """
+
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lng_range[0] = mid
+            else:
+                bits = bits << 1
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def geohash_cell_size(precision):
+    """ Returns (height, width) in degrees of a geohash cell at precision """
+
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """ Returns (min_lat, max_lat, min_lng, max_lng) around a search circle.
+
+    Longitudes may fall outside [-180, 180] when the circle crosses the
+    antimeridian; callers wrap them with normalize_longitude.
+    """
+
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = max(-90.0, latitude - lat_delta)
+    max_lat = min(90.0, latitude + lat_delta)
+
+    cos_lat = math.cos(math.radians(latitude))
+    if max_lat >= 90.0 or min_lat <= -90.0 or cos_lat < 1e-9:
+        # The circle covers a pole, so every longitude is in range.
+        return min_lat, max_lat, -180.0, 180.0
+
+    lng_delta = min(180.0, math.degrees(radius_km / EARTH_RADIUS_KM / cos_lat))
+    return min_lat, max_lat, longitude - lng_delta, longitude + lng_delta
+
+
+def normalize_longitude(longitude):
+    """ Wraps a longitude into [-180, 180) """
+
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def covering_prefixes(latitude, longitude, radius_km):
+    """ Returns the set of geohash prefixes covering a search circle.
+
+    Picks the longest prefix length whose cells cover the circle's bounding
+    box in at most MAX_COVER_CELLS cells. Returns None if even one-character
+    prefixes would need more cells than that (a continent-sized radius).
+    """
+
+    min_lat, max_lat, min_lng, max_lng = bounding_box(
+        latitude, longitude, radius_km)
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        rows = math.ceil((max_lat - min_lat) / height) + 1
+        cols = math.ceil((max_lng - min_lng) / width) + 1
+        if rows * cols <= MAX_COVER_CELLS:
+            break
+    else:
+        return None
+
+    # Stepping by exactly one cell from the box's corner visits every cell
+    # the box touches; the far edges are added explicitly.
+    lats = [min_lat + row * height for row in range(rows)] + [max_lat]
+    lngs = [min_lng + col * width for col in range(cols)] + [max_lng]
+
+    return {
+        encode_geohash(min(lat, 90.0), normalize_longitude(lng), precision)
+        for lat in lats
+        for lng in lngs
+    }
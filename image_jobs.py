@@ -0,0 +1,271 @@
+""" Image processing off the request path, queued in Postgres.
+
+create_pool and create_user stream the upload to the staging prefix in
+storage and return right away with an ImageJob pointing at the staged
+object, like the ones for images uploaded straight to S3. A worker thread
+in each app process (or a dedicated `flask image-worker` process) claims
+jobs, runs the resize + upload in api_helpers, and fills in the pool's or
+user's image urls.
+
+Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so workers in any
+number of processes never pick up the same job. A job left "processing" by
+a crashed worker is picked up again after STALE_JOB_AFTER.
+"""
+
+import hashlib
+import io
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+from api_helpers import upload_to_aws, read_original, stage_upload, delete_staged_upload
+from image_renditions import InvalidImageError
+from models import db, ImageJob, Pool, PoolImage, StoredImage, User, IMAGE_READY, IMAGE_FAILED
+
+
+# seconds an idle worker sleeps before checking the table again
+POLL_INTERVAL = 5
+
+# failures before a job (and its pool's image) is marked failed
+MAX_ATTEMPTS = 3
+
+STALE_JOB_AFTER = timedelta(minutes=10)
+
+# Images resized and uploaded at once by store_images for one request. Each
+# holds one upload and its decoded image in memory.
+IMAGE_THREADS = int(os.environ.get('IMAGE_THREADS', 4))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_THREADS, thread_name_prefix="image")
+
+
+def enqueue_image_job(file=None, source_key=None, pool_id=None, pool_image_id=None,
+                      username=None):
+    """ Adds a job for an uploaded file, or an upload staged in S3 under
+    source_key, to the session; caller commits.
+
+    A file is staged in storage first, so the job row doesn't hold its bytes.
+    """
+
+    if file is not None:
+        source_key = stage_upload(file)
+
+    job = ImageJob(pool_id=pool_id, pool_image_id=pool_image_id, username=username,
+                   source_key=source_key)
+    db.session.add(job)
+    return job
+
+
+def content_hash(file):
+    """ Returns the sha256 of a file object, read in chunks, and rewinds it """
+
+    digest = hashlib.sha256()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def store_images(files, executor=None):
+    """ Returns [orig_url, small_url, renditions, info] for each image file.
+
+    Images are stored under the sha256 of their bytes. Ones seen before are
+    looked up in stored_images and not resized or uploaded again. New ones
+    are resized and uploaded on executor, at most its number of workers at
+    a time, or one by one in this thread if it is None. Raises the first
+    failure. Caller commits.
+    """
+
+    hashes = [content_hash(file) for file in files]
+
+    stored = {image.content_hash: image.urls for image in
+              StoredImage.query.filter(StoredImage.content_hash.in_(hashes))}
+
+    uploads = {}
+    for image_hash, file in zip(hashes, files):
+        if image_hash in stored or image_hash in uploads:
+            continue
+        if executor is None:
+            uploads[image_hash] = upload_to_aws(file, filename=image_hash)
+        else:
+            uploads[image_hash] = executor.submit(upload_to_aws, file, filename=image_hash)
+
+    if executor is not None:
+        uploads = {image_hash: upload.result() for image_hash, upload in uploads.items()}
+
+    StoredImage.record(uploads)
+    stored.update(uploads)
+    return [stored[image_hash] for image_hash in hashes]
+
+
+def store_image(data):
+    """ store_images for one image's bytes """
+
+    [urls] = store_images([io.BytesIO(data)])
+    return urls
+
+
+def claim_next_job():
+    """ Marks the oldest runnable job as processing and returns its id.
+
+    Returns None if there is nothing to do. Commits, so the claim is visible
+    to other workers before the slow part starts.
+    """
+
+    stale_before = datetime.utcnow() - STALE_JOB_AFTER
+    job = (ImageJob.query
+           .filter(or_(ImageJob.status == "pending",
+                       (ImageJob.status == "processing")
+                       & (ImageJob.updated_at < stale_before)))
+           .order_by(ImageJob.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = "processing"
+    job.attempts += 1
+    db.session.commit()
+    return job.id
+
+
+def process_image_job(job_id):
+    """ Resizes and uploads one claimed job, then updates its owner.
+
+    Returns (pool id, username) whose image changed, either None, so the
+    caller can drop cached copies of them.
+    """
+
+    job = db.session.get(ImageJob, job_id)
+
+    try:
+        data = read_original(job.source_key)
+        orig_url, small_url, renditions, info = store_image(data)
+    except Exception as error:
+        print("image job failed: ", job_id, error)
+        traceback.print_exc()
+        db.session.rollback()
+        return fail_or_retry(job_id, error)
+
+    # The pool or user may have been deleted while the job ran.
+    pool = db.session.get(Pool, job.pool_id) if job.pool_id is not None else None
+    if pool is not None:
+        pool.orig_image_url = orig_url
+        pool.small_image_url = small_url
+        pool.image_renditions = renditions
+        pool.set_image_info(info)
+        pool.image_status = IMAGE_READY
+
+    pool_image = (db.session.get(PoolImage, job.pool_image_id)
+                  if job.pool_image_id is not None else None)
+    if pool_image is not None:
+        pool_image.image_url = orig_url
+        pool_image.set_image_info(info)
+        pool_image.image_status = IMAGE_READY
+
+    user = db.session.get(User, job.username) if job.username is not None else None
+    if user is not None:
+        user.image_url = orig_url
+
+    job.status = "done"
+    db.session.commit()
+
+    try:
+        delete_staged_upload(job.source_key)
+    except Exception as error:
+        # harmless: a bucket lifecycle rule on the prefix cleans up
+        print("failed to delete staged upload: ", job.source_key, error)
+
+    return job.pool_id, (user.username if user is not None else None)
+
+
+def fail_or_retry(job_id, error):
+    """ Puts a failed job back in the queue, or gives up after MAX_ATTEMPTS.
+
+    Returns (pool id, None) like process_image_job, the pool id only once
+    its image has failed.
+    """
+
+    job = db.session.get(ImageJob, job_id)
+    job.error = str(error)
+
+    # an image that is unreadable or too large won't get better on retry
+    if job.attempts < MAX_ATTEMPTS and not isinstance(error, InvalidImageError):
+        job.status = "pending"
+        db.session.commit()
+        return None, None
+
+    job.status = "failed"
+    pool = db.session.get(Pool, job.pool_id) if job.pool_id is not None else None
+    if pool is not None:
+        pool.image_status = IMAGE_FAILED
+
+    pool_image = (db.session.get(PoolImage, job.pool_image_id)
+                  if job.pool_image_id is not None else None)
+    if pool_image is not None:
+        pool_image.image_status = IMAGE_FAILED
+    db.session.commit()
+    return job.pool_id, None
+
+
+def run_pending_jobs(on_pool_updated=None, on_user_updated=None):
+    """ Processes jobs until the queue is empty; returns how many ran """
+
+    count = 0
+    while (job_id := claim_next_job()) is not None:
+        pool_id, username = process_image_job(job_id)
+        if pool_id is not None and on_pool_updated is not None:
+            on_pool_updated(pool_id)
+        if username is not None and on_user_updated is not None:
+            on_user_updated(username)
+        count += 1
+
+    return count
+
+
+class ImageWorker:
+    """ Background thread running image jobs for one app process.
+
+    start() is cheap and idempotent, so the app calls it on every request.
+    wake() makes the thread check for work right away instead of at the next
+    poll, for jobs enqueued by this process.
+    """
+
+    def __init__(self, app, on_pool_updated=None, on_user_updated=None):
+        self.app = app
+        self.on_pool_updated = on_pool_updated
+        self.on_user_updated = on_user_updated
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run_forever, name="image-worker", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run_forever(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    run_pending_jobs(self.on_pool_updated, self.on_user_updated)
+            except Exception:
+                traceback.print_exc()
+
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
@@ -0,0 +1,234 @@
+""" Responsive image renditions from a single decode of an upload.
+
+An upload is decoded once, at the smallest size that still covers the
+largest rendition (for JPEGs, PIL's draft() decodes straight to a 1/2, 1/4
+or 1/8 scale). It is turned upright according to its EXIF orientation, and
+every rendition is resized from that one image. Renditions are saved
+without EXIF or other metadata.
+
+The same pass describes the image for clients (describe_image): its upright
+size, a tiny blurred WebP to show while it loads, and its dominant color.
+
+Widths and formats come from IMAGE_RENDITION_WIDTHS and
+IMAGE_RENDITION_FORMATS, e.g. "320,640,1024,1600" and "jpeg,webp".
+
+Memory per image is bounded by checking dimensions from the header before
+anything is decoded (check_image_header). A JPEG is decoded at no more than
+about twice the largest rendition in each direction (or 1/8 scale for
+huge ones), so it may have up to MAX_IMAGE_PIXELS. Other formats are
+decoded at full size and get the lower MAX_FULL_DECODE_PIXELS.
+"""
+
+import base64
+import io
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+RENDITION_WIDTHS = tuple(
+    int(width) for width in
+    os.environ.get('IMAGE_RENDITION_WIDTHS', '320,640,1024,1600').split(','))
+
+RENDITION_FORMATS = tuple(
+    image_format.strip().upper() for image_format in
+    os.environ.get('IMAGE_RENDITION_FORMATS', 'jpeg,webp').split(','))
+
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))
+MAX_FULL_DECODE_PIXELS = int(os.environ.get('MAX_FULL_DECODE_PIXELS', 16_000_000))
+
+# PIL's own decompression bomb guard, as a backstop
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Pool.small_image_url is this many pixels high, in JPEG
+THUMBNAIL_HEIGHT = 280
+
+SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+# Width of the placeholder in describe_image. Upscaled by the browser, so
+# it shows as a blur; a few hundred bytes as a data: URI.
+PLACEHOLDER_WIDTH = 16
+PLACEHOLDER_QUALITY = 40
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+
+# EXIF orientations that rotate the image by 90 degrees either way
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION = 0x0112
+
+
+class InvalidImageError(ValueError):
+    """ Upload is not an image we can read, or is too large to decode """
+
+
+def check_image_header(file):
+    """ Reads just the image header of a file object and checks its size.
+
+    Returns (format, width, height); raises InvalidImageError. The file is
+    left at the position it started from.
+    """
+
+    position = file.tell()
+    try:
+        with Image.open(file) as img:
+            image_format, (width, height) = img.format, img.size
+    except (UnidentifiedImageError, Image.DecompressionBombError) as error:
+        raise InvalidImageError(f"not a readable image: {error}") from error
+    finally:
+        file.seek(position)
+
+    limit = MAX_IMAGE_PIXELS if image_format == "JPEG" else MAX_FULL_DECODE_PIXELS
+    if width * height > limit:
+        raise InvalidImageError(
+            f"image is too large: {width}x{height} {image_format}, "
+            f"at most {limit} pixels")
+
+    return image_format, width, height
+
+
+class Rendition:
+    """ One encoded size/format of an upload """
+
+    def __init__(self, width, height, image_format, data):
+        self.width = width
+        self.height = height
+        self.format = image_format
+        self.data = data
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    def __repr__(self):
+        return f"<Rendition {self.width}x{self.height} {self.format}>"
+
+
+def decode_image(data, min_width, min_height):
+    """ Decodes image bytes into an upright RGB image.
+
+    JPEGs are decoded at the smallest scale that is still at least
+    min_width x min_height once upright.
+    """
+
+    img = Image.open(io.BytesIO(data))
+    orientation = img.getexif().get(EXIF_ORIENTATION)
+
+    if img.format == "JPEG":
+        # draft() works on the stored (not yet rotated) dimensions.
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            min_width, min_height = min_height, min_width
+        img.draft("RGB", (min_width, min_height))
+
+    # exif_transpose copies the whole image even when there's nothing to do
+    if orientation not in (None, 1):
+        img = ImageOps.exif_transpose(img)
+
+    return flatten(img)
+
+
+def flatten(img):
+    """ Returns img as RGB, with any transparency composited onto white """
+
+    if img.mode == "RGB":
+        return img
+
+    img = img.convert("RGBA")
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask=img.getchannel("A"))
+    return background
+
+
+def encode(img, image_format):
+    out = io.BytesIO()
+    img.save(out, format=image_format, **SAVE_OPTIONS[image_format])
+    return out.getvalue()
+
+
+def scaled(img, width=None, height=None):
+    """ Returns img resized to width or height, keeping its aspect ratio """
+
+    if width is not None:
+        height = max(1, round(img.height * width / img.width))
+    else:
+        width = max(1, round(img.width * height / img.height))
+
+    return img.resize((width, height), resample=Image.Resampling.LANCZOS,
+                      reducing_gap=3.0)
+
+
+def dominant_color(img):
+    """ Returns the most common color of img as "#rrggbb" """
+
+    small = img.resize((32, 32), resample=Image.Resampling.BOX)
+    quantized = small.quantize(colors=8)
+    _, index = max(quantized.getcolors())
+    red, green, blue = quantized.getpalette()[index * 3:index * 3 + 3]
+    return f"#{red:02x}{green:02x}{blue:02x}"
+
+
+def describe_image(img, width, height):
+    """ Returns what clients need before an image loads, like:
+
+        {width, height, placeholder, color}
+
+    width and height are the upright size of the original; img is any
+    upright (downscaled) RGB copy of it. placeholder is a data: URI of a
+    PLACEHOLDER_WIDTH wide WebP and color is the dominant color, "#rrggbb".
+    """
+
+    tiny = scaled(img, width=PLACEHOLDER_WIDTH)
+    out = io.BytesIO()
+    tiny.save(out, format="WEBP", quality=PLACEHOLDER_QUALITY)
+    placeholder = base64.b64encode(out.getvalue()).decode("ascii")
+
+    return {
+        "width": width,
+        "height": height,
+        "placeholder": f"data:image/webp;base64,{placeholder}",
+        "color": dominant_color(img),
+    }
+
+
+def render_renditions(data, widths=RENDITION_WIDTHS, formats=RENDITION_FORMATS,
+                      thumbnail_height=THUMBNAIL_HEIGHT):
+    """ Decodes data once and returns (thumbnail, renditions, info).
+
+    thumbnail is a JPEG Rendition thumbnail_height pixels high. renditions
+    has one Rendition per width and format, smallest first. Widths wider
+    than the image become the image's own width; nothing is upscaled. info
+    is describe_image's dict.
+    """
+
+    check_image_header(io.BytesIO(data))
+
+    with Image.open(io.BytesIO(data)) as probe:
+        orientation = probe.getexif().get(EXIF_ORIENTATION)
+        source_width, source_height = probe.size
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            source_width, source_height = source_height, source_width
+
+    widths = sorted({min(width, source_width) for width in widths})
+    img = decode_image(data, widths[-1], thumbnail_height)
+
+    thumbnail_img = scaled(img, height=thumbnail_height)
+    thumbnail = Rendition(thumbnail_img.width, thumbnail_img.height, "JPEG",
+                          encode(thumbnail_img, "JPEG"))
+    info = describe_image(thumbnail_img, source_width, source_height)
+
+    renditions = []
+    for width in widths:
+        resized = img if width == img.width else scaled(img, width=width)
+        for image_format in formats:
+            renditions.append(Rendition(resized.width, resized.height, image_format,
+                                        encode(resized, image_format)))
+
+    img.close()
+    return thumbnail, renditions, info
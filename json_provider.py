@@ -0,0 +1,96 @@
+""" Faster JSON responses using orjson, when it is installed.
+
+OrjsonProvider is a drop-in for Flask's DefaultJSONProvider that keeps the
+same wire format, so clients can't tell which one served a response:
+
+- Decimal (Pool.rate) is a string, e.g. "10.00"
+- datetime/date (Message.timestamp, reservation dates) are RFC 822 / HTTP
+  dates, e.g. "Wed, 01 Feb 2023 12:01:00 GMT"
+- keys are sorted
+
+orjson's own datetime format is switched off (OPT_PASSTHROUGH_DATETIME) and
+those values go through default(), which formats them without the
+email.utils round trip Werkzeug's http_date takes.
+"""
+
+from datetime import date, datetime, timezone
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - exercised only without orjson
+    orjson = None
+
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def http_date(value):
+    """ Formats a date/datetime like werkzeug.http.http_date.
+
+    Naive datetimes are taken to be UTC; aware ones are converted to UTC.
+    """
+
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+    else:
+        value = datetime(value.year, value.month, value.day)
+
+    return (f"{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} "
+            f"{value.year:04d} {value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+
+
+def _default(o):
+    if isinstance(o, date):
+        return http_date(o)
+
+    return DefaultJSONProvider.default(o)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """ JSON provider backed by orjson with Flask's wire format """
+
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs):
+        # Callers asking for json.dumps options (indent, cls, ...) get the
+        # stdlib encoder so those options keep working.
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+
+        return self._dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        body = self._dumps_bytes(obj, indent=indent) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def _dumps_bytes(self, obj, indent=False):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(obj, default=self.default, option=option)
+
+
+def make_json_provider(app, use_orjson=True):
+    """ Returns the JSON provider for app: orjson if wanted and installed """
+
+    if use_orjson and orjson is not None:
+        return OrjsonProvider(app)
+
+    return DefaultJSONProvider(app)
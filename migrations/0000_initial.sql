@@ -0,0 +1,69 @@
+-- The schema before migrations were kept. A new database doesn't need any
+-- of these files: the app's db.create_all() makes every table as it is in
+-- models.py. They bring an existing database up to date; every statement
+-- is safe to run again, so `flask upgrade-db` simply runs them all.
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT NOT NULL,
+    image_url TEXT,
+    email TEXT NOT NULL,
+    location TEXT,
+    password TEXT NOT NULL,
+    PRIMARY KEY (username),
+    UNIQUE (username),
+    UNIQUE (email)
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id SERIAL NOT NULL,
+    sender_username TEXT NOT NULL,
+    recipient_username TEXT NOT NULL,
+    title TEXT,
+    body TEXT NOT NULL,
+    listing INTEGER NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (sender_username) REFERENCES users (username),
+    FOREIGN KEY (recipient_username) REFERENCES users (username)
+);
+
+CREATE TABLE IF NOT EXISTS pool_images (
+    id SERIAL NOT NULL,
+    pool_owner TEXT,
+    image_url TEXT NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (pool_owner) REFERENCES users (username) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS pools (
+    id SERIAL NOT NULL,
+    owner_username TEXT NOT NULL,
+    rate NUMERIC(10, 2) NOT NULL,
+    size TEXT NOT NULL,
+    description TEXT NOT NULL,
+    city TEXT NOT NULL,
+    orig_image_url TEXT NOT NULL,
+    small_image_url TEXT NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (owner_username) REFERENCES users (username)
+);
+
+CREATE TABLE IF NOT EXISTS user_images (
+    id SERIAL NOT NULL,
+    username TEXT,
+    image_path TEXT NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (username) REFERENCES users (username) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS reservations (
+    id SERIAL NOT NULL,
+    booked_username TEXT,
+    pool_id INTEGER,
+    reservation_date_created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    start_date TIMESTAMP WITHOUT TIME ZONE,
+    end_date TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (id),
+    FOREIGN KEY (booked_username) REFERENCES users (username) ON DELETE CASCADE,
+    FOREIGN KEY (pool_id) REFERENCES pools (id) ON DELETE CASCADE
+);
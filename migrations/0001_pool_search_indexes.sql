@@ -0,0 +1,6 @@
+-- Indexes behind GET /api/pools/search: each filter and sort is a range
+-- scan on (filter columns, rate, id).
+
+CREATE INDEX IF NOT EXISTS ix_pools_city_rate_id ON pools (city, rate, id);
+CREATE INDEX IF NOT EXISTS ix_pools_owner_rate_id ON pools (owner_username, rate, id);
+CREATE INDEX IF NOT EXISTS ix_pools_rate_id ON pools (rate, id);
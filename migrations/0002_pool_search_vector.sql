@@ -0,0 +1,10 @@
+-- Keyword search over pool descriptions and cities. Adding the generated
+-- column rewrites the pools table once.
+
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(city, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_pools_search_vector ON pools USING gin (search_vector);
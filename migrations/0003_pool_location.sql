@@ -0,0 +1,8 @@
+-- Pool coordinates for radius search. Existing pools have no location
+-- until one is set.
+
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS latitude FLOAT;
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS longitude FLOAT;
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS geohash TEXT;
+
+CREATE INDEX IF NOT EXISTS ix_pools_geohash ON pools (geohash text_pattern_ops);
@@ -0,0 +1,11 @@
+-- Reservation periods as ranges, so availability search can find
+-- overlapping bookings through a GiST index.
+
+ALTER TABLE reservations ADD COLUMN IF NOT EXISTS period TSRANGE
+    GENERATED ALWAYS AS (
+        CASE WHEN start_date IS NULL OR end_date IS NULL THEN NULL
+        ELSE tsrange(start_date, end_date, '[)') END
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_reservations_pool_id ON reservations (pool_id);
+CREATE INDEX IF NOT EXISTS ix_reservations_period ON reservations USING gist (period);
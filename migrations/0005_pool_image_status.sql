@@ -0,0 +1,4 @@
+-- Pool images are processed by the image job queue. image_jobs itself is a
+-- new table, made by db.create_all().
+
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_status TEXT;
@@ -0,0 +1,3 @@
+-- Resized copies of each pool's image.
+
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_renditions JSONB;
@@ -0,0 +1,12 @@
+-- Direct-to-S3 uploads: gallery images belong to a pool and are processed
+-- by the image job queue, and jobs can point at a staged upload. image_jobs
+-- only needs altering if it was made before; otherwise db.create_all()
+-- makes it whole.
+
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS pool_id INTEGER
+    REFERENCES pools (id) ON DELETE CASCADE;
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS image_status TEXT;
+
+ALTER TABLE IF EXISTS image_jobs ADD COLUMN IF NOT EXISTS pool_image_id INTEGER
+    REFERENCES pool_images (id) ON DELETE CASCADE;
+ALTER TABLE IF EXISTS image_jobs ADD COLUMN IF NOT EXISTS source_key TEXT UNIQUE;
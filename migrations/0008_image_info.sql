@@ -0,0 +1,15 @@
+-- Image size, placeholder and dominant color, so clients can lay out and
+-- show a placeholder before an image loads. Null for existing images until
+-- `flask rethumbnail` fills them in.
+
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_width INTEGER;
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_height INTEGER;
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_placeholder TEXT;
+ALTER TABLE pools ADD COLUMN IF NOT EXISTS image_color TEXT;
+
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS image_width INTEGER;
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS image_height INTEGER;
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS image_placeholder TEXT;
+ALTER TABLE pool_images ADD COLUMN IF NOT EXISTS image_color TEXT;
+
+ALTER TABLE IF EXISTS stored_images ADD COLUMN IF NOT EXISTS image_info JSONB;
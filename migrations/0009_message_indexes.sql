@@ -0,0 +1,6 @@
+-- Each user's messages, newest last, for the conversations view.
+
+CREATE INDEX IF NOT EXISTS ix_messages_recipient_timestamp
+    ON messages (recipient_username, timestamp);
+CREATE INDEX IF NOT EXISTS ix_messages_sender_timestamp
+    ON messages (sender_username, timestamp);
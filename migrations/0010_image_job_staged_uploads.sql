@@ -0,0 +1,20 @@
+-- Image jobs no longer hold the upload's bytes; every job points at an
+-- upload staged in storage under source_key. Jobs still waiting on bytes
+-- in image_data can't run after this, so they fail along with their
+-- pool's image and the owner uploads it again.
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema()
+                 AND table_name = 'image_jobs' AND column_name = 'image_data') THEN
+        UPDATE image_jobs SET status = 'failed', error = 'upload lost in migration'
+            WHERE source_key IS NULL AND status IN ('pending', 'processing');
+        UPDATE pools SET image_status = 'failed'
+            WHERE id IN (SELECT pool_id FROM image_jobs
+                         WHERE error = 'upload lost in migration');
+
+        ALTER TABLE image_jobs DROP COLUMN image_data;
+    END IF;
+END
+$$;
@@ -1,11 +1,14 @@
 """SQLAlchemy models for ShareBNB."""
 
 from datetime import datetime
+from decimal import Decimal
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB, TSRANGE, TSVECTOR, insert
+
+from geo_helpers import encode_geohash
+from passwords import password_hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 # TODO: USER DEFAULT IMAGE URL
@@ -13,9 +16,88 @@ DEFAULT_USER_IMAGE_URL = "testimage.jpg"
 # TODO: POOL DEFAULT IMAGE URL
 DEFAULT_POOL_IMAGE_URL = ""
 
+# Width of the rate histogram buckets on the browse page
+RATE_BUCKET_WIDTH = Decimal(10)
+
+# Pool.image_status while its upload goes through the image job queue.
+# None means the pool was created without an image.
+IMAGE_PENDING = "pending"
+IMAGE_READY = "ready"
+IMAGE_FAILED = "failed"
+
+
+class SerializeMixin:
+    """ serialize() for models, with optional sparse fieldsets.
+
+    Each model lists its JSON keys in `serialize_fields`, mapped to the
+    attribute each comes from. serialize(fields) only touches the requested
+    attributes, so it is safe on rows loaded with load_only_columns(fields).
+    """
+
+    serialize_fields = {}
+
+    def serialize(self, fields=None):
+        """ returns self, limited to the JSON keys in `fields` if given """
+
+        keys = self.serialize_fields if fields is None else fields
+        return {key: getattr(self, self.serialize_fields[key]) for key in keys}
+
+    @classmethod
+    def load_only_columns(cls, fields):
+        """ Model columns backing the JSON keys in `fields` """
+
+        return [getattr(cls, cls.serialize_fields[key]) for key in fields]
+
+
+class ImageInfoMixin:
+    """ Columns describing a model's image, so clients can lay it out and
+    show a placeholder before it loads. Null until the image is processed.
+    """
+
+    image_width = db.Column(
+        db.Integer,
+    )
+
+    image_height = db.Column(
+        db.Integer,
+    )
+
+    # data: URI of a tiny blurred copy
+    image_placeholder = db.Column(
+        db.Text,
+    )
+
+    # dominant color, "#rrggbb"
+    image_color = db.Column(
+        db.Text,
+    )
+
+    image_info_fields = {
+        "image_width": "image_width",
+        "image_height": "image_height",
+        "image_placeholder": "image_placeholder",
+        "image_color": "image_color",
+    }
+
+    @staticmethod
+    def image_info_columns(info):
+        """ Column values for an image_renditions.describe_image dict """
+
+        info = info or {}
+        return {
+            "image_width": info.get("width"),
+            "image_height": info.get("height"),
+            "image_placeholder": info.get("placeholder"),
+            "image_color": info.get("color"),
+        }
+
+    def set_image_info(self, info):
+        for column, value in self.image_info_columns(info).items():
+            setattr(self, column, value)
+
 
 # USERS
-class User(db.Model):
+class User(SerializeMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -58,26 +140,28 @@ class User(db.Model):
     #     backref='owner'
     # )
 
-    def serialize(self):
-        """ returns self """
-        return {
-            "username" : self.username,
-            "email" : self.email,
-            "location" : self.location,
-            "image_url" : self.image_url,
+    # What app.load_current_user caches; the password hash stays out of it
+    cached_columns = ("username", "email", "location", "image_url")
 
-            # "reserved_pools" : self.reserved_pools,
-            # "owned_pools" : self.owned_pools
-        }
+    serialize_fields = {
+        "username" : "username",
+        "email" : "email",
+        "location" : "location",
+        "image_url" : "image_url",
+
+        # "reserved_pools" : "reserved_pools",
+        # "owned_pools" : "owned_pools"
+    }
 
     @classmethod
     def signup(cls, username, email, password, location, image_url=DEFAULT_USER_IMAGE_URL):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises
+        passwords.PasswordHasherBusy if too many hashes are already queued.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -100,13 +184,19 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        A hash made at an older cost is replaced with one at the current
+        BCRYPT_LOG_ROUNDS; caller commits. Raises passwords.PasswordHasherBusy
+        if too many hashes are already queued.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
@@ -116,11 +206,18 @@ class User(db.Model):
 
 
 # Messages
-class Message(db.Model):
+class Message(SerializeMixin, db.Model):
     "Messages between users in the system"
 
     __tablename__ = "messages"
 
+    # Inbox/outbox scans for a user, newest first; together they back the
+    # conversations query in list_conversations.
+    __table_args__ = (
+        db.Index('ix_messages_recipient_timestamp', 'recipient_username', 'timestamp'),
+        db.Index('ix_messages_sender_timestamp', 'sender_username', 'timestamp'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -164,27 +261,37 @@ class Message(db.Model):
         default=datetime.utcnow,
     )
 
-    def serialize(self):
-        """ returns self """
-        return {
-            "id" : self.id,
-            "sender_username" : self.sender_username,
-            "recipient_username" : self.recipient_username,
-            "body" : self.body,
-            "title" : self.title,
-            "listing" : self.listing,
-            "timestamp" : self.timestamp
-
-        }
+    serialize_fields = {
+        "id" : "id",
+        "sender_username" : "sender_username",
+        "recipient_username" : "recipient_username",
+        "body" : "body",
+        "title" : "title",
+        "listing" : "listing",
+        "timestamp" : "timestamp",
+    }
 
 
 # POOLS
 
-class Pool(db.Model):
+class Pool(SerializeMixin, ImageInfoMixin, db.Model):
     """ Pool in the system """
 
     __tablename__ = 'pools'
 
+    # Backs /api/pools/search: equality on city or owner followed by a rate
+    # range/sort, with id as the keyset tie breaker.
+    __table_args__ = (
+        db.Index('ix_pools_city_rate_id', 'city', 'rate', 'id'),
+        db.Index('ix_pools_owner_rate_id', 'owner_username', 'rate', 'id'),
+        db.Index('ix_pools_rate_id', 'rate', 'id'),
+        db.Index('ix_pools_search_vector', 'search_vector', postgresql_using='gin'),
+        # text_pattern_ops lets geohash LIKE 'prefix%' use the index under
+        # any collation.
+        db.Index('ix_pools_geohash', 'geohash',
+                 postgresql_ops={'geohash': 'text_pattern_ops'}),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -226,26 +333,83 @@ class Pool(db.Model):
         nullable=False,
     )
 
+    # IMAGE_PENDING until the image job fills in the urls above
+    image_status = db.Column(
+        db.Text,
+    )
 
-    def serialize(self):
-        """ returns self """
-        return {
-            "id" : self.id,
-            "owner_username" : self.owner_username,
-            "rate" : self.rate,
-            "size" : self.size,
-            "description" : self.description,
-            "city" : self.city,
-            "orig_image_url": self.orig_image_url,
-            "small_image_url": self.small_image_url
-        }
+    # Resized copies of the image for clients to pick from, smallest first:
+    # [{width, height, format, url}, ...]
+    image_renditions = db.Column(
+        JSONB,
+    )
+
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
 
+    # set together with latitude/longitude by set_location
+    geohash = db.Column(
+        db.Text,
+    )
+
+    # Keyword search document, kept up to date by Postgres. City matches
+    # outrank description matches. Deferred so listings never load it.
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed(
+            "setweight(to_tsvector('english', coalesce(city, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(description, '')), 'B')",
+            persisted=True,
+        ),
+    ))
+
+
+    serialize_fields = {
+        "id" : "id",
+        "owner_username" : "owner_username",
+        "rate" : "rate",
+        "size" : "size",
+        "description" : "description",
+        "city" : "city",
+        "orig_image_url": "orig_image_url",
+        "small_image_url": "small_image_url",
+        "image_status": "image_status",
+        "image_renditions": "image_renditions",
+        **ImageInfoMixin.image_info_fields,
+        "latitude": "latitude",
+        "longitude": "longitude",
+    }
+
+    def set_location(self, latitude, longitude):
+        """ Sets coordinates and the geohash used to search by distance.
+
+        Passing None for both clears the location.
+        """
 
-class Reservation(db.Model):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.geohash = (encode_geohash(latitude, longitude)
+                        if latitude is not None and longitude is not None
+                        else None)
+
+
+class Reservation(SerializeMixin, db.Model):
     """ Connection of a User and Pool that they reserve """
 
     __tablename__ = "reservations"
 
+    # The GiST index answers "does this pool have a reservation overlapping
+    # [start, end)?" for availability search without scanning reservations.
+    __table_args__ = (
+        db.Index('ix_reservations_pool_id', 'pool_id'),
+        db.Index('ix_reservations_period', 'period', postgresql_using='gist'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -276,16 +440,25 @@ class Reservation(db.Model):
         nullable=True,
     )
 
-    def serialize(self):
-        """ returns self """
-        return {
-            "id" : self.id,
-            "username" : self.booked_username,
-            "pool_id" : self.pool_id,
-            "reservation_date_created" : self.reservation_date_created,
-            "start_date" : self.start_date,
-            "end_date" : self.end_date,
-        }
+    # [start_date, end_date) as a range, kept up to date by Postgres. NULL
+    # when either date is missing so undated reservations never block.
+    period = db.deferred(db.Column(
+        TSRANGE,
+        db.Computed(
+            "CASE WHEN start_date IS NULL OR end_date IS NULL THEN NULL "
+            "ELSE tsrange(start_date, end_date, '[)') END",
+            persisted=True,
+        ),
+    ))
+
+    serialize_fields = {
+        "id" : "id",
+        "username" : "booked_username",
+        "pool_id" : "pool_id",
+        "reservation_date_created" : "reservation_date_created",
+        "start_date" : "start_date",
+        "end_date" : "end_date",
+    }
 
 class UserImage(db.Model):
     """ Connection from the user to their profile images. """
@@ -306,7 +479,7 @@ class UserImage(db.Model):
         nullable = False
     )
 
-class PoolImage(db.Model):
+class PoolImage(SerializeMixin, ImageInfoMixin, db.Model):
     """ One to many table connecting a pool to many image paths """
 
     __tablename__ = "pool_images"
@@ -320,18 +493,296 @@ class PoolImage(db.Model):
         db.ForeignKey("users.username", ondelete="CASCADE"),
     )
 
+    pool_id = db.Column(
+        db.Integer,
+        db.ForeignKey("pools.id", ondelete="CASCADE"),
+    )
+
     image_url = db.Column(
         db.Text,
         nullable = False
     )
 
-    def serialize(self):
-        """ returns self """
-        return {
-            "id" : self.id,
-            "pool_owner" : self.pool_owner,
-            "image_url" : self.image_url,
-        }
+    # like Pool.image_status
+    image_status = db.Column(
+        db.Text,
+    )
+
+    serialize_fields = {
+        "id" : "id",
+        "pool_owner" : "pool_owner",
+        "pool_id" : "pool_id",
+        "image_url" : "image_url",
+        "image_status" : "image_status",
+        **ImageInfoMixin.image_info_fields,
+    }
+
+
+class ImageJob(db.Model):
+    """ Uploaded image waiting to be resized and stored (see image_jobs.py).
+
+    Exactly one of pool_id / pool_image_id / username says whose picture it
+    is. The upload is staged in storage under source_key, whether it came
+    through the app or straight from the browser. Workers claim
+    pending jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    them can share the table.
+    """
+
+    __tablename__ = "image_jobs"
+
+    __table_args__ = (
+        db.Index('ix_image_jobs_pending', 'id',
+                 postgresql_where=db.text("status IN ('pending', 'processing')")),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    pool_id = db.Column(
+        db.Integer,
+        db.ForeignKey("pools.id", ondelete="CASCADE"),
+    )
+
+    pool_image_id = db.Column(
+        db.Integer,
+        db.ForeignKey("pool_images.id", ondelete="CASCADE"),
+    )
+
+    username = db.Column(
+        db.Text,
+        db.ForeignKey("users.username", ondelete="CASCADE"),
+    )
+
+    # staged upload in S3 (api_helpers.UPLOAD_PREFIX); unique so the same
+    # upload can't be registered twice
+    source_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # pending -> processing -> done, or back to pending to retry, or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="pending",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+
+class StoredImage(db.Model):
+    """ Index of images already in S3, keyed by a hash of their bytes.
+
+    Objects are stored under their content hash, so an image uploaded again
+    (for another listing, or a resubmitted form) reuses the stored urls and
+    skips the resize and the uploads.
+    """
+
+    __tablename__ = "stored_images"
+
+    # sha256 of the uploaded bytes, hex
+    content_hash = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    orig_image_url = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    small_image_url = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    image_renditions = db.Column(
+        JSONB,
+        nullable=False,
+    )
+
+    # image_renditions.describe_image's dict; null for rows stored before it
+    # existed, until `flask rethumbnail` fills it in
+    image_info = db.Column(
+        JSONB,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @property
+    def urls(self):
+        """ Same shape as api_helpers.upload_to_aws's return value """
+
+        return [self.orig_image_url, self.small_image_url, self.image_renditions,
+                self.image_info]
+
+    @classmethod
+    def record(cls, images):
+        """ Adds uploaded images to the index, skipping ones already there.
+
+        images maps content hash -> urls, as returned by upload_to_aws.
+        """
+
+        if not images:
+            return
+
+        now = datetime.utcnow()
+        stmt = insert(cls).values([
+            {"content_hash": content_hash,
+             "orig_image_url": orig_image_url,
+             "small_image_url": small_image_url,
+             "image_renditions": image_renditions,
+             "image_info": image_info,
+             "created_at": now}
+            for content_hash, (orig_image_url, small_image_url, image_renditions, image_info)
+            in images.items()
+        ]).on_conflict_do_nothing(index_elements=[cls.content_hash])
+        db.session.execute(stmt)
+
+
+class PoolFacet(db.Model):
+    """ Precomputed pool counts for the browse page filters.
+
+    One row per (facet, value): facet "city" counts pools per city, facet
+    "rate" counts pools per RATE_BUCKET_WIDTH wide rate bucket, keyed by the
+    bucket's lower bound. Kept current incrementally by pool_added and
+    pool_removed in the same transaction as the pool change; rebuild()
+    recomputes everything from the pools table.
+    """
+
+    __tablename__ = "pool_facets"
+
+    facet = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    value = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    pool_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @staticmethod
+    def rate_bucket(rate):
+        """ Lower bound of the rate bucket `rate` falls in """
+
+        return (Decimal(rate) // RATE_BUCKET_WIDTH) * RATE_BUCKET_WIDTH
+
+    @classmethod
+    def keys_for(cls, pool):
+        """ (facet, value) rows that `pool` is counted in """
+
+        return [("city", pool.city), ("rate", str(cls.rate_bucket(pool.rate)))]
+
+    @classmethod
+    def adjust(cls, keys, delta):
+        """ Adds delta to the counts of keys, creating missing rows """
+
+        if not keys:
+            return
+
+        stmt = insert(cls).values(
+            [{"facet": facet, "value": value, "pool_count": delta}
+             for facet, value in keys])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.facet, cls.value],
+            set_={"pool_count": cls.pool_count + stmt.excluded.pool_count})
+        db.session.execute(stmt)
+
+    @classmethod
+    def pool_added(cls, pool):
+        cls.adjust(cls.keys_for(pool), 1)
+
+    @classmethod
+    def pool_removed(cls, pool):
+        cls.adjust(cls.keys_for(pool), -1)
+
+    @classmethod
+    def rebuild(cls):
+        """ Recomputes every count from the pools table.
+
+        Run periodically (flask refresh-facets) to correct any drift, e.g.
+        from pools written outside the API.
+        """
+
+        bucket = db.func.floor(Pool.rate / RATE_BUCKET_WIDTH) * RATE_BUCKET_WIDTH
+        city_counts = (db.session.query(Pool.city, db.func.count())
+                       .group_by(Pool.city))
+        rate_counts = (db.session.query(bucket, db.func.count())
+                       .group_by(bucket))
+
+        cls.query.delete()
+        db.session.add_all(
+            [cls(facet="city", value=city, pool_count=count)
+             for city, count in city_counts]
+            + [cls(facet="rate", value=str(rate), pool_count=count)
+               for rate, count in rate_counts])
+
+
+class TokenRevocation(db.Model):
+    """ A revoked JWT, or every JWT of a user issued up to created_at.
+
+    Checked from memory on every authenticated request (see revocations.py);
+    a user's revoke-all replaces their earlier rows.
+    """
+
+    __tablename__ = "token_revocations"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    username = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the token's "jti" claim; None revokes all of username's tokens
+    jti = db.Column(
+        db.Text,
+    )
+
+    # UTC; processes pick up new rows by this
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
 
 
 # db
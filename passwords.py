@@ -0,0 +1,80 @@
+""" Password hashing off the request thread, with a bounded queue.
+
+bcrypt is deliberately slow (about 2**BCRYPT_LOG_ROUNDS rounds of work per
+hash or check) and releases the GIL while it runs. All hashing goes
+through one PasswordHasher per process:
+
+- at most PASSWORD_HASH_THREADS hashes run at once (default: one per CPU),
+  so a login spike can't oversubscribe the CPU and starve other requests;
+- at most PASSWORD_HASH_QUEUE more may wait for a thread. Past that,
+  PasswordHasherBusy is raised at once and the app answers 503, rather
+  than letting requests pile up behind a queue they'd time out in.
+
+Stored hashes carry their own cost, so raising BCRYPT_LOG_ROUNDS applies
+to new passwords straight away, and User.authenticate rehashes older ones
+at the next successful login (needs_rehash).
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 4 * PASSWORD_HASH_THREADS))
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """ Too many password hashes already running or queued """
+
+
+class PasswordHasher:
+    """ bcrypt on a bounded thread pool """
+
+    def __init__(self, rounds=BCRYPT_LOG_ROUNDS, threads=PASSWORD_HASH_THREADS,
+                 queue_depth=PASSWORD_HASH_QUEUE):
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=threads,
+                                            thread_name_prefix="bcrypt")
+        # one slot per running or waiting hash
+        self._slots = threading.BoundedSemaphore(threads + queue_depth)
+
+    def _run(self, fn, *args):
+        """ Runs fn on the pool and waits for it; raises PasswordHasherBusy
+        if every slot is taken """
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        """ Returns the bcrypt hash of password at the current cost, as str """
+
+        return self._run(bcrypt.generate_password_hash, password,
+                         self.rounds).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """ True if pw_hash was made with a cost other than the current one """
+
+        # "$2b$<cost>$<salt and hash>"
+        try:
+            return int(pw_hash.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,178 @@
+""" Admission control for expensive endpoints.
+
+Two kinds of limit, checked before a request does any real work:
+
+- token buckets: each key (e.g. "ip:1.2.3.4" or "username:alice") may
+  make `burst` requests at once, refilled at `rate` per second;
+- concurrency slots: at most `limit` requests to a route in flight at
+  once. Slots are leases, so a worker killed mid-request frees its slot
+  after `lease` seconds.
+
+Two backends share the same interface, like the response cache:
+
+- MemoryRateLimitBackend: inside one process; each gunicorn worker
+  enforces the limits on its own.
+- SqliteRateLimitBackend: a SQLite file on local disk, so every worker on
+  the host shares one set of buckets and slots.
+
+make_rate_limit_backend picks one from a config string.
+"""
+
+import threading
+import time
+import uuid
+
+from cache import SqliteTransaction, sqlite_connection
+
+
+# Buckets untouched for this long are full again and can be forgotten
+STALE_BUCKET_SECONDS = 3600
+PRUNE_EVERY = 1000
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    """ Tokens in a bucket at now, after refilling since updated_at """
+
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+class MemoryRateLimitBackend:
+    """ Token buckets and slots in a dict, for one process """
+
+    def __init__(self):
+        self._buckets = {}     # key -> (tokens, updated_at)
+        self._slots = {}       # name -> {slot id: expires_at}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, key, rate, burst):
+        """ Takes a token from key's bucket.
+
+        Returns 0 if allowed, else the seconds until a token is available.
+        """
+
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated_at, now, rate, burst)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                self._buckets = {k: v for k, v in self._buckets.items()
+                                 if v[1] > now - STALE_BUCKET_SECONDS}
+
+        return 0 if allowed else (1 - tokens) / rate
+
+    def acquire(self, name, limit, lease):
+        """ Takes one of name's limit slots for up to lease seconds.
+
+        Returns a slot id to pass to release, or None if all are taken.
+        """
+
+        now = time.time()
+        with self._lock:
+            slots = self._slots.setdefault(name, {})
+            for slot_id in [s for s, expires_at in slots.items() if expires_at <= now]:
+                del slots[slot_id]
+            if len(slots) >= limit:
+                return None
+
+            slot_id = uuid.uuid4().hex
+            slots[slot_id] = now + lease
+            return slot_id
+
+    def release(self, name, slot_id):
+        with self._lock:
+            self._slots.get(name, {}).pop(slot_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._slots.clear()
+
+
+class SqliteRateLimitBackend:
+    """ Token buckets and slots in a local SQLite file, shared by workers """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL NOT NULL,"
+                " updated_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_slots ("
+                " name TEXT NOT NULL, slot_id TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, PRIMARY KEY (name, slot_id))")
+
+    def _connection(self):
+        return sqlite_connection(self._local, self.path)
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with SqliteTransaction(self._connection()) as conn:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens, updated_at = row if row is not None else (burst, now)
+            tokens = refill(tokens, updated_at, now, rate, burst)
+            allowed = tokens >= 1
+
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at)"
+                " VALUES (?, ?, ?)",
+                (key, tokens - 1 if allowed else tokens, now))
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM rate_buckets WHERE updated_at <= ?",
+                             (now - STALE_BUCKET_SECONDS,))
+
+        return 0 if allowed else (1 - tokens) / rate
+
+    def acquire(self, name, limit, lease):
+        now = time.time()
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute("DELETE FROM rate_slots WHERE name = ? AND expires_at <= ?",
+                         (name, now))
+            (taken,) = conn.execute(
+                "SELECT count(*) FROM rate_slots WHERE name = ?", (name,)).fetchone()
+            if taken >= limit:
+                return None
+
+            slot_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO rate_slots (name, slot_id, expires_at) VALUES (?, ?, ?)",
+                (name, slot_id, now + lease))
+            return slot_id
+
+    def release(self, name, slot_id):
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute("DELETE FROM rate_slots WHERE name = ? AND slot_id = ?",
+                         (name, slot_id))
+
+    def clear(self):
+        with SqliteTransaction(self._connection()) as conn:
+            conn.execute("DELETE FROM rate_buckets")
+            conn.execute("DELETE FROM rate_slots")
+
+
+def make_rate_limit_backend(spec):
+    """ Builds a rate limit backend from a config string.
+
+    "memory" (per process) or "sqlite:///path/to/limits.db" (shared by all
+    workers on the host).
+    """
+
+    if spec == "memory":
+        return MemoryRateLimitBackend()
+    if spec.startswith("sqlite:///"):
+        return SqliteRateLimitBackend(spec[len("sqlite:///"):])
+
+    raise ValueError(f"Unknown rate limit backend: {spec}")
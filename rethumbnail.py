@@ -0,0 +1,198 @@
+""" Regenerates the thumbnail and renditions of every original in S3.
+
+Run with `flask rethumbnail` after changing THUMBNAIL_HEIGHT or the
+rendition widths/formats, or to fill in image info (size, placeholder,
+dominant color) for images uploaded before it was recorded. The large image
+bucket is listed in key order, a batch at a time:
+
+1. originals are downloaded on a few threads,
+2. decoded and resized in a process pool (PIL work is CPU bound),
+3. the resized copies are uploaded on api_helpers.upload_executor,
+4. pools, pool_images and stored_images pointing at those originals get the
+   new urls and image info in one transaction per batch,
+5. the last key of the batch is written to the checkpoint file.
+
+After a crash, running the command again resumes after the checkpoint; at
+most one batch is redone, which is harmless.
+"""
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+from sqlalchemy import bindparam, update
+
+from api_helpers import (BUCKET_NAME_LARGE_IMAGES, image_url, list_originals,
+                         read_original, submit_renditions, wait_for_uploads)
+from image_renditions import render_renditions
+from models import db, ImageInfoMixin, Pool, PoolImage, StoredImage
+
+
+DEFAULT_CHECKPOINT_PATH = "rethumbnail.checkpoint.json"
+DEFAULT_BATCH_SIZE = 20
+
+DOWNLOAD_THREADS = 8
+
+
+class Checkpoint:
+    """ Progress of a run, saved to a JSON file after every batch """
+
+    def __init__(self, path):
+        self.path = path
+        self.after = None       # last key whose batch was committed
+        self.done = 0
+        self.failed = []        # keys that couldn't be processed
+
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.after = state["after"]
+            self.done = state["done"]
+            self.failed = state["failed"]
+
+    def save(self):
+        """ Writes the checkpoint atomically, so a crash never leaves half a file """
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"after": self.after, "done": self.done, "failed": self.failed}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.after = None
+        self.done = 0
+        self.failed = []
+
+
+def batches(keys, size):
+    keys = iter(keys)
+    while batch := list(islice(keys, size)):
+        yield batch
+
+
+def update_image_urls(new_urls):
+    """ Points pools, pool_images and stored_images at regenerated images and
+    fills in their image info; caller commits.
+
+    new_urls maps original key -> (small_image_url, rendition_urls, info).
+    """
+
+    if not new_urls:
+        return
+
+    orig_urls = {image_url(BUCKET_NAME_LARGE_IMAGES, key): key for key in new_urls}
+    info_values = {column: bindparam(column) for column in
+                   ImageInfoMixin.image_info_columns(None)}
+
+    pools = (db.session.query(Pool.id, Pool.orig_image_url)
+             .filter(Pool.orig_image_url.in_(orig_urls))
+             .all())
+    if pools:
+        db.session.execute(
+            update(Pool.__table__)
+            .where(Pool.__table__.c.id == bindparam("pool_id"))
+            .values(small_image_url=bindparam("small_image_url"),
+                    image_renditions=bindparam("image_renditions"),
+                    **info_values),
+            [{"pool_id": pool_id,
+              "small_image_url": new_urls[orig_urls[orig_url]][0],
+              "image_renditions": new_urls[orig_urls[orig_url]][1],
+              **Pool.image_info_columns(new_urls[orig_urls[orig_url]][2])}
+             for pool_id, orig_url in pools])
+
+    pool_images = (db.session.query(PoolImage.id, PoolImage.image_url)
+                   .filter(PoolImage.image_url.in_(orig_urls))
+                   .all())
+    if pool_images:
+        db.session.execute(
+            update(PoolImage.__table__)
+            .where(PoolImage.__table__.c.id == bindparam("pool_image_id"))
+            .values(**info_values),
+            [{"pool_image_id": pool_image_id,
+              **PoolImage.image_info_columns(new_urls[orig_urls[url]][2])}
+             for pool_image_id, url in pool_images])
+
+    stored = (db.session.query(StoredImage.content_hash)
+              .filter(StoredImage.content_hash.in_(new_urls))
+              .all())
+    if stored:
+        db.session.execute(
+            update(StoredImage.__table__)
+            .where(StoredImage.__table__.c.content_hash == bindparam("key"))
+            .values(small_image_url=bindparam("small_image_url"),
+                    image_renditions=bindparam("image_renditions"),
+                    image_info=bindparam("image_info")),
+            [{"key": key,
+              "small_image_url": new_urls[key][0],
+              "image_renditions": new_urls[key][1],
+              "image_info": new_urls[key][2]}
+             for (key,) in stored])
+
+
+def rethumbnail_batch(keys, process_pool, download_pool, log=print):
+    """ Regenerates one batch; returns (new_urls, failed_keys) """
+
+    downloads = [download_pool.submit(read_original, key) for key in keys]
+    renders = {}
+    failed = []
+    for key, download in zip(keys, downloads):
+        try:
+            renders[key] = process_pool.submit(render_renditions, download.result())
+        except Exception as error:
+            log(f"failed to download {key}: {error}")
+            failed.append(key)
+
+    uploads = {}
+    new_urls = {}
+    for key, render in renders.items():
+        try:
+            thumbnail, renditions, info = render.result()
+        except Exception as error:
+            log(f"failed to resize {key}: {error}")
+            failed.append(key)
+            continue
+
+        uploads[key], small_image_url, rendition_urls = submit_renditions(
+            key, thumbnail, renditions)
+        new_urls[key] = (small_image_url, rendition_urls, info)
+
+    for key, key_uploads in uploads.items():
+        try:
+            wait_for_uploads(key_uploads)
+        except Exception as error:
+            log(f"failed to upload renditions of {key}: {error}")
+            failed.append(key)
+            del new_urls[key]
+
+    return new_urls, failed
+
+
+def rethumbnail_bucket(checkpoint, workers=None, batch_size=DEFAULT_BATCH_SIZE, log=print):
+    """ Regenerates every original after checkpoint.after; returns checkpoint """
+
+    # spawn, not fork: the app process has open connections and threads
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as process_pool, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as download_pool:
+
+        for keys in batches(list_originals(start_after=checkpoint.after), batch_size):
+            new_urls, failed = rethumbnail_batch(keys, process_pool, download_pool, log)
+
+            update_image_urls(new_urls)
+            db.session.commit()
+
+            checkpoint.after = keys[-1]
+            checkpoint.done += len(new_urls)
+            checkpoint.failed.extend(failed)
+            checkpoint.save()
+            log(f"{checkpoint.done} images done, {len(checkpoint.failed)} failed, "
+                f"last key {checkpoint.after}")
+
+    return checkpoint
@@ -0,0 +1,148 @@
+""" JWT revocation without a database query per request.
+
+Revocations are rows in token_revocations: one per logged out token (by
+its jti), or one per "log out everywhere" (every token of the user issued
+up to then). Each process keeps them all in memory, the jtis and the
+latest revoke-all time per user, so checking a token is two lookups.
+
+Tokens carry ISSUED_AT_CLAIM, their issue time in microseconds, so a
+token issued just after a revoke-all (logging straight back in, or
+signing up again with a deleted username) isn't caught by it. "iat" is in
+whole seconds; it is only used for tokens issued without the claim.
+
+The copy is refreshed incrementally: at most every
+TOKEN_REVOCATION_REFRESH seconds, the next check reads just the rows
+created since the newest one it has seen (less REFRESH_OVERLAP, to catch
+rows whose transaction committed late). A revocation made in this
+process applies at once; one made in another process applies here within
+the refresh interval.
+
+Tokens never expire, so neither do single-token revocations: the table
+and the in-memory copy grow by one row per logout. A revoke-all replaces
+the user's earlier rows, so each user holds at most one revoke-all plus
+the tokens logged out since. Other processes only drop the replaced rows
+from memory when they restart.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, TokenRevocation
+
+
+TOKEN_REVOCATION_REFRESH = float(os.environ.get('TOKEN_REVOCATION_REFRESH', 5))
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+ISSUED_AT_CLAIM = "iat_us"
+
+
+def utc_microseconds(dt):
+    """ Microseconds since the epoch of a naive UTC datetime """
+
+    delta = dt - datetime(1970, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def issued_at_claims():
+    """ Claims to add to each new token """
+
+    return {ISSUED_AT_CLAIM: utc_microseconds(datetime.utcnow())}
+
+
+def token_issued_at(jwt_data):
+    """ When a token was issued, in microseconds since the epoch """
+
+    if ISSUED_AT_CLAIM in jwt_data:
+        return jwt_data[ISSUED_AT_CLAIM]
+
+    # iat is in whole seconds, so older tokens issued in the same second as
+    # a revoke-all are revoked too
+    return jwt_data["iat"] * 1_000_000
+
+
+class RevokedTokens:
+    """ In-memory copy of token_revocations """
+
+    def __init__(self, refresh_interval=TOKEN_REVOCATION_REFRESH):
+        self.refresh_interval = refresh_interval
+        self._jtis = {}                # jti -> username
+        self._revoked_before = {}      # username -> UTC microseconds
+        self._newest = None            # created_at of the newest row seen
+        self._next_refresh = 0
+        self._lock = threading.Lock()
+
+    def is_revoked(self, username, jti, issued_at):
+        """ True if the token with this jti, issued at issued_at (see
+        token_issued_at) to username has been revoked """
+
+        if time.monotonic() >= self._next_refresh:
+            self.refresh(only_if_due=True)
+
+        if jti in self._jtis:
+            return True
+
+        revoked_before = self._revoked_before.get(username)
+        return revoked_before is not None and issued_at <= revoked_before
+
+    def refresh(self, only_if_due=False):
+        """ Reads the revocations added since the last refresh """
+
+        with self._lock:
+            # another thread may have refreshed while this one waited
+            if only_if_due and time.monotonic() < self._next_refresh:
+                return
+
+            query = db.session.query(TokenRevocation.username, TokenRevocation.jti,
+                                     TokenRevocation.created_at)
+            if self._newest is not None:
+                query = query.filter(
+                    TokenRevocation.created_at >= self._newest - REFRESH_OVERLAP)
+
+            for username, jti, created_at in query:
+                self._add(username, jti, created_at)
+
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def _add(self, username, jti, created_at):
+        if jti is not None:
+            self._jtis[jti] = username
+        else:
+            self._revoked_before[username] = max(
+                utc_microseconds(created_at), self._revoked_before.get(username, 0))
+
+        if self._newest is None or created_at > self._newest:
+            self._newest = created_at
+
+    def revoke_token(self, username, jti):
+        """ Revokes one token. Commits. """
+
+        created_at = datetime.utcnow()
+        db.session.add(TokenRevocation(username=username, jti=jti, created_at=created_at))
+        db.session.commit()
+
+        with self._lock:
+            self._add(username, jti, created_at)
+
+    def revoke_user(self, username):
+        """ Revokes every token username has been issued so far, replacing
+        their earlier revocations. Commits. """
+
+        created_at = datetime.utcnow()
+        TokenRevocation.query.filter_by(username=username).delete()
+        db.session.add(TokenRevocation(username=username, created_at=created_at))
+        db.session.commit()
+
+        with self._lock:
+            self._jtis = {jti: name for jti, name in self._jtis.items() if name != username}
+            self._add(username, None, created_at)
+
+    def clear(self):
+        """ Forgets the in-memory copy; the next check reloads it """
+
+        with self._lock:
+            self._jtis.clear()
+            self._revoked_before.clear()
+            self._newest = None
+            self._next_refresh = 0
@@ -1,6 +1,6 @@
 # noinspection PyUnresolvedReferences
 from app import db
-from models import User, UserImage, Pool, PoolImage, Reservation, Message
+from models import User, UserImage, Pool, PoolImage, Reservation, Message, PoolFacet
 
 db.drop_all()
 db.create_all()
@@ -150,6 +150,9 @@ pool10 = Pool(
 
 db.session.add_all([pool1, pool2, pool3, pool4, pool5, pool6, pool7, pool8, pool9, pool10])
 db.session.commit()
+
+PoolFacet.rebuild()
+db.session.commit()
 # endregion
 
 # region poolImages
@@ -0,0 +1,200 @@
+""" Where uploaded images are kept.
+
+Two backends share the same interface, addressed by bucket and key:
+
+- S3StorageBackend: the S3 buckets in production. boto3 is imported and the
+  client created on first use, not at import, so importing the app (tests,
+  seed.py, the image worker) doesn't pay for it or need AWS credentials.
+  One client, with a connection pool sized for the upload threads, is
+  shared by every thread in the process.
+- LocalStorageBackend: a directory on local disk, one subdirectory per
+  bucket, to run the whole image pipeline without AWS.
+
+make_storage_backend picks one from a config string.
+"""
+
+import os
+import threading
+from pathlib import Path
+
+
+MB = 1024 * 1024
+
+
+class S3StorageBackend:
+    """ Objects in S3 buckets, through a lazily created boto3 client """
+
+    def __init__(self, region="us-west-1", max_pool_connections=10,
+                 multipart_threshold=8 * MB, multipart_chunksize=8 * MB,
+                 multipart_concurrency=4, client=None):
+        self.region = region
+        self.max_pool_connections = max_pool_connections
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.multipart_concurrency = multipart_concurrency
+        self._client = client
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """ The boto3 client, created on first use """
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._make_client()
+        return self._client
+
+    def _make_client(self):
+        import boto3
+        from botocore.config import Config
+
+        # Credentials from the env names in .env, else boto3's usual chain
+        # (instance role, ~/.aws). Presigned requests are signed for region.
+        return boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get('aws_access_key_id'),
+            aws_secret_access_key=os.environ.get('aws_secret_access_key'),
+            region_name=self.region,
+            config=Config(max_pool_connections=self.max_pool_connections))
+
+    @property
+    def transfer_config(self):
+        """ Files over multipart_threshold go up in parts, up to
+        multipart_concurrency at a time """
+
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+
+            self._transfer_config = TransferConfig(
+                multipart_threshold=self.multipart_threshold,
+                multipart_chunksize=self.multipart_chunksize,
+                max_concurrency=self.multipart_concurrency,
+            )
+        return self._transfer_config
+
+    def base_url(self, bucket):
+        return f"https://{bucket}.s3.{self.region}.amazonaws.com/"
+
+    def put(self, file, bucket, key, content_type=None):
+        extra_args = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(file, bucket, key, ExtraArgs=extra_args,
+                                   Config=self.transfer_config)
+
+    def get(self, bucket, key):
+        return self.client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    def size(self, bucket, key):
+        """ Returns the size of an object, or None if it isn't there """
+
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def delete(self, bucket, key):
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    def list_keys(self, bucket, start_after=None, page_size=1000):
+        """ Yields the keys in bucket after start_after, in key order """
+
+        paginator = self.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=bucket,
+            StartAfter=start_after or "",
+            PaginationConfig={"PageSize": page_size},
+        )
+        for page in pages:
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+    def presigned_post(self, bucket, key, content_type, max_size, expires_in):
+        """ Returns {url, fields} for a browser to POST one file to key """
+
+        return self.client.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires_in,
+        )
+
+
+class LocalStorageBackend:
+    """ Objects as files under root/<bucket>/<key>, served from base_url """
+
+    def __init__(self, root, base_url="/media/"):
+        self.root = Path(root)
+        self.url_prefix = base_url if base_url.endswith("/") else f"{base_url}/"
+
+    def bucket_path(self, bucket):
+        return self.root / bucket
+
+    def _path(self, bucket, key):
+        path = (self.root / bucket / key).resolve()
+        if not path.is_relative_to(self.bucket_path(bucket).resolve()):
+            raise ValueError(f"Key outside of bucket: {key}")
+        return path
+
+    def base_url(self, bucket):
+        return f"{self.url_prefix}{bucket}/"
+
+    def put(self, file, bucket, key, content_type=None):
+        """ Writes to a temporary file first, so readers never see half an
+        object """
+
+        path = self._path(bucket, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as out:
+            while chunk := file.read(MB):
+                out.write(chunk)
+        os.replace(tmp_path, path)
+
+    def get(self, bucket, key):
+        return self._path(bucket, key).read_bytes()
+
+    def size(self, bucket, key):
+        try:
+            return self._path(bucket, key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, bucket, key):
+        self._path(bucket, key).unlink(missing_ok=True)
+
+    def list_keys(self, bucket, start_after=None, page_size=1000):
+        bucket_path = self.bucket_path(bucket)
+        keys = sorted(
+            path.relative_to(bucket_path).as_posix()
+            for path in bucket_path.rglob("*")
+            if path.is_file() and not path.name.endswith(".tmp"))
+        for key in keys:
+            if start_after is None or key > start_after:
+                yield key
+
+    def presigned_post(self, bucket, key, content_type, max_size, expires_in):
+        raise NotImplementedError("Direct uploads need the S3 storage backend")
+
+
+def make_storage_backend(spec, base_url=None, **s3_options):
+    """ Builds a storage backend from a config string.
+
+    "s3" (the S3 buckets) or "file:///path/to/dir" (local disk, with urls
+    under base_url, default /media/). s3_options go to S3StorageBackend.
+    """
+
+    if spec == "s3":
+        return S3StorageBackend(**s3_options)
+    if spec.startswith("file://"):
+        return LocalStorageBackend(spec[len("file://"):], base_url=base_url or "/media/")
+
+    raise ValueError(f"Unknown storage backend: {spec}")
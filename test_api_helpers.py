@@ -0,0 +1,123 @@
+import io
+import time
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_s3
+from PIL import Image
+
+from image_renditions import render_renditions
+from api_helpers import (
+    upload_to_aws, BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES, MB)
+from storage import S3StorageBackend
+from test_helpers import make_jpeg
+
+
+# Simulated link to S3 for the timing tests: every request pays a round trip
+# plus its body size over this bandwidth.
+ROUND_TRIP_SECONDS = 0.05
+BYTES_PER_SECOND = 20 * MB
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if hasattr(body, "__len__"):
+        return len(body)
+
+    position = body.tell()
+    size = body.seek(0, io.SEEK_END) - position
+    body.seek(position)
+    return size
+
+
+def simulate_network(params, **kwargs):
+    # params is the serialized request here; its body is what goes on the wire
+    time.sleep(ROUND_TRIP_SECONDS + body_size(params.get("body")) / BYTES_PER_SECOND)
+
+
+def upload_sequentially(s3, file):
+    """ upload_to_aws without the thread pool: one PUT per object, in turn """
+
+    data = file.read()
+    s3.put_object(Body=data, Bucket=BUCKET_NAME_LARGE_IMAGES, Key="sequential")
+
+    thumbnail, renditions, _ = render_renditions(data)
+    for i, image in enumerate([thumbnail] + renditions):
+        s3.put_object(Body=image.data, Bucket=BUCKET_NAME_SMALL_IMAGES,
+                      Key=f"sequential-{i}")
+
+
+@mock_s3
+class UploadToAwsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-west-1")
+        for bucket in (BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES):
+            self.s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "us-west-1"})
+
+        self.storage = S3StorageBackend(client=self.s3)
+        patcher = patch("api_helpers.storage", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_object(self, url):
+        bucket = (BUCKET_NAME_SMALL_IMAGES if url.endswith("-small")
+                  else BUCKET_NAME_LARGE_IMAGES)
+        return self.s3.get_object(Bucket=bucket, Key=url.rsplit("/", 1)[1])
+
+    def test_upload_to_aws(self):
+        data = make_jpeg(600, 400, noisy=True)
+
+        orig_url, small_url, renditions, info = upload_to_aws(io.BytesIO(data))
+
+        self.assertEqual(self.get_object(orig_url)["Body"].read(), data)
+        small = Image.open(self.get_object(small_url)["Body"])
+        self.assertEqual(small.height, 280)
+
+        self.assertEqual([(r["width"], r["format"]) for r in renditions],
+                         [(320, "jpeg"), (320, "webp"), (600, "jpeg"), (600, "webp")])
+        self.assertEqual((info["width"], info["height"]), (600, 400))
+        for rendition in renditions:
+            obj = self.s3.get_object(Bucket=BUCKET_NAME_SMALL_IMAGES,
+                                     Key=rendition["url"].rsplit("/", 1)[1])
+            self.assertEqual(obj["ContentType"], f"image/{rendition['format']}")
+            self.assertEqual(Image.open(obj["Body"]).width, rendition["width"])
+
+    def test_upload_to_aws_multipart(self):
+        data = make_jpeg(3500, 2500, noisy=True)
+        self.assertGreater(len(data), self.storage.multipart_threshold)
+
+        orig_url, _, _, _ = upload_to_aws(io.BytesIO(data))
+
+        obj = self.get_object(orig_url)
+        self.assertEqual(obj["Body"].read(), data)
+        # S3 ETags of multipart uploads end in -<number of parts>
+        self.assertIn("-", obj["ETag"])
+
+    def test_upload_to_aws_failure(self):
+        self.s3.delete_bucket(Bucket=BUCKET_NAME_SMALL_IMAGES)
+
+        with self.assertRaises(Exception):
+            upload_to_aws(io.BytesIO(make_jpeg(600, 400, noisy=True)))
+
+    def test_upload_to_aws_faster_than_sequential(self):
+        data = make_jpeg(3500, 2500, noisy=True)
+        self.storage.multipart_threshold = self.storage.multipart_chunksize = 5 * MB
+        self.s3.meta.events.register("before-call.s3.PutObject", simulate_network)
+        self.s3.meta.events.register("before-call.s3.UploadPart", simulate_network)
+
+        start = time.perf_counter()
+        upload_sequentially(self.s3, io.BytesIO(data))
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        upload_to_aws(io.BytesIO(data))
+        concurrent = time.perf_counter() - start
+
+        self.assertLess(concurrent, sequential * 0.75,
+                        f"sequential {sequential:.2f}s, concurrent {concurrent:.2f}s")
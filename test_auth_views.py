@@ -1,7 +1,17 @@
 import unittest
 import json
-from app import app
-from models import db, User
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+from PIL import Image
+from app import app, user_cache, user_cache_key, revoked_tokens, rate_limiter, image_worker
+from models import db, User, ImageJob
+from storage import LocalStorageBackend
+from image_jobs import run_pending_jobs
+from passwords import PasswordHasherBusy
+from models import TokenRevocation
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 class TestAuthViews(unittest.TestCase):
@@ -11,6 +21,16 @@ class TestAuthViews(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
         app.config['TESTING'] = True
         self.client = app.test_client()
+        user_cache.clear()
+        revoked_tokens.clear()
+        rate_limiter.clear()
+
+        # uploads are staged in storage for the image jobs
+        staging = tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        patcher = patch("api_helpers.storage", LocalStorageBackend(staging.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         db.drop_all()
         db.create_all()
@@ -65,6 +85,156 @@ class TestAuthViews(unittest.TestCase):
         self.assertIn("error", json_response)
         db.session.rollback()  
 
+    @patch('image_jobs.upload_to_aws', return_value=['https://example.com/orig.jpg', 'https://example.com/small.jpg', [], None])
+    def test_create_user_with_image(self, mock_upload):
+        """Test if the signup endpoint queues the profile image instead of uploading it."""
+
+        out = BytesIO()
+        Image.new("RGB", (100, 100), "red").save(out, "JPEG")
+        image_data = out.getvalue()
+
+        response = self.client.post(
+            "/api/auth/signup",
+            data={
+                "username": "testuser",
+                "email": "test@test.com",
+                "password": "password",
+                "location": "Test City",
+                "file": (BytesIO(image_data), "test_file.jpg")
+            }
+        )
+
+        self.assertIn("token", json.loads(response.data))
+        mock_upload.assert_not_called()
+        self.assertEqual(ImageJob.query.one().username, "testuser")
+
+        # the user behind the token is cached on its first request...
+        headers = {"Authorization": f"Bearer {json.loads(response.data)['token']}"}
+        self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertIsNotNone(user_cache.get(user_cache_key("testuser")))
+
+        run_pending_jobs(image_worker.on_pool_updated, image_worker.on_user_updated)
+        self.assertEqual(db.session.get(User, "testuser").image_url, "https://example.com/orig.jpg")
+        # ...and dropped once the image job changes it
+        self.assertIsNone(user_cache.get(user_cache_key("testuser")))
+
+    def test_logout(self):
+        """Test that logging out revokes only the token used."""
+
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        token = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+        other = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        response = self.client.post("/api/auth/logout", headers=token)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get("/api/reservations/testuser", headers=token).status_code, 401)
+        self.assertEqual(self.client.get("/api/reservations/testuser", headers=other).status_code, 200)
+
+    def test_logout_everywhere(self):
+        """Test that logging out everywhere revokes every earlier token."""
+
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        tokens = [{"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+                  for _ in range(2)]
+
+        response = self.client.post("/api/auth/logout-all", headers=tokens[0])
+        self.assertEqual(response.status_code, 200)
+
+        for headers in tokens:
+            self.assertEqual(self.client.get("/api/reservations/testuser", headers=headers).status_code, 401)
+
+        # logging straight back in, within the same second, gives a live token
+        response = self.client.post(
+            "/api/auth/login", json={"username": "testuser", "password": "password"})
+        headers = {"Authorization": f"Bearer {json.loads(response.data)['token']}"}
+        self.assertEqual(self.client.get("/api/reservations/testuser", headers=headers).status_code, 200)
+
+    def test_logout_everywhere_replaces_earlier_revocations(self):
+        """Test that a revoke-all replaces the user's earlier revocations,
+        which it covers."""
+
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        tokens = [{"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+                  for _ in range(3)]
+        # issued before the claim with the time in microseconds existed
+        with patch("app.issued_at_claims", return_value={}):
+            legacy = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        for headers in tokens[:2]:
+            self.client.post("/api/auth/logout", headers=headers)
+        self.assertEqual(TokenRevocation.query.count(), 2)
+
+        self.client.post("/api/auth/logout-all", headers=tokens[2])
+        self.assertEqual([(r.username, r.jti) for r in TokenRevocation.query],
+                         [("testuser", None)])
+
+        revoked_tokens.clear()
+        for headers in tokens + [legacy]:
+            self.assertEqual(self.client.get("/api/reservations/testuser", headers=headers).status_code, 401)
+
+    def test_revocation_check_without_query(self):
+        """Test that tokens are checked from memory, picking up revocations
+        made elsewhere at the next refresh."""
+
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+        self.client.get("/api/reservations/testuser", headers=headers)
+
+        queries = []
+
+        def count_queries(conn, cursor, statement, *args):
+            if statement.startswith("SELECT") and "token_revocations" in statement:
+                queries.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_queries)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_queries)
+
+        for _ in range(3):
+            self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertEqual(queries, [])
+
+        # revoked by another process
+        db.session.add(TokenRevocation(username="testuser"))
+        db.session.commit()
+
+        with patch.object(revoked_tokens, "_next_refresh", 0):
+            response = self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(queries), 1)
+
+    def test_login_busy(self):
+        """Test that login answers 503 when password hashing is saturated."""
+
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+
+        with patch('passwords.PasswordHasher.check', side_effect=PasswordHasherBusy):
+            response = self.client.post(
+                "/api/auth/login",
+                json={"username": "testuser", "password": "password"}
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    @patch.dict(app.config, {"MAX_CONTENT_LENGTH": 1024})
+    def test_login_body_too_large(self):
+        """Test that a JSON body over MAX_CONTENT_LENGTH is refused unread."""
+
+        with patch('passwords.PasswordHasher.check') as check:
+            response = self.client.post(
+                "/api/auth/login",
+                json={"username": "testuser", "password": "x" * 2048}
+            )
+
+        self.assertEqual(response.status_code, 413)
+        check.assert_not_called()
+
 def test_login_successful(self):
     """Test if the login endpoint authenticates a user and returns a token."""
 
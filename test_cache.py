@@ -0,0 +1,126 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from cache import MemoryCacheBackend, SqliteCacheBackend, make_cache_backend
+
+
+class CacheBackendTests:
+    """Tests shared by every cache backend; mixed into a TestCase below."""
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", b"1")
+        self.assertEqual(self.cache.get("a"), b"1")
+
+    def test_ttl(self):
+        self.cache.set("a", b"1", ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_invalidate_tags(self):
+        self.cache.set("list", b"1", tags=["pool:1", "pool:2"])
+        self.cache.set("detail1", b"2", tags=["pool:1"])
+        self.cache.set("detail2", b"3", tags=["pool:2"])
+
+        self.cache.invalidate_tags(["pool:1"])
+
+        self.assertIsNone(self.cache.get("list"))
+        self.assertIsNone(self.cache.get("detail1"))
+        self.assertEqual(self.cache.get("detail2"), b"3")
+
+    def test_overwrite_drops_old_tags(self):
+        self.cache.set("a", b"1", tags=["old"])
+        self.cache.set("a", b"2", tags=["new"])
+
+        self.cache.invalidate_tags(["old"])
+        self.assertEqual(self.cache.get("a"), b"2")
+
+    def test_max_entries(self):
+        for i in range(5):
+            self.cache.set(str(i), b"x", ttl=60 + i)
+        self.assertIsNone(self.cache.get("0"))
+        self.assertEqual(self.cache.get("4"), b"x")
+
+
+class MemoryCacheBackendTestCase(CacheBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.cache = MemoryCacheBackend(max_entries=3)
+
+    def test_lru(self):
+        self.cache.set("a", b"1")
+        self.cache.set("b", b"2")
+        self.cache.set("c", b"3")
+        self.cache.get("a")
+        self.cache.set("d", b"4")
+
+        self.assertEqual(self.cache.get("a"), b"1")
+        self.assertIsNone(self.cache.get("b"))
+
+
+class SqliteCacheBackendTestCase(CacheBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cache.db")
+        self.cache = SqliteCacheBackend(self.path, max_entries=3)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared_between_instances(self):
+        other = SqliteCacheBackend(self.path)
+        self.cache.set("a", b"1", tags=["pool:1"])
+        self.assertEqual(other.get("a"), b"1")
+
+        other.invalidate_tags(["pool:1"])
+        self.assertIsNone(self.cache.get("a"))
+
+
+class MakeCacheBackendTestCase(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            make_cache_backend("redis://localhost")
+
+    def test_none_backend(self):
+        cache = make_cache_backend("none")
+        cache.set("a", b"1")
+        self.assertIsNone(cache.get("a"))
+
+
+class AppResponseCacheConfigTestCase(unittest.TestCase):
+    """The app shares its response cache between workers by default, and
+    must with a separate image worker."""
+
+    def import_app(self, **env):
+        env = {key: value for key, value in os.environ.items()
+               if key != "RESPONSE_CACHE_BACKEND"} | env
+        return subprocess.run(
+            [sys.executable, "-c", "import app; print(app.response_cache.path)"],
+            env=env, capture_output=True, text=True)
+
+    def test_shared_by_default(self):
+        result = self.import_app()
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(),
+                         os.path.join(tempfile.gettempdir(), "pool_party_cache.db"))
+
+    def test_shared_by_default_without_image_worker(self):
+        result = self.import_app(IMAGE_WORKER="0")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(),
+                         os.path.join(tempfile.gettempdir(), "pool_party_cache.db"))
+
+    def test_memory_refused_without_image_worker(self):
+        result = self.import_app(IMAGE_WORKER="0", RESPONSE_CACHE_BACKEND="memory")
+
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("IMAGE_WORKER=0 needs a shared RESPONSE_CACHE_BACKEND", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
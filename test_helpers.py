@@ -0,0 +1,22 @@
+""" Helpers shared by the test modules """
+
+import io
+import os
+
+from PIL import Image
+
+
+def make_jpeg(width=400, height=300, color="red", noisy=False):
+    """ Returns the bytes of a JPEG of one color, or of random noise, which
+    compresses poorly """
+
+    if noisy:
+        img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+        quality = 95
+    else:
+        img = Image.new("RGB", (width, height), color)
+        quality = 75
+
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
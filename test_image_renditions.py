@@ -0,0 +1,137 @@
+import base64
+import io
+import unittest
+from unittest.mock import patch
+
+from PIL import Image
+
+import image_renditions
+from image_renditions import (decode_image, render_renditions, check_image_header,
+                              describe_image, InvalidImageError, EXIF_ORIENTATION)
+
+
+def make_image(width, height, image_format="JPEG", mode="RGB", orientation=None):
+    img = Image.new(mode, (width, height), "red")
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[EXIF_ORIENTATION] = orientation
+    exif[0x010F] = "Test Camera"    # Make
+
+    out = io.BytesIO()
+    img.save(out, image_format, exif=exif.tobytes())
+    return out.getvalue()
+
+
+class ImageRenditionsTestCase(unittest.TestCase):
+    def test_render_renditions(self):
+        thumbnail, renditions, _ = render_renditions(
+            make_image(2000, 1000), widths=(640, 320), formats=("JPEG", "WEBP"))
+
+        self.assertEqual((thumbnail.width, thumbnail.height, thumbnail.format),
+                         (560, 280, "JPEG"))
+        self.assertEqual(
+            [(r.width, r.height, r.format) for r in renditions],
+            [(320, 160, "JPEG"), (320, 160, "WEBP"), (640, 320, "JPEG"), (640, 320, "WEBP")])
+
+        for rendition in renditions:
+            img = Image.open(io.BytesIO(rendition.data))
+            self.assertEqual(img.format, rendition.format)
+            self.assertEqual(img.size, (rendition.width, rendition.height))
+
+    def test_render_renditions_no_upscaling(self):
+        _, renditions, _ = render_renditions(
+            make_image(500, 400), widths=(320, 640, 1024), formats=("JPEG",))
+
+        self.assertEqual([r.width for r in renditions], [320, 500])
+
+    def test_render_renditions_decodes_once(self):
+        with patch("image_renditions.Image.Image.load", autospec=True,
+                   side_effect=Image.Image.load) as load:
+            render_renditions(make_image(1200, 800), widths=(320, 640),
+                              formats=("JPEG", "WEBP"))
+
+        decoded = {id(call.args[0]) for call in load.call_args_list
+                   if getattr(call.args[0], "format", None) == "JPEG"}
+        self.assertEqual(len(decoded), 1)
+
+    def test_describe_image(self):
+        img = Image.new("RGB", (400, 200), "blue")
+        img.paste((255, 0, 0), (0, 0, 100, 200))
+
+        info = describe_image(img, 4000, 2000)
+
+        self.assertEqual((info["width"], info["height"], info["color"]),
+                         (4000, 2000, "#0000ff"))
+        self.assertTrue(info["placeholder"].startswith("data:image/webp;base64,"))
+        placeholder = Image.open(io.BytesIO(
+            base64.b64decode(info["placeholder"].split(",", 1)[1])))
+        self.assertEqual(placeholder.size, (16, 8))
+        self.assertLess(len(info["placeholder"]), 400)
+
+    def test_decode_image_uses_draft(self):
+        img = decode_image(make_image(4000, 3000), 640, 280)
+
+        # 4000x3000 decoded at 1/4 scale is the smallest that covers 640 wide
+        self.assertEqual(img.size, (1000, 750))
+
+    def test_exif_orientation(self):
+        # Stored landscape, displayed portrait (rotate 90 degrees)
+        thumbnail, renditions, info = render_renditions(
+            make_image(800, 400, orientation=6), widths=(200,), formats=("JPEG",))
+
+        self.assertEqual((renditions[0].width, renditions[0].height), (200, 400))
+        self.assertEqual((thumbnail.width, thumbnail.height), (140, 280))
+        self.assertEqual((info["width"], info["height"]), (400, 800))
+
+    def test_metadata_stripped(self):
+        thumbnail, renditions, _ = render_renditions(
+            make_image(800, 400, orientation=6), widths=(200,), formats=("JPEG", "WEBP"))
+
+        for rendition in [thumbnail] + renditions:
+            img = Image.open(io.BytesIO(rendition.data))
+            self.assertNotIn("exif", img.info)
+            self.assertEqual(dict(img.getexif()), {})
+
+    def test_transparency_flattened(self):
+        out = io.BytesIO()
+        Image.new("RGBA", (400, 400), (0, 0, 0, 0)).save(out, "PNG")
+
+        _, renditions, _ = render_renditions(out.getvalue(), widths=(100,), formats=("JPEG",))
+
+        img = Image.open(io.BytesIO(renditions[0].data))
+        r, g, b = img.getpixel((50, 50))
+        self.assertGreater(min(r, g, b), 250)
+
+    def test_default_widths_and_formats(self):
+        self.assertEqual(image_renditions.RENDITION_FORMATS, ("JPEG", "WEBP"))
+        self.assertEqual(image_renditions.RENDITION_WIDTHS, (320, 640, 1024, 1600))
+
+    def test_check_image_header(self):
+        file = io.BytesIO(make_image(300, 200))
+        file.seek(5)
+
+        self.assertEqual(check_image_header(file), ("JPEG", 300, 200))
+        self.assertEqual(file.tell(), 5)
+
+    def test_check_image_header_not_an_image(self):
+        with self.assertRaises(InvalidImageError):
+            check_image_header(io.BytesIO(b"not an image"))
+
+    @patch("image_renditions.MAX_IMAGE_PIXELS", 1_000_000)
+    @patch("image_renditions.MAX_FULL_DECODE_PIXELS", 100_000)
+    def test_check_image_header_too_large(self):
+        # JPEGs get the higher limit since they're decoded at reduced size
+        check_image_header(io.BytesIO(make_image(1000, 1000)))
+        with self.assertRaises(InvalidImageError):
+            check_image_header(io.BytesIO(make_image(1001, 1000)))
+
+        with self.assertRaises(InvalidImageError):
+            check_image_header(io.BytesIO(make_image(400, 400, image_format="PNG")))
+
+        with self.assertRaises(InvalidImageError):
+            render_renditions(make_image(400, 400, image_format="PNG"))
+
+    def test_decode_image_bounded(self):
+        # 1/8 scale is the most draft() can do
+        img = decode_image(make_image(8000, 6000), 320, 280)
+        self.assertEqual(img.size, (1000, 750))
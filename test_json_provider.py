@@ -0,0 +1,49 @@
+import json
+import unittest
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from json_provider import OrjsonProvider, make_json_provider
+
+
+class OrjsonProviderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.fast = OrjsonProvider(self.app)
+        self.default = DefaultJSONProvider(self.app)
+
+    def test_same_wire_format_as_default(self):
+        """Decimal, datetime and date render exactly like Flask's encoder."""
+        payload = {
+            "rate": Decimal("10.50"),
+            "timestamp": datetime(2023, 2, 1, 12, 1),
+            "aware": datetime(2023, 2, 1, 4, 1, tzinfo=timezone(timedelta(hours=-8))),
+            "day": date(2023, 2, 3),
+            "nested": [{"b": 1, "a": None}],
+        }
+
+        with self.app.app_context():
+            fast = self.fast.response(payload).get_data()
+            default = self.default.response(payload).get_data()
+
+        self.assertEqual(fast, default)
+        self.assertEqual(json.loads(fast)["timestamp"], "Wed, 01 Feb 2023 12:01:00 GMT")
+        self.assertEqual(json.loads(fast)["rate"], "10.50")
+
+    def test_dumps_with_options_uses_stdlib(self):
+        self.assertEqual(self.fast.dumps({"a": 1}, indent=2), '{\n  "a": 1\n}')
+
+    def test_loads(self):
+        self.assertEqual(self.fast.loads(b'{"a": [1, 2]}'), {"a": [1, 2]})
+
+    def test_make_json_provider(self):
+        self.assertIsInstance(make_json_provider(self.app), OrjsonProvider)
+        self.assertIsInstance(make_json_provider(self.app, use_orjson=False),
+                              DefaultJSONProvider)
+
+
+if __name__ == "__main__":
+    unittest.main()
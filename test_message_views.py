@@ -1,6 +1,8 @@
 import unittest
 import json
-from app import app
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import app, user_cache, revoked_tokens, rate_limiter
 from models import db, User, Message
 from flask_jwt_extended import create_access_token
 
@@ -12,6 +14,9 @@ class MessagesViewsTestCase(unittest.TestCase):
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///sharebnb_test"
         self.client = app.test_client()
+        user_cache.clear()
+        revoked_tokens.clear()
+        rate_limiter.clear()
 
         db.create_all()
 
@@ -53,6 +58,55 @@ class MessagesViewsTestCase(unittest.TestCase):
         self.assertTrue("inbox" in data["messages"])
         self.assertTrue("outbox" in data["messages"])
 
+    def test_list_messages_fields(self):
+        access_token1 = create_access_token(identity="user1")
+        headers = {"Authorization": f"Bearer {access_token1}"}
+
+        response = self.client.get("/api/messages?fields=id,title", headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["messages"]["outbox"], [{"id": 1, "title": "Test Message"}])
+
+    def test_list_conversations(self):
+        start = datetime(2023, 3, 1, 12, 0)
+        db.session.add_all([
+            Message(sender_username="user2", recipient_username="user1", body="Yes it is!",
+                    listing=1, timestamp=start + timedelta(minutes=1)),
+            Message(sender_username="user1", recipient_username="user3", body="Hi",
+                    listing=2, timestamp=start + timedelta(minutes=3)),
+            Message(sender_username="user3", recipient_username="user1", body="Hello",
+                    listing=1, timestamp=start + timedelta(minutes=2)),
+            Message(sender_username="user2", recipient_username="user3", body="Not for user1",
+                    listing=1, timestamp=start + timedelta(minutes=4)),
+        ])
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {create_access_token(identity='user1')}"}
+
+        message_queries = []
+
+        def count_queries(conn, cursor, statement, *args):
+            if "FROM messages" in statement:
+                message_queries.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_queries)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_queries)
+
+        response = self.client.get("/api/messages/conversations?fields=body", headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(message_queries), 1)
+        # setUp's message to user2 was sent just now
+        self.assertEqual(data["conversations"], [
+            {"counterpart": "user2", "listing": 1, "message_count": 2,
+             "latest_message": {"body": "This is a test message."}},
+            {"counterpart": "user3", "listing": 2, "message_count": 1,
+             "latest_message": {"body": "Hi"}},
+            {"counterpart": "user3", "listing": 1, "message_count": 1,
+             "latest_message": {"body": "Hello"}},
+        ])
+
     def test_create_message(self):
         access_token1 = create_access_token(identity="user1")
         headers = {"Authorization": f"Bearer {access_token1}"}
@@ -0,0 +1,86 @@
+import os
+import unittest
+
+from sqlalchemy import text
+
+from app import app, apply_migrations, MIGRATIONS_DIR
+from models import db
+
+
+def read_schema(connection, schema):
+    """ Columns, indexes and constraints of every table in schema """
+
+    columns = connection.execute(text(
+        "SELECT table_name, column_name, data_type, is_nullable, generation_expression"
+        " FROM information_schema.columns WHERE table_schema = :schema"
+        " ORDER BY table_name, column_name"), {"schema": schema}).all()
+    indexes = connection.execute(text(
+        "SELECT tablename, indexname, replace(indexdef, :prefix, '')"
+        " FROM pg_indexes WHERE schemaname = :schema ORDER BY indexname"),
+        {"schema": schema, "prefix": f"{schema}."}).all()
+    constraints = connection.execute(text(
+        "SELECT rel.relname, con.contype, pg_get_constraintdef(con.oid)"
+        " FROM pg_constraint con JOIN pg_class rel ON rel.oid = con.conrelid"
+        " JOIN pg_namespace ns ON ns.oid = rel.relnamespace"
+        " WHERE ns.nspname = :schema ORDER BY 1, 2, 3"), {"schema": schema}).all()
+
+    return {"columns": columns, "indexes": indexes, "constraints": constraints}
+
+
+class MigrationsTestCase(unittest.TestCase):
+    """Test that the migrations bring a database made before them up to
+    date with models.py."""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+        self.connection = db.engine.connect()
+        self.addCleanup(self.connection.close)
+        self.addCleanup(self.drop_schemas)
+        self.drop_schemas()
+
+    def drop_schemas(self):
+        self.connection.rollback()
+        self.connection.exec_driver_sql("RESET search_path")
+        for schema in ("migrated", "fresh"):
+            self.connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        self.connection.commit()
+
+    def use_schema(self, schema):
+        self.connection.exec_driver_sql(f"CREATE SCHEMA {schema}")
+        self.connection.exec_driver_sql(f"SET search_path TO {schema}")
+
+    def test_migrations_match_models(self):
+        self.use_schema("migrated")
+        with open(os.path.join(MIGRATIONS_DIR, "0000_initial.sql")) as f:
+            self.connection.exec_driver_sql(f.read())
+        self.connection.exec_driver_sql(
+            "INSERT INTO users (username, email, password) VALUES ('u', 'u@test.com', 'x');"
+            "INSERT INTO pools (owner_username, rate, size, description, city,"
+            " orig_image_url, small_image_url)"
+            " VALUES ('u', 100, '1000 sqft', 'Heated pool', 'Test City', '', '');"
+            "INSERT INTO reservations (booked_username, pool_id, reservation_date_created,"
+            " start_date, end_date)"
+            " VALUES ('u', 1, now(), '2023-02-04 14:00', '2023-02-04 18:00');")
+
+        # as `flask upgrade-db` does, twice to check the scripts can be rerun
+        for _ in range(2):
+            apply_migrations(self.connection)
+            db.metadata.create_all(self.connection)
+        migrated = read_schema(self.connection, "migrated")
+
+        # existing rows get the generated columns
+        self.assertEqual(self.connection.exec_driver_sql(
+            "SELECT count(*) FROM pools WHERE search_vector @@ to_tsquery('heated')").scalar(), 1)
+        self.assertEqual(self.connection.exec_driver_sql(
+            "SELECT upper(period) FROM reservations").scalar().hour, 18)
+
+        self.use_schema("fresh")
+        db.metadata.create_all(self.connection)
+        fresh = read_schema(self.connection, "fresh")
+
+        for part in ("columns", "indexes", "constraints"):
+            self.assertEqual(migrated[part], fresh[part], part)
+
+
+if __name__ == "__main__":
+    unittest.main()
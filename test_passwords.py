@@ -0,0 +1,49 @@
+import threading
+import unittest
+
+from passwords import PasswordHasher, PasswordHasherBusy, bcrypt
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def test_hash_and_check(self):
+        hasher = PasswordHasher(rounds=4, threads=1, queue_depth=0)
+
+        pw_hash = hasher.hash("password")
+
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(hasher.check(pw_hash, "password"))
+        self.assertFalse(hasher.check(pw_hash, "wrong_password"))
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(rounds=5)
+
+        self.assertTrue(hasher.needs_rehash(
+            bcrypt.generate_password_hash("password", 4).decode()))
+        self.assertFalse(hasher.needs_rehash(
+            bcrypt.generate_password_hash("password", 5).decode()))
+        self.assertTrue(hasher.needs_rehash("not a bcrypt hash"))
+
+    def test_busy_when_queue_full(self):
+        hasher = PasswordHasher(rounds=4, threads=1, queue_depth=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_hash(*args):
+            started.set()
+            release.wait(5)
+
+        # one hash running and one waiting fill both slots
+        running = [threading.Thread(target=hasher._run, args=(slow_hash,))
+                   for _ in range(2)]
+        for thread in running:
+            thread.start()
+        started.wait(5)
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("password")
+
+        release.set()
+        for thread in running:
+            thread.join()
+
+        self.assertTrue(hasher.check(hasher.hash("password"), "password"))
@@ -1,6 +1,8 @@
 import unittest
 from app import app
 from models import db, User, Pool
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
 
 class TestPoolModel(unittest.TestCase):
 
@@ -66,10 +68,43 @@ class TestPoolModel(unittest.TestCase):
             "description": "A lovely pool",
             "city": "Test City",
             "orig_image_url": "test_orig_image.jpg",
-            "small_image_url": "test_small_image.jpg"
+            "small_image_url": "test_small_image.jpg",
+            "image_status": None,
+            "image_renditions": None,
+            "image_width": None,
+            "image_height": None,
+            "image_placeholder": None,
+            "image_color": None,
+            "latitude": None,
+            "longitude": None,
         }
 
         self.assertEqual(serialized_data, expected_data)
 
+    def test_serialize_fields(self):
+        """Test that serialize(fields) only reads the columns it was asked for."""
+        user = self.create_test_user()
+        self.create_test_pool(user)
+        db.session.expunge_all()
+
+        fields = ["id", "rate", "city"]
+        pool = Pool.query.options(load_only(*Pool.load_only_columns(fields))).one()
+
+        self.assertEqual(pool.serialize(fields), {"id": pool.id, "rate": 100, "city": "Test City"})
+        self.assertIn("description", inspect(pool).unloaded)
+
+    def test_set_location(self):
+        """Test that set_location keeps the geohash in sync."""
+        user = self.create_test_user()
+        pool = self.create_test_pool(user)
+
+        pool.set_location(37.7749, -122.4194)
+        db.session.commit()
+        self.assertEqual(pool.geohash, "9q8yyk8yt")
+
+        pool.set_location(None, None)
+        db.session.commit()
+        self.assertIsNone(pool.geohash)
+
 if __name__ == "__main__":
     unittest.main()
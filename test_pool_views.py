@@ -1,14 +1,39 @@
 import unittest
+import hashlib
 import json
-from app import app
-from models import db, User, Pool
+import threading
+import uuid
+from app import app, response_cache, user_cache, revoked_tokens, rate_limiter, image_worker
+from models import db, User, Pool, PoolImage, Reservation, PoolFacet, ImageJob, StoredImage
+from image_jobs import enqueue_image_job, run_pending_jobs, MAX_ATTEMPTS
+from image_renditions import InvalidImageError
 from flask_jwt_extended import create_access_token
 from werkzeug.datastructures import FileStorage
 from unittest.mock import patch, MagicMock
 from io import BytesIO
 from PIL import Image
+import boto3
+import requests
+import tempfile
+from moto import mock_s3
+from api_helpers import BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES, staged_upload_size
+from storage import LocalStorageBackend, S3StorageBackend
+from test_helpers import make_jpeg
 
 
+IMAGE_INFO = {"width": 400, "height": 300, "placeholder": "data:image/webp;base64,AAAA",
+              "color": "#ff0000"}
+
+
+def fake_upload(file, filename):
+    return [f"https://example.com/{filename}", f"https://example.com/{filename}-small", [],
+            IMAGE_INFO]
+
+
+RENDITIONS = [
+    {"width": 320, "height": 240, "format": "jpeg", "url": "https://example.com/new-320w.jpg"},
+    {"width": 320, "height": 240, "format": "webp", "url": "https://example.com/new-320w.webp"},
+]
 
 
 class PoolViewsTestCase(unittest.TestCase):
@@ -17,6 +42,17 @@ class PoolViewsTestCase(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
         app.config['TESTING'] = True
         self.client = app.test_client()
+        response_cache.clear()
+        user_cache.clear()
+        revoked_tokens.clear()
+        rate_limiter.clear()
+
+        # uploads are staged in storage for the image jobs
+        staging = tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        patcher = patch("api_helpers.storage", LocalStorageBackend(staging.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         db.drop_all()
         db.create_all()
@@ -41,6 +77,190 @@ class PoolViewsTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue("pools" in data)
 
+    def test_list_pools_pagination(self):
+        for i in range(4):
+            db.session.add(Pool(owner_username="testuser", rate=100 + i, size="1000 sqft",
+                                description=f"Test pool {i}", city="Test City",
+                                orig_image_url="https://example.com/orig_image.jpg",
+                                small_image_url="https://example.com/small_image.jpg"))
+        db.session.commit()
+
+        response = self.client.get("/api/pools?limit=2")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([pool["id"] for pool in data["pools"]], [1, 2])
+        self.assertEqual(data["next_cursor"], 2)
+
+        response = self.client.get(f"/api/pools?limit=2&after={data['next_cursor']}")
+        data = json.loads(response.data)
+        self.assertEqual([pool["id"] for pool in data["pools"]], [3, 4])
+
+        response = self.client.get(f"/api/pools?limit=2&after={data['next_cursor']}")
+        data = json.loads(response.data)
+        self.assertEqual([pool["id"] for pool in data["pools"]], [5])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_list_pools_bad_cursor(self):
+        for after in ("abc", "²", "-1"):
+            response = self.client.get(f"/api/pools?after={after}")
+            self.assertEqual(response.status_code, 400, after)
+
+    def test_list_pools_fields(self):
+        response = self.client.get("/api/pools?fields=id,rate,city,small_image_url")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data["pools"][0]), {"id", "rate", "city", "small_image_url"})
+
+        response = self.client.get("/api/pools/search?sort=rate_asc&fields=id")
+        data = json.loads(response.data)
+        self.assertEqual(data["pools"], [{"id": 1}])
+
+        response = self.client.get("/api/pools?fields=id,password")
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_pools(self):
+        for rate, city, owner in [(50, "Test City", "testuser"), (150, "Test City", "testuser"),
+                                  (75, "Other City", "testuser")]:
+            db.session.add(Pool(owner_username=owner, rate=rate, size="1000 sqft",
+                                description="Test pool", city=city,
+                                orig_image_url="https://example.com/orig_image.jpg",
+                                small_image_url="https://example.com/small_image.jpg"))
+        db.session.commit()
+
+        response = self.client.get(
+            "/api/pools/search?city=Test%20City&min_rate=60&sort=rate_desc")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([float(pool["rate"]) for pool in data["pools"]], [150, 100])
+
+        response = self.client.get("/api/pools/search?sort=rate_asc&limit=2")
+        data = json.loads(response.data)
+        self.assertEqual([float(pool["rate"]) for pool in data["pools"]], [50, 75])
+
+        response = self.client.get(
+            f"/api/pools/search?sort=rate_asc&limit=2&after={data['next_cursor']}")
+        data = json.loads(response.data)
+        self.assertEqual([float(pool["rate"]) for pool in data["pools"]], [100, 150])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_search_pools_available(self):
+        pool = Pool(owner_username="testuser", rate=100, size="1000 sqft",
+                    description="Test pool", city="Test City",
+                    orig_image_url="https://example.com/orig_image.jpg",
+                    small_image_url="https://example.com/small_image.jpg")
+        db.session.add(pool)
+        db.session.commit()
+        db.session.add(Reservation(booked_username="testuser", pool_id=1,
+                                   start_date="2023-02-04T14:00:00",
+                                   end_date="2023-02-04T18:00:00"))
+        db.session.commit()
+
+        response = self.client.get(
+            "/api/pools/search?city=Test%20City"
+            "&available_from=2023-02-04T16:00:00&available_to=2023-02-04T20:00:00")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([pool["id"] for pool in data["pools"]], [2])
+
+        # back to back with the existing booking is fine
+        response = self.client.get(
+            "/api/pools/search?city=Test%20City"
+            "&available_from=2023-02-04T18:00:00&available_to=2023-02-04T20:00:00")
+        data = json.loads(response.data)
+        self.assertEqual(len(data["pools"]), 2)
+
+        response = self.client.get("/api/pools/search?available_from=2023-02-04T18:00:00")
+        self.assertEqual(response.status_code, 400)
+
+        # offsets are converted to UTC: 08:00-08:00 is 16:00 UTC
+        for window in ["available_from=2023-02-04T16:00:00Z&available_to=2023-02-04T20:00:00Z",
+                       "available_from=2023-02-04T08:00:00-08:00&available_to=2023-02-04T20:00:00"]:
+            response = self.client.get(f"/api/pools/search?city=Test%20City&{window}")
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200, window)
+            self.assertEqual([pool["id"] for pool in data["pools"]], [2], window)
+
+        response = self.client.get(
+            "/api/pools/search?available_from=2023-02-04T20:00:00Z"
+            "&available_to=2023-02-04T12:00:00-08:00")
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_pools_bad_sort(self):
+        response = self.client.get("/api/pools/search?sort=cheapest")
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_pools_bad_rate(self):
+        for rate in ["1e999999", "1e-999999", "NaN", "Infinity", "100000000", "10.005", "ten"]:
+            response = self.client.get(f"/api/pools/search?min_rate={rate}")
+            self.assertEqual(response.status_code, 400, rate)
+
+        response = self.client.get("/api/pools/search?sort=rate_asc&after=1e999999_1")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get("/api/pools/search?min_rate=99.50&max_rate=1e2")
+        data = json.loads(response.data)
+        self.assertEqual([float(pool["rate"]) for pool in data["pools"]], [100])
+
+    def test_text_search_pools(self):
+        for description in ["Heated saltwater pool", "Pool with a view", "Heated lap pool"]:
+            db.session.add(Pool(owner_username="testuser", rate=100, size="1000 sqft",
+                                description=description, city="Test City",
+                                orig_image_url="https://example.com/orig_image.jpg",
+                                small_image_url="https://example.com/small_image.jpg"))
+        db.session.commit()
+
+        response = self.client.get("/api/pools/search/text?q=heated")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data["pools"]), 2)
+
+        response = self.client.get("/api/pools/search/text?q=heated%20saltwater")
+        data = json.loads(response.data)
+        self.assertEqual([pool["description"] for pool in data["pools"]],
+                         ["Heated saltwater pool"])
+
+        response = self.client.get("/api/pools/search/text?q=pool&limit=2&page=2")
+        data = json.loads(response.data)
+        self.assertEqual(len(data["pools"]), 2)
+        self.assertIsNone(data["next_page"])
+
+    def test_search_pools_nearby(self):
+        # Ferry Building, Golden Gate Park (~7km away) and Oakland (~13km away)
+        for lat, lng in [(37.7955, -122.3937), (37.7694, -122.4862), (37.8044, -122.2712)]:
+            pool = Pool(owner_username="testuser", rate=100, size="1000 sqft",
+                        description="Test pool", city="San Francisco",
+                        orig_image_url="https://example.com/orig_image.jpg",
+                        small_image_url="https://example.com/small_image.jpg")
+            pool.set_location(lat, lng)
+            db.session.add(pool)
+        db.session.commit()
+
+        response = self.client.get("/api/pools/nearby?lat=37.7749&lng=-122.4194&radius_km=8")
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([pool["id"] for pool in data["pools"]], [2, 3])
+        self.assertLess(data["pools"][0]["distance_km"], data["pools"][1]["distance_km"])
+
+        response = self.client.get("/api/pools/nearby?lat=37.7749")
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_pools(self):
+        for i in range(150):
+            db.session.add(Pool(owner_username="testuser", rate=i, size="1000 sqft",
+                                description="Test pool", city="Test City",
+                                orig_image_url="https://example.com/orig_image.jpg",
+                                small_image_url="https://example.com/small_image.jpg"))
+        db.session.commit()
+
+        response = self.client.get("/api/export/pools?fields=id,rate")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+
+        lines = response.data.decode().splitlines()
+        self.assertEqual(len(lines), 151)
+        self.assertEqual(json.loads(lines[0]), {"id": 1, "rate": "100.00"})
+        self.assertEqual(json.loads(lines[-1])["id"], 151)
+
     def test_show_pool_by_id(self):
         # Replace 1 with the test pool ID if needed
         response = self.client.get("/api/pools/1")
@@ -96,8 +316,287 @@ class PoolViewsTestCase(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(response.status_code, 201)
         self.assertTrue("pool" in data)
+        self.assertEqual(data["pool"]["image_status"], "pending")
+
+    @patch('image_jobs.upload_to_aws', return_value=['https://example.com/orig_new.jpg', 'https://example.com/small_new.jpg', RENDITIONS, IMAGE_INFO])
+    def test_create_pool_image_job(self, mock_upload):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+        image_data = make_jpeg()
+
+        response = self.client.post(
+            "/api/pools",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={
+                "file": (BytesIO(image_data), "test_file.jpg"),
+                "rate": 200,
+                "size": "2000 sqft",
+                "description": "Test pool 2",
+                "city": "Test City 2"
+            },
+        )
+        pool_id = json.loads(response.data)["pool"]["id"]
+        mock_upload.assert_not_called()
+        # the upload waits in storage, not in the job row
+        self.assertEqual(staged_upload_size(ImageJob.query.one().source_key), len(image_data))
+
+        # Cached while the image is still pending
+        self.client.get(f"/api/pools/{pool_id}")
+
+        self.assertEqual(run_pending_jobs(image_worker.on_pool_updated), 1)
+        self.assertEqual(mock_upload.call_args[0][0].read(), image_data)
+
+        response = self.client.get(f"/api/pools/{pool_id}")
+        pool = json.loads(response.data)["pool"]
+        self.assertEqual(pool["image_status"], "ready")
+        self.assertEqual(pool["orig_image_url"], "https://example.com/orig_new.jpg")
+        self.assertEqual(pool["small_image_url"], "https://example.com/small_new.jpg")
+        self.assertEqual(pool["image_renditions"], RENDITIONS)
+        self.assertEqual(
+            [pool["image_width"], pool["image_height"], pool["image_placeholder"], pool["image_color"]],
+            [400, 300, "data:image/webp;base64,AAAA", "#ff0000"])
+
+        job = ImageJob.query.one()
+        self.assertEqual(job.status, "done")
+        self.assertIsNone(staged_upload_size(job.source_key))
+
+    @patch('image_jobs.upload_to_aws', return_value=['https://example.com/orig_new.jpg', 'https://example.com/small_new.jpg', RENDITIONS, IMAGE_INFO])
+    def test_duplicate_image_uploaded_once(self, mock_upload):
+        pool2 = Pool(owner_username="testuser", rate=100, size="1000 sqft", description="Test pool 2",
+                     city="Test City", orig_image_url="", small_image_url="")
+        db.session.add(pool2)
+        db.session.commit()
+
+        enqueue_image_job(BytesIO(b"same image"), pool_id=1)
+        enqueue_image_job(BytesIO(b"same image"), pool_id=pool2.id)
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), 2)
+        self.assertEqual(mock_upload.call_count, 1)
+
+        content_hash = hashlib.sha256(b"same image").hexdigest()
+        self.assertEqual(mock_upload.call_args.kwargs["filename"], content_hash)
+        self.assertEqual(db.session.get(StoredImage, content_hash).orig_image_url,
+                         "https://example.com/orig_new.jpg")
+
+        for pool in (db.session.get(Pool, 1), db.session.get(Pool, pool2.id)):
+            self.assertEqual(pool.orig_image_url, "https://example.com/orig_new.jpg")
+            self.assertEqual(pool.image_renditions, RENDITIONS)
+            self.assertEqual(pool.image_status, "ready")
+
+    def test_create_pool_not_an_image(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = self.client.post(
+            "/api/pools",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={
+                "file": (BytesIO(b"not an image"), "test_file.jpg"),
+                "rate": 200,
+                "size": "2000 sqft",
+                "description": "Test pool 2",
+                "city": "Test City 2"
+            },
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Pool.query.count(), 1)
+        self.assertEqual(ImageJob.query.count(), 0)
+
+    @patch.dict(app.config, {"MAX_CONTENT_LENGTH": 1024})
+    def test_create_pool_upload_too_large(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = self.client.post(
+            "/api/pools",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={
+                "file": (BytesIO(b"x" * 4096), "test_file.jpg"),
+                "rate": 200,
+                "size": "2000 sqft",
+                "description": "Test pool 2",
+                "city": "Test City 2"
+            },
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("error", json.loads(response.data))
+        self.assertEqual(Pool.query.count(), 1)
+
+    @patch('image_jobs.store_image', side_effect=InvalidImageError("image is too large"))
+    def test_image_job_invalid_image_not_retried(self, _):
+        enqueue_image_job(BytesIO(b"huge image"), pool_id=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), 1)
+
+        job = ImageJob.query.one()
+        self.assertEqual((job.status, job.attempts), ("failed", 1))
+        self.assertEqual(db.session.get(Pool, 1).image_status, "failed")
+
+    @patch('image_jobs.upload_to_aws', side_effect=fake_upload)
+    def test_add_pool_images(self, mock_upload):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+        red, blue = make_jpeg(), make_jpeg(color="blue")
+
+        response = self.client.post(
+            "/api/pools/1/images",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={"file": [(BytesIO(red), "1.jpg"), (BytesIO(blue), "2.jpg"), (BytesIO(red), "3.jpg")]},
+        )
+
+        self.assertEqual(response.status_code, 201)
+        pool_images = json.loads(response.data)["pool_images"]
+        self.assertEqual(
+            [image["image_url"] for image in pool_images],
+            [f"https://example.com/{hashlib.sha256(data).hexdigest()}" for data in (red, blue, red)])
+        self.assertEqual({image["pool_id"] for image in pool_images}, {1})
+        self.assertEqual({(image["image_width"], image["image_color"]) for image in pool_images},
+                         {(400, "#ff0000")})
+        self.assertEqual(PoolImage.query.count(), 3)
+        # the repeated image is resized and uploaded once
+        self.assertEqual(mock_upload.call_count, 2)
+
+    def test_add_pool_images_concurrent(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        # only gets past the barrier if both images are processed at once
+        barrier = threading.Barrier(2, timeout=5)
+
+        def upload(file, filename):
+            barrier.wait()
+            return fake_upload(file, filename)
+
+        with patch('image_jobs.upload_to_aws', side_effect=upload):
+            response = self.client.post(
+                "/api/pools/1/images",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={"file": [(BytesIO(make_jpeg()), "1.jpg"), (BytesIO(make_jpeg(color="blue")), "2.jpg")]},
+            )
+
+        self.assertEqual(response.status_code, 201)
+
+    @patch('image_jobs.upload_to_aws', side_effect=fake_upload)
+    def test_add_pool_image_single(self, _):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = self.client.post(
+            "/api/pools/1/images",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={"file": (BytesIO(make_jpeg()), "1.jpg")},
+        )
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data["pool_image"], data["pool_images"][0])
+
+    @patch('image_jobs.upload_to_aws', side_effect=fake_upload)
+    def test_add_pool_images_body_limit(self, _):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+        files = [make_jpeg(color=color) for color in ("red", "blue", "green")]
+        one_file = max(len(data) for data in files) + 1024
+
+        # the gallery may carry more than one file's worth...
+        with patch.dict(app.config, {"MAX_CONTENT_LENGTH": one_file,
+                                     "MAX_GALLERY_CONTENT_LENGTH": 3 * one_file}):
+            response = self.client.post(
+                "/api/pools/1/images",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={"file": [(BytesIO(data), f"{i}.jpg") for i, data in enumerate(files)]},
+            )
+            self.assertEqual(response.status_code, 201)
+
+            # ...but other endpoints may not
+            response = self.client.post(
+                "/api/pools",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={"file": [(BytesIO(data), f"{i}.jpg") for i, data in enumerate(files)],
+                      "rate": 200, "size": "2000 sqft", "description": "Test pool 2",
+                      "city": "Test City 2"},
+            )
+            self.assertEqual(response.status_code, 413)
+
+        with patch.dict(app.config, {"MAX_GALLERY_CONTENT_LENGTH": one_file}):
+            response = self.client.post(
+                "/api/pools/1/images",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={"file": [(BytesIO(data), f"{i}.jpg") for i, data in enumerate(files)]},
+            )
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(json.loads(response.data)["error"],
+                             f"request is larger than {one_file} bytes")
+
+        # each file is still held to MAX_UPLOAD_SIZE
+        with patch("app.MAX_UPLOAD_SIZE", one_file - 1024):
+            response = self.client.post(
+                "/api/pools/1/images",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={"file": (BytesIO(files[0] + b"x" * 2048), "big.jpg")},
+            )
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(json.loads(response.data)["error"],
+                             f"upload is larger than {one_file - 1024} bytes")
+
+    def test_add_pool_images_too_many(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = self.client.post(
+            "/api/pools/1/images",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={"file": [(BytesIO(make_jpeg()), f"{i}.jpg") for i in range(21)]},
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    @patch('image_jobs.upload_to_aws', side_effect=[RuntimeError("s3 down"), fake_upload(BytesIO(), "x")])
+    def test_add_pool_images_all_or_nothing(self, _):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        response = self.client.post(
+            "/api/pools/1/images",
+            content_type='multipart/form-data',
+            headers=headers,
+            data={"file": [(BytesIO(make_jpeg()), "1.jpg"), (BytesIO(make_jpeg(color="blue")), "2.jpg")]},
+        )
+
+        self.assertEqual(response.status_code, 424)
+        self.assertEqual(PoolImage.query.count(), 0)
+        self.assertEqual(StoredImage.query.count(), 0)
+
+    @patch('image_jobs.upload_to_aws', side_effect=RuntimeError("s3 down"))
+    def test_image_job_retries_then_fails(self, mock_upload):
+        pool = db.session.get(Pool, 1)
+        pool.image_status = "pending"
+        enqueue_image_job(BytesIO(b"image bytes"), pool_id=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), MAX_ATTEMPTS)
+        self.assertEqual(mock_upload.call_count, MAX_ATTEMPTS)
+
+        job = ImageJob.query.one()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "s3 down")
+        self.assertEqual(db.session.get(Pool, 1).image_status, "failed")
 
-        
     def test_update_pool(self):
         access_token = create_access_token(identity="testuser")
         headers = {"Authorization": f"Bearer {access_token}"}
@@ -118,6 +617,96 @@ class PoolViewsTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue("pool" in data)
 
+    def test_update_pool_bad_coordinates(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        for latitude, longitude in (("north", "west"), (500, 0), ("nan", 0)):
+            response = self.client.patch(
+                "/api/pools/1",
+                json={"latitude": latitude, "longitude": longitude},
+                headers=headers,
+            )
+            self.assertEqual(response.status_code, 400, latitude)
+
+        self.assertIsNone(db.session.get(Pool, 1).latitude)
+
+    def test_create_pool_bad_coordinates(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        for latitude, longitude in (("north", "west"), ("500", "0"), ("nan", "0")):
+            response = self.client.post(
+                "/api/pools",
+                content_type='multipart/form-data',
+                headers=headers,
+                data={
+                    "file": (BytesIO(make_jpeg()), "test_file.jpg"),
+                    "rate": 200,
+                    "size": "2000 sqft",
+                    "description": "Test pool 2",
+                    "city": "Test City 2",
+                    "latitude": latitude,
+                    "longitude": longitude,
+                },
+            )
+            self.assertEqual(response.status_code, 400, latitude)
+
+        self.assertEqual(Pool.query.count(), 1)
+
+    def test_pool_cache_invalidated_on_update(self):
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        self.client.get("/api/pools/1")
+        self.client.get("/api/pools")
+
+        self.client.patch(
+            "/api/pools/1",
+            json={"rate": 150, "size": "1500 sqft",
+                  "description": "Updated test pool", "address": "Updated"},
+            headers=headers,
+        )
+
+        data = json.loads(self.client.get("/api/pools/1").data)
+        self.assertEqual(data["pool"]["description"], "Updated test pool")
+        data = json.loads(self.client.get("/api/pools").data)
+        self.assertEqual(data["pools"][0]["description"], "Updated test pool")
+
+    def test_upgrade_db_fills_empty_pool_facets(self):
+        result = app.test_cli_runner().invoke(args=["upgrade-db"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        data = json.loads(self.client.get("/api/pools/facets").data)
+        self.assertEqual(data["facets"]["cities"], [{"city": "Test City", "count": 1}])
+
+    def test_pool_facets(self):
+        PoolFacet.rebuild()
+        db.session.commit()
+
+        data = json.loads(self.client.get("/api/pools/facets").data)
+        self.assertEqual(data["facets"]["cities"], [{"city": "Test City", "count": 1}])
+        self.assertEqual(data["facets"]["rates"],
+                         [{"min_rate": "100", "max_rate": "110", "count": 1}])
+
+        access_token = create_access_token(identity="testuser")
+        headers = {"Authorization": f"Bearer {access_token}"}
+        self.client.patch(
+            "/api/pools/1",
+            json={"rate": 155, "size": "1500 sqft",
+                  "description": "Updated test pool", "address": "Updated"},
+            headers=headers,
+        )
+
+        data = json.loads(self.client.get("/api/pools/facets").data)
+        self.assertEqual(data["facets"]["rates"],
+                         [{"min_rate": "150", "max_rate": "160", "count": 1}])
+
+        self.client.delete("/api/pools/1", headers=headers)
+
+        data = json.loads(self.client.get("/api/pools/facets").data)
+        self.assertEqual(data["facets"], {"cities": [], "rates": []})
+
     def test_delete_pool(self):
         access_token = create_access_token(identity="testuser")
         headers = {"Authorization": f"Bearer {access_token}"}
@@ -128,5 +717,148 @@ class PoolViewsTestCase(unittest.TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+
+
+@mock_s3
+class PoolUploadViewsTestCase(unittest.TestCase):
+    """ Direct-to-S3 uploads, against moto's S3 """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        response_cache.clear()
+        user_cache.clear()
+        revoked_tokens.clear()
+        rate_limiter.clear()
+
+        db.drop_all()
+        db.create_all()
+
+        self.s3 = boto3.client("s3", region_name="us-west-1")
+        for bucket in (BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES):
+            self.s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "us-west-1"})
+        patcher = patch("api_helpers.storage", S3StorageBackend(client=self.s3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.signup("testuser", "test@example.com", "testpassword", "Test City")
+        other = User.signup("otheruser", "other@example.com", "testpassword", "Test City")
+        db.session.add_all([user, other])
+        db.session.commit()
+
+        pool = Pool(owner_username="testuser", rate=100, size="1000 sqft", description="Test pool", city="Test City",
+                    orig_image_url="", small_image_url="")
+        db.session.add(pool)
+        db.session.commit()
+
+        self.headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def upload(self, data, gallery=False):
+        """ Runs the client side of an upload; returns the complete response """
+
+        response = self.client.post("/api/pools/1/uploads", headers=self.headers,
+                                    json={"content_type": "image/jpeg"})
+        self.assertEqual(response.status_code, 201)
+        upload = json.loads(response.data)["upload"]
+
+        s3_response = requests.post(upload["url"], data=upload["fields"],
+                                    files={"file": ("pool.jpg", data)})
+        self.assertLess(s3_response.status_code, 300)
+
+        return self.client.post("/api/pools/1/uploads/complete", headers=self.headers,
+                                json={"key": upload["key"], "gallery": gallery})
+
+    def test_create_pool_upload(self):
+        response = self.client.post("/api/pools/1/uploads", headers=self.headers)
+        upload = json.loads(response.data)["upload"]
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(upload["key"].startswith("uploads/1/"))
+        self.assertEqual(upload["fields"]["key"], upload["key"])
+        self.assertEqual(upload["fields"]["Content-Type"], "image/jpeg")
+
+    def test_create_pool_upload_bad_content_type(self):
+        response = self.client.post("/api/pools/1/uploads", headers=self.headers,
+                                    json={"content_type": "text/html"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_create_pool_upload_not_owner(self):
+        headers = {"Authorization": f"Bearer {create_access_token(identity='otheruser')}"}
+        response = self.client.post("/api/pools/1/uploads", headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_complete_pool_upload(self):
+        data = make_jpeg(800, 600, "blue")
+
+        response = self.upload(data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)["pool"]["image_status"], "pending")
+        key = ImageJob.query.one().source_key
+
+        self.assertEqual(run_pending_jobs(), 1)
+
+        pool = db.session.get(Pool, 1)
+        content_hash = hashlib.sha256(data).hexdigest()
+        self.assertEqual(pool.image_status, "ready")
+        self.assertTrue(pool.orig_image_url.endswith(f"/{content_hash}"))
+        self.assertEqual([r["width"] for r in pool.image_renditions], [320, 320, 640, 640, 800, 800])
+        self.assertEqual((pool.image_width, pool.image_height, pool.image_color),
+                         (800, 600, "#0000fe"))
+        self.assertTrue(pool.image_placeholder.startswith("data:image/webp;base64,"))
+
+        stored = self.s3.get_object(Bucket=BUCKET_NAME_LARGE_IMAGES, Key=content_hash)
+        self.assertEqual(stored["Body"].read(), data)
+        # the staged copy is gone
+        self.assertEqual(self.s3.list_objects_v2(
+            Bucket=BUCKET_NAME_LARGE_IMAGES, Prefix="uploads/")["KeyCount"], 0)
+
+        response = self.client.post("/api/pools/1/uploads/complete", headers=self.headers,
+                                    json={"key": key})
+        self.assertEqual(response.status_code, 400)
+
+    def test_complete_pool_upload_gallery(self):
+        response = self.upload(make_jpeg(800, 600, "blue"), gallery=True)
+        pool_image = json.loads(response.data)["pool_image"]
+        self.assertEqual(pool_image["pool_id"], 1)
+        self.assertEqual(pool_image["image_status"], "pending")
+
+        run_pending_jobs()
+
+        pool_image = db.session.get(PoolImage, pool_image["id"])
+        self.assertEqual(pool_image.image_status, "ready")
+        self.assertTrue(pool_image.image_url.startswith("https://"))
+        self.assertIsNone(db.session.get(Pool, 1).image_status)
+
+    def test_complete_pool_upload_twice(self):
+        response = self.client.post("/api/pools/1/uploads", headers=self.headers)
+        upload = json.loads(response.data)["upload"]
+        requests.post(upload["url"], data=upload["fields"],
+                      files={"file": ("pool.jpg", make_jpeg(800, 600, "blue"))})
+
+        for status in (201, 409):
+            response = self.client.post("/api/pools/1/uploads/complete", headers=self.headers,
+                                        json={"key": upload["key"]})
+            self.assertEqual(response.status_code, status)
+
+    def test_complete_pool_upload_bad_key(self):
+        other_upload = f"uploads/2/{uuid.uuid4()}"
+        for key in (None, "uploads/2/abc", "some-other-object", other_upload,
+                    f"uploads/1/../../{other_upload}", "uploads/1/abc"):
+            response = self.client.post("/api/pools/1/uploads/complete", headers=self.headers,
+                                        json={"key": key})
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post("/api/pools/1/uploads/complete", headers=self.headers,
+                                    json={"key": f"uploads/1/{uuid.uuid4()}"})
+        self.assertEqual(response.status_code, 400)
+
+
 if __name__ == "__main__":
     unittest.main()
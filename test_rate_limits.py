@@ -0,0 +1,162 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from app import app, rate_limiter
+from models import db, User
+from rate_limits import (MemoryRateLimitBackend, SqliteRateLimitBackend,
+                         make_rate_limit_backend)
+
+
+class RateLimitBackendTests:
+    """Tests shared by every rate limit backend; mixed into a TestCase below."""
+
+    def test_token_bucket(self):
+        for _ in range(3):
+            self.assertEqual(self.limits.take("ip:1", rate=10, burst=3), 0)
+
+        retry_after = self.limits.take("ip:1", rate=10, burst=3)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.1)
+        # other keys have their own bucket
+        self.assertEqual(self.limits.take("ip:2", rate=10, burst=3), 0)
+
+        time.sleep(0.15)
+        self.assertEqual(self.limits.take("ip:1", rate=10, burst=3), 0)
+
+    def test_slots(self):
+        first = self.limits.acquire("route:login", limit=2, lease=30)
+        second = self.limits.acquire("route:login", limit=2, lease=30)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.limits.acquire("route:login", limit=2, lease=30))
+        self.assertIsNotNone(self.limits.acquire("route:signup", limit=2, lease=30))
+
+        self.limits.release("route:login", first)
+        self.assertIsNotNone(self.limits.acquire("route:login", limit=2, lease=30))
+
+    def test_slot_lease_expires(self):
+        self.limits.acquire("route:login", limit=1, lease=0.05)
+        self.assertIsNone(self.limits.acquire("route:login", limit=1, lease=0.05))
+
+        time.sleep(0.1)
+        self.assertIsNotNone(self.limits.acquire("route:login", limit=1, lease=0.05))
+
+
+class MemoryRateLimitBackendTestCase(RateLimitBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.limits = MemoryRateLimitBackend()
+
+
+class SqliteRateLimitBackendTestCase(RateLimitBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "limits.db")
+        self.limits = SqliteRateLimitBackend(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared_between_instances(self):
+        other = SqliteRateLimitBackend(self.path)
+
+        self.assertEqual(self.limits.take("ip:1", rate=1, burst=1), 0)
+        self.assertGreater(other.take("ip:1", rate=1, burst=1), 0)
+
+        slot_id = other.acquire("route:login", limit=1, lease=30)
+        self.assertIsNone(self.limits.acquire("route:login", limit=1, lease=30))
+        other.release("route:login", slot_id)
+        self.assertIsNotNone(self.limits.acquire("route:login", limit=1, lease=30))
+
+
+class MakeRateLimitBackendTestCase(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            make_rate_limit_backend("redis://localhost")
+
+    @unittest.skipIf("RATE_LIMIT_BACKEND" in os.environ, "RATE_LIMIT_BACKEND is set")
+    def test_app_default_shared_between_workers(self):
+        self.assertIsInstance(rate_limiter, SqliteRateLimitBackend)
+        self.assertEqual(os.path.dirname(rate_limiter.path), tempfile.gettempdir())
+
+
+class AdmissionControlViewsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        db.drop_all()
+        db.create_all()
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+
+        rate_limiter.clear()
+        self.addCleanup(rate_limiter.clear)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username="testuser", ip="10.0.0.1"):
+        return self.client.post(
+            "/api/auth/login",
+            json={"username": username, "password": "wrong_password"},
+            environ_base={"REMOTE_ADDR": ip})
+
+    def test_ip_limit(self):
+        with patch.dict(app.config, {"AUTH_IP_BURST": 2, "AUTH_IP_RATE": 0.01}):
+            self.assertEqual(self.login("a").status_code, 401)
+            self.assertEqual(self.login("b").status_code, 401)
+
+            response = self.login("c")
+            self.assertEqual(response.status_code, 429)
+            self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+
+            self.assertEqual(self.login("d", ip="10.0.0.2").status_code, 401)
+
+    def test_username_limit(self):
+        with patch.dict(app.config, {"AUTH_USERNAME_BURST": 2}):
+            self.assertEqual(self.login(ip="10.0.0.1").status_code, 401)
+            self.assertEqual(self.login(ip="10.0.0.2").status_code, 401)
+            self.assertEqual(self.login(ip="10.0.0.3").status_code, 429)
+
+    def test_concurrency_limit(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_authenticate(username, password):
+            started.set()
+            release.wait(5)
+            return False
+
+        with patch.dict(app.config, {"AUTH_CONCURRENCY": 1}), \
+                patch("app.User.authenticate", side_effect=slow_authenticate):
+            first = threading.Thread(target=lambda: app.test_client().post(
+                "/api/auth/login", json={"username": "a", "password": "x"}))
+            first.start()
+            started.wait(5)
+
+            response = self.login("b")
+            release.set()
+            first.join()
+
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            self.assertEqual(self.login("c").status_code, 401)
+
+    def test_trusted_proxy(self):
+        with patch.dict(app.config, {"AUTH_IP_BURST": 1, "AUTH_IP_RATE": 0.01,
+                                     "TRUSTED_PROXIES": 1}):
+            for client in ("1.1.1.1", "2.2.2.2"):
+                response = self.client.post(
+                    "/api/auth/login",
+                    json={"username": client, "password": "x"},
+                    headers={"X-Forwarded-For": f"9.9.9.9, {client}"})
+                self.assertEqual(response.status_code, 401)
@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_s3
+from PIL import Image
+
+from app import app
+from models import db, User, Pool, PoolImage, StoredImage
+from api_helpers import BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES, image_url
+from rethumbnail import Checkpoint, rethumbnail_bucket
+from storage import S3StorageBackend
+from test_helpers import make_jpeg
+
+
+@mock_s3
+class RethumbnailTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        db.drop_all()
+        db.create_all()
+
+        self.s3 = boto3.client("s3", region_name="us-west-1")
+        for bucket in (BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES):
+            self.s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "us-west-1"})
+        patcher = patch("api_helpers.storage", S3StorageBackend(client=self.s3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # five originals with stale 140px thumbnails, plus a staged upload
+        self.keys = [f"image-{i}" for i in range(5)]
+        for key in self.keys:
+            self.s3.put_object(Bucket=BUCKET_NAME_LARGE_IMAGES, Key=key,
+                               Body=make_jpeg(700, 350, "green"))
+        self.s3.put_object(Bucket=BUCKET_NAME_LARGE_IMAGES, Key="uploads/1/staged",
+                           Body=b"not an image")
+
+        db.session.add(User.signup("testuser", "test@example.com", "testpassword", "Test City"))
+        db.session.commit()
+        for key in ("image-1", "image-4"):
+            db.session.add(Pool(owner_username="testuser", rate=100, size="1000 sqft",
+                                description="Test pool", city="Test City",
+                                orig_image_url=image_url(BUCKET_NAME_LARGE_IMAGES, key),
+                                small_image_url="https://example.com/old-140px.jpg"))
+        db.session.add(PoolImage(pool_owner="testuser",
+                                 image_url=image_url(BUCKET_NAME_LARGE_IMAGES, "image-3")))
+        db.session.add(StoredImage(content_hash="image-2",
+                                   orig_image_url=image_url(BUCKET_NAME_LARGE_IMAGES, "image-2"),
+                                   small_image_url="https://example.com/old-140px.jpg",
+                                   image_renditions=[]))
+        db.session.commit()
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.checkpoint_path = os.path.join(tmp_dir.name, "checkpoint.json")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def small_keys(self):
+        objects = self.s3.list_objects_v2(Bucket=BUCKET_NAME_SMALL_IMAGES).get("Contents", [])
+        return {obj["Key"] for obj in objects}
+
+    def test_rethumbnail_bucket(self):
+        checkpoint = rethumbnail_bucket(Checkpoint(self.checkpoint_path), workers=2,
+                                        batch_size=2, log=lambda message: None)
+
+        self.assertEqual(checkpoint.done, 5)
+        self.assertEqual(checkpoint.failed, [])
+        self.assertEqual(checkpoint.after, "image-4")
+
+        for key in self.keys:
+            self.assertIn(f"{key}-small", self.small_keys())
+        small = self.s3.get_object(Bucket=BUCKET_NAME_SMALL_IMAGES, Key="image-1-small")
+        self.assertEqual(Image.open(small["Body"]).size, (560, 280))
+
+        pool = Pool.query.filter(Pool.orig_image_url.endswith("image-1")).one()
+        self.assertEqual(pool.small_image_url, image_url(BUCKET_NAME_SMALL_IMAGES, "image-1-small"))
+        self.assertEqual([r["width"] for r in pool.image_renditions], [320, 320, 640, 640, 700, 700])
+        self.assertEqual((pool.image_width, pool.image_height), (700, 350))
+        self.assertIsNotNone(pool.image_placeholder)
+
+        pool_image = PoolImage.query.one()
+        self.assertEqual((pool_image.image_width, pool_image.image_height), (700, 350))
+
+        stored = db.session.get(StoredImage, "image-2")
+        self.assertEqual(stored.small_image_url, image_url(BUCKET_NAME_SMALL_IMAGES, "image-2-small"))
+        self.assertEqual(stored.image_info["width"], 700)
+
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(json.load(f)["after"], "image-4")
+
+    def test_rethumbnail_bucket_resumes_after_crash(self):
+        with patch("rethumbnail.update_image_urls", side_effect=[None, RuntimeError("crash")]):
+            with self.assertRaises(RuntimeError):
+                rethumbnail_bucket(Checkpoint(self.checkpoint_path), workers=1,
+                                   batch_size=2, log=lambda message: None)
+
+        checkpoint = Checkpoint(self.checkpoint_path)
+        self.assertEqual(checkpoint.after, "image-1")
+        self.assertEqual(checkpoint.done, 2)
+
+        with patch("rethumbnail.read_original", wraps=lambda key: make_jpeg(700, 350, "green")) as read:
+            checkpoint = rethumbnail_bucket(checkpoint, workers=1, batch_size=2,
+                                            log=lambda message: None)
+
+        self.assertEqual(sorted(call.args[0] for call in read.call_args_list),
+                         ["image-2", "image-3", "image-4"])
+        self.assertEqual(checkpoint.done, 5)
+
+        pool = Pool.query.filter(Pool.orig_image_url.endswith("image-4")).one()
+        self.assertEqual(pool.small_image_url, image_url(BUCKET_NAME_SMALL_IMAGES, "image-4-small"))
+
+    def test_rethumbnail_bucket_records_failures(self):
+        self.s3.put_object(Bucket=BUCKET_NAME_LARGE_IMAGES, Key="image-2", Body=b"corrupt")
+
+        checkpoint = rethumbnail_bucket(Checkpoint(self.checkpoint_path), workers=1,
+                                        batch_size=10, log=lambda message: None)
+
+        self.assertEqual(checkpoint.failed, ["image-2"])
+        self.assertEqual(checkpoint.done, 4)
+        self.assertEqual(db.session.get(StoredImage, "image-2").small_image_url,
+                         "https://example.com/old-140px.jpg")
@@ -0,0 +1,103 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app
+from api_helpers import (upload_to_aws, read_original, list_originals,
+                         BUCKET_NAME_LARGE_IMAGES, BUCKET_NAME_SMALL_IMAGES)
+from storage import LocalStorageBackend, S3StorageBackend, make_storage_backend
+from test_helpers import make_jpeg
+
+
+class LocalStorageBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.storage = LocalStorageBackend(self.root, base_url="http://localhost:5000/media")
+
+    def test_put_get_delete(self):
+        self.storage.put(io.BytesIO(b"image bytes"), "bucket", "uploads/1/a")
+
+        self.assertEqual(self.storage.get("bucket", "uploads/1/a"), b"image bytes")
+        self.assertEqual(self.storage.size("bucket", "uploads/1/a"), 11)
+        self.assertEqual(self.storage.base_url("bucket"), "http://localhost:5000/media/bucket/")
+
+        self.storage.delete("bucket", "uploads/1/a")
+        self.assertIsNone(self.storage.size("bucket", "uploads/1/a"))
+        self.storage.delete("bucket", "uploads/1/a")
+
+    def test_list_keys(self):
+        for key in ("b", "a", "uploads/1/c"):
+            self.storage.put(io.BytesIO(b"x"), "bucket", key)
+
+        self.assertEqual(list(self.storage.list_keys("bucket")), ["a", "b", "uploads/1/c"])
+        self.assertEqual(list(self.storage.list_keys("bucket", start_after="a")),
+                         ["b", "uploads/1/c"])
+
+    def test_key_outside_bucket(self):
+        with self.assertRaises(ValueError):
+            self.storage.put(io.BytesIO(b"x"), "bucket", "../other/a")
+
+    def test_no_presigned_uploads(self):
+        with self.assertRaises(NotImplementedError):
+            self.storage.presigned_post("bucket", "a", "image/jpeg", 100, 60)
+
+    def test_image_pipeline(self):
+        with patch("api_helpers.storage", self.storage):
+            data = make_jpeg(600, 400, "blue")
+            orig_url, small_url, renditions, _ = upload_to_aws(io.BytesIO(data), filename="img")
+
+            self.assertEqual(orig_url, f"http://localhost:5000/media/{BUCKET_NAME_LARGE_IMAGES}/img")
+            self.assertEqual(read_original("img"), data)
+            self.assertEqual(list(list_originals()), ["img"])
+
+        small = Image.open(os.path.join(self.root, BUCKET_NAME_SMALL_IMAGES, "img-small"))
+        self.assertEqual(small.height, 280)
+        self.assertEqual(len(renditions), 4)
+
+    def test_serve_local_image(self):
+        self.storage.put(io.BytesIO(b"image bytes"), BUCKET_NAME_LARGE_IMAGES, "img")
+        client = app.test_client()
+
+        with patch("api_helpers.storage", self.storage):
+            response = client.get(f"/media/{BUCKET_NAME_LARGE_IMAGES}/img")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b"image bytes")
+            response.close()
+
+            self.assertEqual(client.get("/media/other-bucket/img").status_code, 404)
+
+        self.assertEqual(client.get(f"/media/{BUCKET_NAME_LARGE_IMAGES}/img").status_code, 404)
+
+
+class S3StorageBackendTestCase(unittest.TestCase):
+    def test_client_created_once_on_first_use(self):
+        storage = S3StorageBackend()
+        self.assertIsNone(storage._client)
+
+        with patch("boto3.client") as make_client:
+            self.assertIs(storage.client, storage.client)
+
+        make_client.assert_called_once()
+
+    def test_import_does_not_load_boto3(self):
+        env = {key: value for key, value in os.environ.items()
+               if key not in ("aws_access_key_id", "aws_secret_access_key")}
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, app; print('boto3' in sys.modules)"],
+            env=env, capture_output=True, text=True, check=True)
+
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_make_storage_backend(self):
+        self.assertIsInstance(make_storage_backend("s3"), S3StorageBackend)
+        self.assertIsInstance(make_storage_backend("file:///tmp/images"), LocalStorageBackend)
+        with self.assertRaises(ValueError):
+            make_storage_backend("ftp://example.com")
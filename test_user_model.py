@@ -1,6 +1,8 @@
 import unittest
+from unittest.mock import patch
 from app import app
 from models import db, User, DEFAULT_USER_IMAGE_URL
+from passwords import password_hasher
 
 class TestUserModel(unittest.TestCase):
 
@@ -46,6 +48,24 @@ class TestUserModel(unittest.TestCase):
         auth_user_wrong_username = User.authenticate("wronguser", "password")
         self.assertFalse(auth_user_wrong_username)
 
+    def test_authenticate_rehashes_old_cost(self):
+        """Test that logging in upgrades a hash made at an older cost."""
+
+        with patch.object(password_hasher, "rounds", 4):
+            User.signup("testuser", "test@test.com", "password", "Test City")
+            db.session.commit()
+
+        with patch.object(password_hasher, "rounds", 5):
+            self.assertFalse(User.authenticate("testuser", "wrong_password"))
+            self.assertTrue(db.session.get(User, "testuser").password.startswith("$2b$04$"))
+
+            User.authenticate("testuser", "password")
+            db.session.commit()
+
+        pw_hash = db.session.get(User, "testuser").password
+        self.assertTrue(pw_hash.startswith("$2b$05$"))
+        self.assertTrue(User.authenticate("testuser", "password"))
+
     def test_serialize(self):
         """Test if the serialize method returns correct data."""
 
@@ -1,8 +1,9 @@
 import unittest
 import json
-from app import app
+from app import app, response_cache, user_cache, revoked_tokens
 from models import db, User, Pool
 from flask_jwt_extended import create_access_token
+from sqlalchemy import event
 
 class TestUsersViews(unittest.TestCase):
 
@@ -11,6 +12,9 @@ class TestUsersViews(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
         app.config['TESTING'] = True
         self.client = app.test_client()
+        response_cache.clear()
+        user_cache.clear()
+        revoked_tokens.clear()
 
         db.drop_all()
         db.create_all()
@@ -36,6 +40,40 @@ class TestUsersViews(unittest.TestCase):
         self.assertIn("users", json_response)
         self.assertEqual(len(json_response["users"]), 2)
 
+    def test_list_users_pagination(self):
+        """Test that list_users pages by username and caps the page size."""
+        for username in ["carol", "alice", "bob"]:
+            db.session.add(User(username=username, email=f"{username}@test.com",
+                                password="password"))
+        db.session.commit()
+
+        response = self.client.get("/api/users?limit=2")
+        json_response = json.loads(response.data)
+        self.assertEqual([u["username"] for u in json_response["users"]], ["alice", "bob"])
+        self.assertEqual(json_response["next_cursor"], "bob")
+
+        response = self.client.get("/api/users?limit=2&after=bob")
+        json_response = json.loads(response.data)
+        self.assertEqual([u["username"] for u in json_response["users"]], ["carol"])
+        self.assertIsNone(json_response["next_cursor"])
+
+        response = self.client.get("/api/users?limit=100000")
+        self.assertEqual(response.status_code, 200)
+
+    def test_export_users(self):
+        """Test that export_users streams one JSON object per line."""
+        for username in ["carol", "alice", "bob"]:
+            db.session.add(User(username=username, email=f"{username}@test.com",
+                                password="password"))
+        db.session.commit()
+
+        response = self.client.get("/api/export/users")
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([u["username"] for u in lines], ["alice", "bob", "carol"])
+        self.assertNotIn("password", lines[0])
+
     def test_show_user(self):
             """Test the show_user route."""
             user = User.signup("testuser", "test@test.com", "password", "Test City")
@@ -83,6 +121,46 @@ class TestUsersViews(unittest.TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_current_user_cached(self):
+        """Test that the user behind a token is loaded once, then cached."""
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        user_queries = []
+
+        def count_user_queries(conn, cursor, statement, *args):
+            if "FROM users" in statement:
+                user_queries.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_user_queries)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", count_user_queries)
+
+        response = self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(user_queries), 1)
+
+        response = self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(user_queries), 1)
+
+    def test_update_user_refreshes_cache(self):
+        """Test that a cached user is dropped when updated or deleted."""
+        User.signup("testuser", "test@test.com", "password", "Test City")
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        self.client.patch("/api/users/testuser", headers=headers,
+                          json={"email": "first@test.com", "location": "Test City"})
+        response = self.client.patch("/api/users/testuser", headers=headers,
+                                     json={"email": "second@test.com", "location": "Test City"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(db.session.get(User, "testuser").email, "second@test.com")
+
+        self.client.delete("/api/users/delete/testuser", headers=headers)
+        response = self.client.get("/api/reservations/testuser", headers=headers)
+        self.assertEqual(response.status_code, 401)
+
     def test_list_pools_of_user(self):
         """Test the list_pools_of_user route."""
         user = User.signup("testuser", "test@test.com", "password", "Test City")